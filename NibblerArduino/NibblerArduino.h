@@ -30,6 +30,20 @@
  */
 #define BAUDRATE 115200
 
+/*
+ Protocolo 2, que el programa de la computadora solicita con `V` después de elegir el modo. Cada bloque se envía con el
+ byte de sincronía, la longitud de la información, un número de secuencia, la información y un CRC-8 de la longitud,
+ la secuencia y la información. Los comandos pueden llegar como paquetes de LARGO_PAQUETE bytes: sincronía, comando,
+ cantidad de veces, argumento 0 (16 bits, LSB primero), argumento 1 y el CRC-8 de los 5 bytes anteriores. Los comandos
+ en texto del protocolo 1 siguen funcionando.
+ */
+#define VERSION_PROTOCOLO 2
+#define SINCRONIA 0xA5
+#define BYTES_INFORMACION 12
+#define LARGO_PAQUETE 7
+// CRC-8 con el polinomio x^8 + x^2 + x + 1
+#define POLINOMIO_CRC8 0x07
+
 // Determina la dirección del programa (PC), conéctese a los 3 contadores
 #define PC0 24
 #define PC1 25
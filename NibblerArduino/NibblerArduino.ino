@@ -26,6 +26,9 @@
 #include "NibblerArduino.h"
 
 int sel = 0;
+// La versión del protocolo con el que se envían los bloques y el número de secuencia del siguiente bloque
+uint8_t protocolo = 1;
+uint8_t secuencia = 0;
 
 /*
     Configura Arduino para incializar la CPU Nibbler. En primer lugar, configura todos los puertos para entradas. Esto
@@ -128,6 +131,7 @@ void loop() {
     B DEC: Cambia el valor de los botones a los primeros 4 bits LSB del número decimal DEC
     C: Envía un pulso de reloj a la CPU
     P: Envía un pulso de propagación a la CPU
+    V: Cambia al protocolo 2
 */
 void depurarPrograma() {
   int comando = 0;
@@ -154,6 +158,12 @@ void depurarPrograma() {
     case '0':
       Serial.println("0p0");
       break;
+    case 'V':
+      cambiarProtocolo();
+      break;
+    case SINCRONIA:
+      atenderPaquete();
+      break;
   }
 }
 
@@ -167,6 +177,7 @@ void depurarPrograma() {
     C: Envía un pulso de reloj a la CPU
     P: Envía un pulso de propagación a la CPU
     I (PROG[0] | PROG[1]) (ESLARGA): envía una instrucción PROG con los bytes en MSB y 1 si la instrucción es larga
+    V: Cambia al protocolo 2
 */
 void depurarInstruccion() {
   int comando = 0;
@@ -196,6 +207,74 @@ void depurarInstruccion() {
     case '1':
       Serial.println("0p1");
       break;
+    case 'V':
+      cambiarProtocolo();
+      break;
+    case SINCRONIA:
+      atenderPaquete();
+      break;
+  }
+}
+
+void cambiarProtocolo() {
+  Serial.print("0v");
+  Serial.println(VERSION_PROTOCOLO);
+  protocolo = VERSION_PROTOCOLO;
+  secuencia = 0;
+}
+
+uint8_t crc8(const uint8_t *datos, uint8_t largo) {
+  uint8_t crc = 0;
+  for (uint8_t i = 0; i < largo; i++) {
+    crc ^= datos[i];
+    for (uint8_t j = 0; j < 8; j++) {
+      crc = crc & 0x80 ? (crc << 1) ^ POLINOMIO_CRC8 : crc << 1;
+    }
+  }
+  return crc;
+}
+
+/*
+  Atiende un paquete del protocolo 2, después de leer su byte de sincronía. Los argumentos llegan en binario, así que
+  no hay que esperar a `Serial.parseInt`, y el comando se ejecuta tantas veces como indique el paquete. Un paquete con
+  un CRC incorrecto se descarta.
+*/
+void atenderPaquete() {
+  uint8_t paquete[LARGO_PAQUETE - 1];
+  if (Serial.readBytes(paquete, sizeof(paquete)) != sizeof(paquete)) {
+    return;
+  }
+  if (crc8(paquete, sizeof(paquete) - 1) != paquete[sizeof(paquete) - 1]) {
+    return;
+  }
+  uint16_t argumento0 = paquete[2] | paquete[3] << 8;
+  uint8_t argumento1 = paquete[4];
+  for (uint8_t i = 0; i < paquete[1]; i++) {
+    switch (paquete[0]) {
+      case 'O' :
+        enviarEstado('o');
+        break;
+      case 'R' :
+        resetCPU();
+        if (sel == '1') {
+          escribirPROGBYTE(0,  0);
+        }
+        break;
+      case 'B' :
+        escribirBOTON(argumento0);
+        break;
+      case 'C' :
+        pulso();
+        break;
+      case 'P' :
+        propagar();
+        break;
+      case 'I' :
+        if (sel == '1') {
+          escribirPROGBYTE(argumento1,  argumento0);
+        }
+        break;
+    }
   }
 }
 
@@ -219,7 +298,18 @@ void enviarEstado(char t) {
   data[11] = leerPROG();
   data[12] = leerACC();
   data[13] = leerOUT();
-  Serial.write(data, sizeof(data));
+  if (protocolo == 2) {
+    // Con el protocolo 2 la cabecera se reemplaza por la sincronía, la longitud y la secuencia, y se agrega el CRC
+    uint8_t bloque[BYTES_INFORMACION + 4];
+    bloque[0] = SINCRONIA;
+    bloque[1] = BYTES_INFORMACION;
+    bloque[2] = secuencia++;
+    memcpy(bloque + 3, data + 2, BYTES_INFORMACION);
+    bloque[sizeof(bloque) - 1] = crc8(bloque + 1, sizeof(bloque) - 2);
+    Serial.write(bloque, sizeof(bloque));
+  } else {
+    Serial.write(data, sizeof(data));
+  }
   Serial.flush();
 }
 
@@ -0,0 +1,134 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+"""
+Panel de analizador lógico para la interfaz de `curses`: las 16 señales del microcódigo y las banderas CERO, ACARREO y
+FASE en los últimos ciclos del reloj, una columna por ciclo. Cada byte de la ROM de microcódigo se decodifica con una
+tabla de 256 entradas calculada una sola vez. Las formas de onda se dibujan en subventanas sin borde; cuando llegan
+ciclos nuevos, cada fila se recorre a la izquierda con `delch` y solo se escriben las columnas nuevas.
+"""
+import curses
+from collections import deque
+
+from ensamblador_reverso import ACTIVAS_EN_BAJO0, ACTIVAS_EN_BAJO1
+from grabacion import FLANCOS
+
+# MICROROM0 y MICROROM1, del bit 0 al 7
+NOMBRES_MICRO0 = ("nLOADOUT", "nOEOPERAND", "nOEIN", "nOEALU", "nWERAM", "nCSPRAM", "S0ALU", "S1ALU")
+NOMBRES_MICRO1 = ("S2ALU", "S3ALU", "MALU", "nCARRYIN", "nLDFLAGS", "nLOADA", "nLOADPC", "INCPC")
+# Las filas del panel; las banderas son los 3 bits más bajos del byte de banderas del bloque
+SENALES = NOMBRES_MICRO0 + NOMBRES_MICRO1 + ("CERO", "ACARREO", "FASE")
+# El ancho de la columna de los nombres, con un espacio de separación
+ANCHO_NOMBRES = max(len(nombre) for nombre in SENALES) + 1
+
+
+def _tabla(bits, activas_en_bajo):  # type: (int, int) -> list
+    """
+    Precalcula, para cada valor de un byte, el código de cada una de sus señales: el bit 0 es el nivel y el bit 1 indica
+    si la señal está activa.
+    """
+    return [bytearray(valor >> i & 1 | ((valor >> i & 1) != (activas_en_bajo >> i & 1)) << 1 for i in range(bits))
+            for valor in range(1 << bits)]
+
+
+TABLA_MICRO0 = _tabla(8, ACTIVAS_EN_BAJO0)
+TABLA_MICRO1 = _tabla(8, ACTIVAS_EN_BAJO1)
+TABLA_BANDERAS = _tabla(3, 0)
+
+
+class AnalizadorLogico(object):
+    """
+    Las últimas columnas recibidas y las subventanas donde se dibujan.
+    :param muestras: cuántos ciclos se conservan para volver a dibujar el panel después de cambiar su tamaño
+    """
+
+    def __init__(self, muestras=512):  # type: (int) -> None
+        self.columnas = deque(maxlen=muestras)
+        # Las columnas que llegaron desde el último dibujo
+        self.pendientes = 0
+        # Cada subventana con la primera señal que muestra y cuántas
+        self.ondas = []  # type: list
+        self.ancho = 0
+        self.resaltado = 0
+        self.simbolos = ("_", "-")
+
+    def visible(self):  # type: () -> bool
+        return bool(self.ondas)
+
+    def agregar(self, trama):  # type: (bytearray) -> None
+        """
+        Agrega una columna por cada bloque con el formato que entrega `receptor` que sigue a un flanco del reloj.
+        """
+        if FLANCOS[trama[0]]:
+            self.columnas.append(TABLA_MICRO0[trama[5]] + TABLA_MICRO1[trama[6]] + TABLA_BANDERAS[trama[7] & 7])
+            self.pendientes += 1
+
+    def limpiar(self):
+        self.columnas.clear()
+        self.pendientes = self.ancho
+
+    def ubicar(self, ventana, resaltado=curses.A_REVERSE):  # type: (object, int) -> None
+        """
+        Reparte las señales en el interior de una ventana con borde, en tantas columnas como se necesiten para que
+        quepan, escribe sus nombres y crea las subventanas de las formas de onda.
+        :param resaltado: el atributo de las señales activas
+        """
+        alto, ancho = ventana.getmaxyx()
+        filas = max(1, alto - 2)
+        grupos = -(-len(SENALES) // filas)
+        ancho_grupo = (ancho - 2) // grupos
+        # La última columna de cada subventana no se usa: escribir en la esquina inferior derecha desplaza la ventana
+        self.ancho = max(1, ancho_grupo - ANCHO_NOMBRES - 2)
+        self.resaltado = resaltado
+        self.simbolos = (curses.ACS_S9, curses.ACS_S1)
+        self.ondas = []
+        for grupo in range(grupos):
+            primera = grupo * filas
+            cantidad = min(filas, len(SENALES) - primera)
+            x = 1 + grupo * ancho_grupo
+            for fila in range(cantidad):
+                ventana.addstr(1 + fila, x, SENALES[primera + fila].ljust(ANCHO_NOMBRES)[:ancho_grupo - 1])
+            ondas = ventana.derwin(cantidad, self.ancho + 1, 1, x + ANCHO_NOMBRES)
+            # Los cambios en la subventana marcan a la ventana de su marco, que es la que se copia a la pantalla
+            ondas.syncok(True)
+            self.ondas.append((ondas, primera, cantidad))
+        self.pendientes = self.ancho
+
+    def quitar(self):
+        self.ondas = []
+
+    def _escribir(self, ondas, primera, cantidad, x, columna):
+        # type: (object, int, int, int, bytearray) -> None
+        for fila in range(cantidad):
+            if columna is None:
+                ondas.addch(fila, x, ord(" "))
+            else:
+                codigo = columna[primera + fila]
+                ondas.addch(fila, x, self.simbolos[codigo & 1], self.resaltado if codigo & 2 else 0)
+
+    def dibujar(self):  # type: () -> bool
+        """
+        Dibuja las columnas pendientes: si son menos que el ancho del panel, recorre las filas y solo escribe las
+        nuevas; si no, dibuja el panel completo.
+        :return: si se escribió algo
+        """
+        if not self.ondas or not self.pendientes:
+            return False
+        nuevas = self.pendientes
+        if nuevas >= self.ancho:
+            # El panel completo, con espacios a la izquierda si todavía no hay suficientes ciclos
+            nuevas = self.ancho
+            for ondas, primera, cantidad in self.ondas:
+                ondas.erase()
+        else:
+            for ondas, primera, cantidad in self.ondas:
+                for fila in range(cantidad):
+                    for i in range(nuevas):
+                        ondas.delch(fila, 0)
+        total = len(self.columnas)
+        for ondas, primera, cantidad in self.ondas:
+            for i in range(nuevas):
+                j = total - nuevas + i
+                self._escribir(ondas, primera, cantidad, self.ancho - nuevas + i, self.columnas[j] if j >= 0 else None)
+        self.pendientes = 0
+        return True
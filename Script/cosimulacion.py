@@ -0,0 +1,281 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+"""
+Co-simulación para encontrar errores de cableado en una placa: ejecuta un guion (ver `lotes`) en la placa y, al mismo
+tiempo, en el modelo de `simulador`, que recibe exactamente los mismos bytes que se escriben en el puerto. Cada bloque
+de la placa se compara con el del modelo y la ejecución se detiene en la primera diferencia, con un reporte de las
+señales que difieren y los pines de Arduino que las leen, según `NibblerArduino.h`.
+
+Los comandos se envían encadenados con `ejecutar_pasos` y el modelo se ejecuta después sobre todo el lote, así que la
+comparación no agrega viajes de ida y vuelta: si el lote coincide, basta una sola comparación de listas.
+
+    python cosimulacion.py /dev/ttyACM0 115200 0 guion.txt --rom programa.bin
+
+Lo que la placa no deja ver se toma de ella la primera vez que se necesita: los registros al encender, cada dirección
+de la RAM que se lee antes de escribirla y, sin `--rom`, cada byte de la ROM del programa. En ese caso los pines
+del byte del programa no se pueden revisar.
+"""
+import argparse
+import os
+import re
+import sys
+
+from lotes import leer_guion, traducir
+from grabacion import reloj_monotonico
+from receptor import CABECERA, VERSION_PROTOCOLO, ConexionNibbler
+from simulador import LectorBytes, NucleoNibbler, FirmwareNibbler, nCSRAM, nOEIN, nOEOPERAND, nWERAM
+from analizador import NOMBRES_MICRO0, NOMBRES_MICRO1
+
+# El encabezado del firmware, con los pines de cada señal
+CABECERA_FIRMWARE = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "NibblerArduino",
+                                 "NibblerArduino.h")
+# Para cada campo del bloque: su nombre, su posición, los nombres de sus bits y las constantes de sus pines en
+# `NibblerArduino.h`, del bit 0 en adelante. El PC ocupa dos bytes
+CAMPOS = (
+    ("DATOS", 1, ("DATO0", "DATO1", "DATO2", "DATO3"), ("DATA0", "DATA1", "DATA2", "DATA3")),
+    ("PC", 2, tuple("PC{0:d}".format(i) for i in range(12)), tuple("PC{0:d}".format(i) for i in range(12))),
+    ("FETCH", 4, ("OPRND0", "OPRND1", "OPRND2", "OPRND3", "INSTR0", "INSTR1", "INSTR2", "INSTR3"),
+     ("OPRND0", "OPRND1", "OPRND2", "OPRND3", "INSTR0", "INSTR1", "INSTR2", "INSTR3")),
+    ("MICROROM0", 5, NOMBRES_MICRO0, tuple("MICRO0_{0:d}".format(i) for i in range(8))),
+    ("MICROROM1", 6, NOMBRES_MICRO1, tuple("MICRO1_{0:d}".format(i) for i in range(8))),
+    ("BANDERAS", 7, ("CERO", "ACARREO", "FASE", "RESET"), ("nZERO", "nCARRY", "PHASE", "nRESET")),
+    ("BOTONES", 8, ("BOTON0", "BOTON1", "BOTON2", "BOTON3"), ("nBOTON0", "nBOTON1", "nBOTON2", "nBOTON3")),
+    ("PROGBYTE", 9, tuple("PROG{0:d}".format(i) for i in range(8)), tuple("PROG{0:d}".format(i) for i in range(8))),
+    ("ACUMULADOR", 10, ("ACC0", "ACC1", "ACC2", "ACC3"), ("ACC0", "ACC1", "ACC2", "ACC3")),
+    ("SALIDA", 11, ("OUT0", "OUT1", "OUT2", "OUT3"), ("OUT0", "OUT1", "OUT2", "OUT3")),
+)
+
+
+def leer_pines(archivo=CABECERA_FIRMWARE):  # type: (str) -> dict
+    """
+    Lee los `#define` de `NibblerArduino.h`.
+    :return: un diccionario con el valor de cada constante, vacío si el archivo no existe
+    """
+    pines = {}
+    if not os.path.exists(archivo):
+        return pines
+    with open(archivo) as cabecera:
+        for linea in cabecera:
+            definicion = re.match(r"\s*#define\s+(\w+)\s+(\w+)", linea)
+            if definicion:
+                pines[definicion.group(1)] = definicion.group(2)
+    return pines
+
+
+def _valor(trama, posicion):  # type: (bytearray, int) -> int
+    if posicion == 2:
+        return trama[2] | (trama[3] & 0xF) << 8
+    return trama[posicion]
+
+
+def diferencias(placa, modelo, pines=None):  # type: (bytearray, bytearray, dict) -> list
+    """
+    Compara dos bloques campo por campo.
+    :return: las líneas del reporte, vacía si los bloques coinciden
+    """
+    pines = pines or {}
+    lineas = []
+    if placa[0] != modelo[0]:
+        lineas.append("COMANDO: placa {0:s}, modelo {1:s}".format(repr(chr(placa[0])), repr(chr(modelo[0]))))
+    for nombre, posicion, senales, constantes in CAMPOS:
+        valor_placa = _valor(placa, posicion)
+        valor_modelo = _valor(modelo, posicion)
+        distintos = valor_placa ^ valor_modelo
+        if not distintos:
+            continue
+        lineas.append("{0:s}: placa 0x{1:X}, modelo 0x{2:X}".format(nombre, valor_placa, valor_modelo))
+        bits = [i for i in range(len(senales)) if distintos >> i & 1]
+        for i in bits:
+            lineas.append("    {0:s}: placa {1:d}, modelo {2:d}, pin {3:s}{4:s}".format(
+                senales[i], valor_placa >> i & 1, valor_modelo >> i & 1, constantes[i],
+                " ({0:s})".format(pines[constantes[i]]) if constantes[i] in pines else ""))
+        if len(bits) == 2 and (valor_placa >> bits[0] & 1) == (valor_modelo >> bits[1] & 1) and \
+                (valor_placa >> bits[1] & 1) == (valor_modelo >> bits[0] & 1):
+            lineas.append("    posible cruce entre los pines {0:s} y {1:s}".format(constantes[bits[0]],
+                                                                               constantes[bits[1]]))
+    return lineas
+
+
+class FirmwareReferencia(FirmwareNibbler):
+    """
+    El firmware simulado como referencia: en lugar de codificar los bloques para el puerto, los acumula en `tramas`
+    con el formato que entrega `receptor`. Antes de cada bloque toma de la placa lo que el modelo no puede saber.
+    :param rom: la imagen de la ROM del programa, o None para tomar cada byte de la placa
+    """
+
+    def __init__(self, rom=None):  # type: (bytearray) -> None
+        FirmwareNibbler.__init__(self, NucleoNibbler(rom))
+        self.tramas = []  # type: list
+        # Los bloques de la placa que corresponden a los que el modelo va a generar
+        self.esperadas = []  # type: list
+        self.ram_conocida = bytearray(len(self.nucleo.ram))
+        self.rom_conocida = bytearray([int(rom is not None)]) * len(self.nucleo.rom)
+        self.sincronizado = False
+
+    def _adoptar(self, trama):  # type: (bytearray) -> None
+        nucleo = self.nucleo
+        if not self.sincronizado:
+            # Los registros al encender la placa
+            nucleo.pc = trama[2] | (trama[3] & 0xF) << 8
+            nucleo.fetch = trama[4]
+            nucleo.cero = bool(trama[7] & 1)
+            nucleo.acarreo = bool(trama[7] & 2)
+            nucleo.fase = trama[7] >> 2 & 1
+            nucleo.boton = trama[8]
+            nucleo.acc = trama[10]
+            nucleo.out = trama[11]
+            self.sincronizado = True
+        if nucleo.prog_forzado is None and not self.rom_conocida[nucleo.pc]:
+            nucleo.rom[nucleo.pc] = trama[9]
+            self.rom_conocida[nucleo.pc] = 1
+        u0, u1 = nucleo.senales()
+        if u0 & nCSRAM:
+            return
+        direccion = (nucleo.fetch & 0xF) << 8 | nucleo.progb
+        if not u0 & nWERAM:
+            self.ram_conocida[direccion] = 1
+        elif u0 & nOEOPERAND and u0 & nOEIN and not self.ram_conocida[direccion]:
+            # Una lectura de la RAM antes de escribirla: el valor es el que reproduce el bus de la placa, aunque pase
+            # por la ALU
+            for valor in range(16):
+                nucleo.ram[direccion] = valor
+                if nucleo.datos == trama[1]:
+                    break
+            else:
+                nucleo.ram[direccion] = 0
+            self.ram_conocida[direccion] = 1
+
+    def enviar_estado(self, t):
+        i = len(self.tramas)
+        if i < len(self.esperadas):
+            self._adoptar(self.esperadas[i])
+        self.tramas.append(self.nucleo.bloque(ord(t))[2:] + CABECERA)
+
+
+class SerialEspejo(object):
+    """
+    Envuelve el puerto de la placa: todo lo que se escribe también se guarda para el modelo.
+    """
+
+    def __init__(self, serial, lector):  # type: (object, LectorBytes) -> None
+        self._serial = serial
+        self._lector = lector
+
+    def write(self, datos):
+        self._lector.agregar(bytearray(datos))
+        return self._serial.write(datos)
+
+    def __getattr__(self, nombre):
+        return getattr(self._serial, nombre)
+
+
+class Cosimulacion(object):
+    """
+    Una placa ya abierta y su modelo de referencia en el mismo estado.
+    """
+
+    def __init__(self, placa, modo, rom=None, pines=None):  # type: (ConexionNibbler, int, bytearray, dict) -> None
+        self.placa = placa
+        self.modo = str(modo)
+        self.modelo = FirmwareReferencia(rom)
+        self.lector = LectorBytes()
+        self.pines = pines or {}
+        self.comparados = 0
+        placa.serial = SerialEspejo(placa.serial, self.lector)
+
+    def inicio(self, bloques, espera=1.0):  # type: (list, float) -> list
+        """
+        Compara los bloques que la placa envió al abrir el puerto con el reset del modelo. Con el protocolo 1, el final
+        del reset puede llegar después de que `abrir` termina: se espera hasta su último bloque (`r`).
+        """
+        bloques = list(bloques)
+        limite = reloj_monotonico() + espera
+        while (not bloques or bloques[-1][0] != ord("r")) and reloj_monotonico() < limite:
+            self.placa.esperar([self.placa.serial], limite - reloj_monotonico())
+            bloques += self.placa.leer_tramas()
+        self.modelo.esperadas = bloques
+        self.modelo.iniciar()
+        self.modelo.seleccionar_modo(self.modo)
+        return self._comparar(bloques)
+
+    def ejecutar(self, comando, pasos, condicion=None, ventana=32, final=None):
+        # type: (str, int, object, int, str) -> (list, int, int, list)
+        """
+        Igual que `ConexionNibbler.ejecutar_pasos`, y después ejecuta lo enviado en el modelo.
+        :return: los bloques, los pasos completados, el paso en que se cumplió la condición y el reporte de la primera
+        diferencia, vacío si todos los bloques coinciden
+        """
+        # Los bloques que llegaron sin un comando no tienen equivalente en el modelo
+        previos = self.placa.leer_tramas()
+        if previos:
+            return previos, 0, 0, ["La placa envió {0:d} bloques sin recibir un comando.".format(len(previos))]
+        bloques, completados, detenido = self.placa.ejecutar_pasos(comando, pasos, condicion, ventana, final=final)
+        self.modelo.esperadas = bloques
+        while self.lector.buffer:
+            self.modelo.atender(self.lector)
+        return bloques, completados, detenido, self._comparar(bloques)
+
+    def _comparar(self, bloques):  # type: (list) -> list
+        modelo = self.modelo.tramas
+        self.modelo.tramas = []
+        self.modelo.esperadas = []
+        if modelo == bloques:
+            self.comparados += len(bloques)
+            return []
+        for i, (trama, referencia) in enumerate(zip(bloques, modelo)):
+            if trama != referencia:
+                break
+        else:
+            i = min(len(bloques), len(modelo))
+        self.comparados += i
+        reporte = ["Diferencia en el bloque {0:d} del lote ({1:d} de la placa, {2:d} del modelo):".format(
+            i + 1, len(bloques), len(modelo))]
+        if i < len(bloques) and i < len(modelo):
+            reporte += diferencias(bloques[i], modelo[i], self.pines)
+        else:
+            reporte.append("la placa envió {0:s} bloques que el modelo".format("más" if len(bloques) > i else "menos"))
+        return reporte
+
+
+if __name__ == "__main__":
+    argumentos = argparse.ArgumentParser(description="Compara una placa con el modelo de la CPU Nibbler mientras "
+                                                     "ejecuta un guion.")
+    argumentos.add_argument("puerto", help="el puerto serial, o host:puerto para conectarse a servidor.py")
+    argumentos.add_argument("baud", type=int, help="la tasa de baudios")
+    argumentos.add_argument("modo", type=int, choices=(0, 1), help="modo de operación: 0 programa, 1 instrucción")
+    argumentos.add_argument("guion", help="el guion de comandos (ver lotes.py), o - para leerlo de la entrada estándar")
+    argumentos.add_argument("--rom", metavar="ARCHIVO",
+                            help="la imagen de la ROM del programa; sin ella, los bytes del programa se toman de la "
+                                 "placa")
+    argumentos.add_argument("--pines", metavar="ARCHIVO", default=CABECERA_FIRMWARE,
+                            help="el encabezado del firmware con los pines (por omisión NibblerArduino.h)")
+    argumentos.add_argument("--limite", metavar="N", type=int, default=10000,
+                            help="máximo de instrucciones para HASTA (por omisión %(default)s)")
+    argumentos.add_argument("--protocolo", type=int, choices=(1, 2), default=VERSION_PROTOCOLO,
+                            help="la versión más alta del protocolo con Arduino (por omisión %(default)s)")
+    opciones = argumentos.parse_args()
+
+    guion = sys.stdin if opciones.guion == "-" else open(opciones.guion)
+    rom = bytearray(open(opciones.rom, "rb").read()) if opciones.rom else None
+    placa = ConexionNibbler()
+    iniciales = placa.abrir(opciones.puerto, opciones.baud, str(opciones.modo), opciones.protocolo)
+    cosimulacion = Cosimulacion(placa, opciones.modo, rom, leer_pines(opciones.pines))
+    reporte = cosimulacion.inicio(iniciales)
+    lugar = "Al abrir el puerto"
+    try:
+        for numero, orden, argumento in leer_guion(guion):
+            if reporte:
+                break
+            lugar = "Línea {0:d} del guion, {1:s} {2:s}".format(numero, orden, argumento).rstrip()
+            comando, pasos, condicion, ventana, final = traducir(orden, argumento, opciones.modo, opciones.limite)
+            bloques, completados, detenido, reporte = cosimulacion.ejecutar(comando, pasos, condicion, ventana, final)
+            if completados < pasos and not detenido and not reporte:
+                reporte = ["Arduino dejó de responder después de {0:d} de {1:d} pasos.".format(completados, pasos)]
+    finally:
+        placa.cerrar()
+    if reporte:
+        sys.stdout.write(lugar + ". " + "\n".join(reporte) + "\n")
+    sys.stderr.write("{0:d} bloques comparados{1:s}.\n".format(cosimulacion.comparados,
+                                                               ", con diferencias" if reporte else " sin diferencias"))
+    sys.exit(1 if reporte else 0)
@@ -16,14 +16,28 @@ Este script, el esamblador y el ensamblador reverso son software libre bajo la l
 
 Copyright (c) 2016 Oever González
 """
+import argparse
+import json
+import os
 import sys
-from curses import *
+from collections import OrderedDict, deque
+from curses import (A_BOLD, COLOR_BLACK, COLOR_BLUE, COLOR_CYAN, COLOR_WHITE, COLOR_YELLOW, KEY_BTAB, KEY_END,
+                    KEY_LEFT, KEY_RESIZE, KEY_RIGHT, color_pair, error, has_colors, init_pair, newwin, start_color,
+                    wrapper)
 from math import floor
-from time import sleep
 
-from ensamblador import ensamblar
-from ensamblador_reverso import decodificar_datos, disasm
-from receptor import *
+from editor_linea import ESCAPE, EditorLinea
+from ensamblador_reverso import ACTIVAS_EN_BAJO0, ACTIVAS_EN_BAJO1, EstadoCpu, disasm
+from grabacion import BLOQUES_FINALES, Reproductor, reloj_monotonico
+from historia import HistorialTramas
+from puntos_ruptura import PuntosRuptura, traducir
+from receptor import VERSION_PROTOCOLO, ConexionNibbler, MultiplexorNibbler, bits
+from renderizador import Lienzo
+
+# El analizador lógico, el perfilador y la copia de la ROM se importan y se crean la primera vez que se usan: el
+# analizador con 'a', el perfil con 'f' (o al iniciar, con --perfil) y la copia de la ROM con el primer bloque del modo
+# programa, para el listado; se ponen al día con los bloques que conserva el historial. El ensamblador se importa con
+# 'i', con el mapa de símbolos o con alguno de los dos últimos, que lo usan
 
 min_x = 90
 min_y = 28
@@ -31,6 +45,156 @@ min_y = 28
 l_cmd_enviado = ""
 l_disasm_enviado = ""
 
+# Tiempo máximo que la interfaz duerme sin recibir bloques ni teclas
+espera_maxima = 0.25
+# Lo mismo mientras alguna placa se está abriendo, para mostrar sus primeros bloques en cuanto lleguen
+espera_conexion = 0.02
+# Máximo de veces por segundo que se dibuja la pantalla cuando los bloques llegan más rápido
+cuadros_por_segundo = 30
+# Límite de instrucciones para "ejecutar hasta" si no se indica otro, por si la dirección nunca se alcanza
+pasos_maximos = 10000
+# Duración de cada parte de una corrida ('n', 'u' o 'e'); entre una parte y otra se atienden el teclado y las placas
+duracion_parte = 0.1
+# Para informar el tiempo desde que se inicia el depurador hasta el primer bloque
+momento_inicio = reloj_monotonico()
+# Las teclas de los comandos que se envían a Arduino, que esperan a que la placa termine de abrirse
+teclas_placa = frozenset(bytearray(b"rRoOcCpPnNuU*eEbBiI"))
+
+
+def _filas_microcodigo(activas_en_bajo):  # type: (int) -> list
+    """
+    Precalcula, para cada uno de los 256 valores de un byte de microcódigo, las dos filas de etiquetas que muestra la
+    ventana de banderas.
+    :param activas_en_bajo: máscara de las señales que se activan con 0
+    """
+    filas = []
+    for valor in range(256):
+        etiquetas = ["ACTIVADO" if (valor >> i & 1) != (activas_en_bajo >> i & 1) else "DESACTIV" for i in range(8)]
+        filas.append(("\t".join(etiquetas[:4]), "\t".join(etiquetas[4:])))
+    return filas
+
+
+# MICROROM0: nLOADOUT, nOEOPERAND, nOEIN, nOEALU, nWERAM, nCSRAM, S0, S1
+FILAS_MICRO0 = _filas_microcodigo(ACTIVAS_EN_BAJO0)
+# MICROROM1: S2, S3, M, nCARRYIN, nLOADFLAGS, nLOADA, nLOADPC, INCPC
+FILAS_MICRO1 = _filas_microcodigo(ACTIVAS_EN_BAJO1)
+# Los botones se leen con lógica negativa
+FILAS_BOTONES = ["| " + " | ".join("_=_" if not valor >> i & 1 else "___" for i in range(4)) + " |"
+                 for valor in range(16)]
+
+
+class Corrida(object):
+    """
+    Una ejecución de muchos pasos en una placa, enviada por partes de `duracion_parte` segundos. Cada parte usa la
+    ventana normal de comandos en camino, así que la condición se cumple con algunos pasos todavía en camino: esos
+    pasos se ejecutan y se cuentan en `excedente`, y `indice` señala el bloque de la última parte que la cumplió, para
+    mostrarlo en lugar del estado final.
+    :param descripcion: una función que recibe el paso en que se cumplió la condición (0 si no se cumplió) y devuelve
+    el texto que se agrega al resumen
+    :param todas: si es verdadero, la condición se evalúa con todos los bloques, incluidos los de los flancos del
+    reloj; si no, solo con el final de cada paso
+    """
+
+    def __init__(self, conexion, paso, pasos, condicion=None, descripcion=None, todas=False):
+        # type: (ConexionNibbler, str, int, callable, callable, bool) -> None
+        self.conexion = conexion
+        self.paso = paso
+        self.restantes = pasos
+        self.condicion = condicion
+        self.descripcion = descripcion
+        self.todas = todas
+        self.completados = 0
+        self.bloques = 0
+        self.detenido = 0
+        self.indice = -1
+        self.cumplida = None  # type: bytearray
+        self.inicio = reloj_monotonico()
+
+    def _cumple(self, trama):  # type: (bytearray) -> bool
+        if self.condicion(trama):
+            self.cumplida = trama
+            return True
+        return False
+
+    def avanzar(self):  # type: () -> list
+        """
+        Ejecuta la siguiente parte.
+        :return: sus bloques
+        """
+        bloques, completados, detenido = self.conexion.ejecutar_pasos(
+            self.paso, self.restantes, None if self.condicion is None else self._cumple,
+            plazo=reloj_monotonico() + duracion_parte, todas=self.todas)
+        if detenido:
+            self.detenido = self.completados + detenido
+            self.indice = next(i for i, trama in enumerate(bloques) if trama is self.cumplida)
+        self.completados += completados
+        self.bloques += len(bloques)
+        # Si Arduino dejó de responder, la corrida termina
+        self.restantes = 0 if detenido or not completados else self.restantes - completados
+        return bloques
+
+    def terminada(self):  # type: () -> bool
+        return self.restantes <= 0
+
+    def excedente(self):  # type: () -> int
+        return self.completados - self.detenido if self.detenido else 0
+
+    def resumen(self, interrumpida=False, mostrada=False):  # type: (bool, bool) -> str
+        texto = "{0:s} x{1:d}: {2:d} bloques en {3:.2f} s".format(self.paso, self.completados, self.bloques,
+                                                                 reloj_monotonico() - self.inicio)
+        if self.descripcion is not None:
+            texto += ", " + self.descripcion(self.detenido)
+        if self.excedente():
+            texto += " (+{0:d} en camino{1:s})".format(self.excedente(),
+                                                       "; se muestra donde se detuvo" if mostrada else "")
+        if interrumpida:
+            texto += ", interrumpida"
+        return texto
+
+
+def val3op(cond, val_si, val_no):
+    return val_si if cond else val_no
+
+
+def dibujar_estado(escribir, ventana_pc, ventana_datos, ventana_banderas, estado, colores):
+    # type: (callable, object, object, object, EstadoCpu, tuple) -> None
+    """
+    Escribe los campos de un estado en las ventanas de la interfaz mediante `escribir` (ver `Lienzo.escribir`), de
+    modo que solo se escriben los campos que cambiaron desde la última vez.
+    :param ventana_banderas: None si la ventana muestra el analizador lógico
+    :param colores: los atributos de los encabezados de los botones y de las filas resaltadas
+    """
+    encabezado, resaltado = colores
+    escribir(ventana_pc, 1, 1, "PC: 0x{0:04X}, {0:02d}".format(estado.pc))
+    escribir(ventana_pc, 2, 1, "FETCHD: I[0x{0:01X}] O[0x{1:01X}], 0x{2:02X}".format(estado.ejec >> 4,
+                                                                                     estado.ejec & 0xF,
+                                                                                     estado.ejec))
+    escribir(ventana_pc, 3, 1, "PROGBYTE: I[0x{0:01X}] O[0x{1:01X}], 0x{2:02X}".format(estado.progb >> 4,
+                                                                                       estado.progb & 0xF,
+                                                                                       estado.progb))
+    escribir(ventana_pc, 4, 1, "FASE: {0:s}".format(val3op(estado.fase, "EJECUTANDO", "OBTENIENDO")))
+
+    escribir(ventana_datos, 1, 1, "DATOS: 0x{0:02X}".format(estado.datos))
+    escribir(ventana_datos, 2, 1, "BOTONES: 0x{0:02X}".format(estado.boton))
+    escribir(ventana_datos, 3, 1, "| LEFT|RIGHT| DOWN|  UP |", encabezado)
+    escribir(ventana_datos, 4, 1, FILAS_BOTONES[estado.boton & 0xF], resaltado)
+    escribir(ventana_datos, 5, 1, "ACCUMULADOR: 0x{0:02X}, {0:02d}".format(estado.acc))
+    escribir(ventana_datos, 6, 1, "SALIDA: 0x{0:02X}".format(estado.out))
+
+    if ventana_banderas is None:
+        return
+    micro0 = FILAS_MICRO0[estado.u0]
+    micro1 = FILAS_MICRO1[estado.u1]
+    escribir(ventana_banderas, 3, 1, micro0[0], resaltado)
+    escribir(ventana_banderas, 5, 1, micro0[1], resaltado)
+    escribir(ventana_banderas, 8, 1, micro1[0], resaltado)
+    escribir(ventana_banderas, 10, 1, micro1[1], resaltado)
+    escribir(ventana_banderas, 11, 1, "CERO: {0:s},\tACARREO: {1:s},\tFASE: {2:s},\tRESET: {3:s}"
+             .format(val3op(estado.cero, "Sí", "No"),
+                     val3op(estado.acarreo, "Sí", "No"),
+                     val3op(estado.fase, "Sí", "No"),
+                     val3op(estado.reset, "Sí", "No")), A_BOLD)
+
 
 def interface(pantalla):
     """
@@ -70,95 +234,294 @@ def interface(pantalla):
     ventana_entrada.scrollok(True)
     ventana_entrada.idlok(True)
 
-    def val3op(cond, val_si, val_no):
-        return val_si if cond else val_no
-
-    def val3opb(no, cmpr, val_si, val_no, bits):
-        ret = []
-        for i in range(bits):
-            ret.append(val_si if (no >> i & 1) == cmpr else val_no)
-        return ret
-
-    def rewrite():
+    lienzo = Lienzo([ventana_principal, ventana_pc, ventana_datos, marco_comandos, ventana_comandos, marco_disasm,
+                     ventana_disasm, ventana_banderas, marco_entrada, ventana_entrada], cuadros_por_segundo, pantalla)
+    escribir = lienzo.escribir
+    colores = (A_BOLD | color_pair(3), A_BOLD | color_pair(4))
+    puntos = PuntosRuptura()
+    editor = EditorLinea()
+    # La ventana de banderas muestra las etiquetas del estado actual o, con 'a', el analizador lógico
+    analizador = None
+    con_analizador = False
+
+    def mensaje(texto, atributos=A_BOLD | color_pair(4)):
+        ventana_entrada.addstr(texto + "\n", atributos)
+        lienzo.marcar(ventana_entrada)
+
+    def volcar_estadisticas(conexion=None):
+        # Agrega una instantánea de la salud del enlace de una placa al archivo de `--estadisticas`, una por línea
+        conexion = conexion or placa
+        instantanea = OrderedDict([("placa", conexion.archivo)])
+        instantanea.update(conexion.estadisticas())
+        if opciones.estadisticas:
+            with open(opciones.estadisticas, "a") as archivo:
+                archivo.write(json.dumps(instantanea) + "\n")
+        return instantanea
+
+    def titulo():
+        if reproductor is not None:
+            texto = "REPRODUCCIÓN"
+        else:
+            texto = "MODO PROGRAMA" if modo == 0 else "MODO INSTRUCCIÓN"
+            if len(placas) > 1:
+                texto += ", PLACA {0:d}/{1:d}: {2:s}".format(placas.conexiones.index(placa) + 1, len(placas),
+                                                            placa.archivo.ljust(max(len(str(c)) for c in placas)))
+            if placa.conectando():
+                texto += ", CONECTANDO"
+            elif not placa.conectada():
+                texto += ", SIN CONEXIÓN"
+        texto = "Depurador de la CPU Nibbler ({0:s})".format(texto)
+        if vista is not None:
+            # La posición dentro de los bloques que se conservan; el último es el estado actual
+            texto += " HISTORIA {0:d}/{1:d}".format(vista - historial.primero + 1, len(historial))
+        # Los espacios borran lo que quede de un título más largo
+        anchos[0] = max(anchos[0], len(texto))
+        escribir(ventana_principal, 0, 1, texto.ljust(anchos[0]), A_BOLD | color_pair(1))
+
+    def resumen_placa(i, conexion):
+        # Una fila con el último estado conocido de una placa
+        marca = "*" if conexion is placa else " "
+        if conexion.ultima is None:
+            return "{0:s}{1:d} {2:s}: {3:s}".format(marca, i, conexion.archivo, estado_conexion(conexion))
+        cpu = EstadoCpu(conexion.ultima)
+        return "{0:s}{1:d} {2:s}: PC=0x{3:03X} ACC=0x{4:X} OUT=0x{5:X} {6:s}{7:s}{8:s} {9:.0f} bloques/s".format(
+            marca, i, conexion.archivo, cpu.pc, cpu.acc, cpu.out, val3op(cpu.cero, "Z", "-"),
+            val3op(cpu.acarreo, "C", "-"), val3op(cpu.fase, "F", "-"), conexion.estadisticas()["bloques_s"])
+
+    def estado_conexion(conexion):
+        if conexion.conectando():
+            return "conectando, " + conexion.paso_apertura
+        if conexion.error is not None:
+            return "sin conexión, " + str(conexion.error)
+        return "sin datos"
+
+    def al_conectar(conexion):
+        # Informa el resultado de la apertura en segundo plano de una placa y cuánto tardó su primer bloque
+        if conexion.error is not None or conexion.enlace.primer_bloque is None:
+            mensaje("{0:s}: {1:s}".format(conexion.archivo, estado_conexion(conexion)))
+        else:
+            mensaje("{0:s}: primer bloque a los {1:.2f} s del inicio (conexión {2:.2f} s, Arduino {3:.2f} s, "
+                    "protocolo {4:d})".format(conexion.archivo, reloj_monotonico() - momento_inicio,
+                                              conexion.enlace.primer_bloque, conexion.enlace.arranque,
+                                              conexion.protocolo), A_BOLD)
+        if conexion is placa:
+            titulo()
+
+    def simbolos():
+        # Las etiquetas del mapa, que se lee la primera vez que las necesitan el listado o el perfil
+        if opciones.mapa and not etiquetas:
+            from ensamblador import leer_mapa
+            etiquetas.extend(leer_mapa(opciones.mapa))
+        return etiquetas
+
+    def bloques_anteriores(conexion, desde=None):
+        # Los bloques que conserva el historial de una placa, para ponerse al día al crear lo que se crea al usarse
+        return historiales[conexion].tramas(desde) if conexion in historiales else ()
+
+    def sombra_de(conexion):
+        # En el modo programa, una copia de la ROM para el listado del desensamblador
+        if conexion not in sombras:
+            from rom_sombra import RomSombra
+            sombra_nueva = RomSombra()
+            if imagen is not None:
+                sombra_nueva.precargar(imagen)
+            sombra_nueva.cargar_simbolos(simbolos())
+            for trama in bloques_anteriores(conexion):
+                sombra_nueva.observar(trama)
+            sombras[conexion] = sombra_nueva
+        return sombras[conexion]
+
+    def perfil_de(conexion):
+        if conexion not in perfiles:
+            from perfilador import Perfilador
+            perfil_nuevo = Perfilador()
+            perfil_nuevo.cargar_simbolos(simbolos())
+            perfil_nuevo.registrar_bloques(bloques_anteriores(conexion))
+            perfiles[conexion] = perfil_nuevo
+        return perfiles[conexion]
+
+    def nuevo_analizador():
+        from analizador import AnalizadorLogico
+        muestras = 512
+        analizador_nuevo = AnalizadorLogico(muestras)
+        # Basta con los últimos bloques: el analizador solo conserva `muestras` columnas, una por flanco del reloj
+        if placa in historiales:
+            for trama in bloques_anteriores(placa, historiales[placa].total - 4 * muestras):
+                analizador_nuevo.agregar(trama)
+        elif reproductor is not None and posicion >= 0:
+            analizador_nuevo.agregar(reproductor.entrada(posicion)[2])
+        return analizador_nuevo
+
+    def observar_bloques(conexion, bloques):
+        # Los pasos solo muestran el estado final, pero todos sus bloques llenan el historial, la copia de la ROM y el
+        # perfil. El último bloque de la placa que se muestra se agrega cuando se registra
+        for trama in (bloques[:-1] if conexion is placa else bloques):
+            historiales[conexion].agregar(trama)
+        if conexion in sombras:
+            for trama in bloques:
+                sombras[conexion].observar(trama)
+        if conexion in perfiles:
+            perfiles[conexion].registrar_bloques(bloques[:-1] if conexion is placa else bloques)
+        if conexion is placa and analizador is not None:
+            for trama in bloques[:-1]:
+                analizador.agregar(trama)
+
+    def desensamblar(conexion):
+        # Para mostrar la instrucción de cada dirección en el perfil, si se conoce la ROM
+        if sombras.get(conexion) is None:
+            return None
+        return lambda addr: sombras[conexion].instruccion(addr)[0]
+
+    def titulo_comandos():
+        # El panel de los comandos muestra el perfil mientras se ve alguna de sus vistas
+        marco_comandos.box()
+        marco_comandos.addstr(0, 1, "REGISTRO DE COMANDOS" if vista_perfil is None else "PERFIL: " + vista_perfil,
+                              A_BOLD | color_pair(2))
+        lienzo.marcar(marco_comandos)
+
+    def dibujar_perfil():
+        alto, ancho = ventana_comandos.getmaxyx()
+        lineas = ["{0:d} instrucciones, {1:d} ciclos".format(perfil.total(), sum(perfil.ciclos))]
+        lineas += perfil.filas(vista_perfil, alto - 1, desensamblar(placa))
+        for fila in range(alto):
+            texto = lineas[fila] if fila < len(lineas) else ""
+            escribir(ventana_comandos, fila, 0, texto[:ancho - 1].ljust(ancho - 1), A_BOLD if fila == 0 else 0)
+
+    def dibujar_listado(cpu):
+        # En la fase de ejecución se marca la instrucción que se ejecuta, no la siguiente
+        actual = (cpu.pc - 1) & 0xFFF if cpu.fase else cpu.pc
+        alto, ancho = ventana_disasm.getmaxyx()
+        lineas, linea_pc = sombra.listado(actual, alto)
+        for fila in range(alto):
+            texto = ("> " if fila == linea_pc else "  ") + (lineas[fila][1] if fila < len(lineas) else "")
+            escribir(ventana_disasm, fila, 0, texto[:ancho - 1].ljust(ancho - 1), colores[1] if fila == linea_pc else 0)
+
+    def previa_instruccion(texto):
+        # La vista previa de 'i': los bytes de la instrucción ensamblada
+        from ensamblador import ensamblar
+        try:
+            asmed, larga = ensamblar(texto)
+        except ValueError:
+            return "(inválida)"
+        if larga:
+            return "= 0x{0:02X} 0x{1:02X}".format(asmed & 0xFF, asmed >> 8)
+        return "= 0x{0:02X}".format(asmed)
+
+    def previa_condicion(texto):
+        # La vista previa de 'k': si la condición del punto de ruptura es válida
+        try:
+            traducir(texto)
+        except ValueError:
+            return "(inválida)"
+        return ""
+
+    def dibujar_editor():
+        # La línea que se edita ocupa el lugar de la línea de estado del enlace; devuelve la columna del cursor
+        ancho = x_principal - 6
+        etiqueta = chr(editor.orden) + ": "
+        texto = etiqueta + editor.texto
+        previa = editor.previa()
+        if previa:
+            texto += "  " + previa
+        escribir(ventana_principal, y_principal + 1, 5, texto[:ancho].ljust(ancho))
+        return 5 + min(len(etiqueta) + editor.cursor, ancho - 1)
+
+    def registrar():
         global l_cmd_enviado
         global l_disasm_enviado
         """
-        Actualiza la información que se presenta en la pantalla.
+        Agrega a los registros el bloque recibido y los comandos enviados. Se llama una vez por bloque, aunque la
+        pantalla no se dibuje.
         """
-        ventana_pc.addstr(1, 1, "PC: 0x{0:04X}, {0:02d}".format(pc))
-        ventana_pc.addstr(2, 1, "FETCHD: I[0x{0:01X}] O[0x{1:01X}], 0x{2:02X}".format(ejec >> 4, ejec & 0xF, ejec))
-        ventana_pc.addstr(3, 1, "PROGBYTE: I[0x{0:01X}] O[0x{1:01X}], 0x{2:02X}".format(progb >> 4, progb & 0xF, progb))
-        ventana_pc.addstr(4, 1, "FASE: {0:s}".format(val3op(fase, "EJECUTANDO", "OBTENIENDO")))
-
-        ventana_datos.addstr(1, 1, "DATOS: 0x{0:02X}".format(datos))
-        ventana_datos.addstr(2, 1, "BOTONES: 0x{0:02X}".format(boton))
-        ventana_datos.addstr(3, 1, "| LEFT|RIGHT| DOWN|  UP |", A_BOLD | color_pair(3))
-        botones_str = val3opb(boton, 0, "_=_", "___", 4)
-        ventana_datos.addstr(4, 1, "| {0:s} | {1:s} | {2:s} | {3:s} |".
-                             format(botones_str[0],
-                                    botones_str[1],
-                                    botones_str[2],
-                                    botones_str[3]),
-                             A_BOLD | color_pair(4))
-        ventana_datos.addstr(5, 1, "ACCUMULADOR: 0x{0:02X}, {0:02d}".format(accum))
-        ventana_datos.addstr(6, 1, "SALIDA: 0x{0:02X}".format(salida))
-
-        ventana_comandos.addstr(comando + "\n")
-        if disasm_enviado != l_disasm_enviado:
+        if estado.cmd and vista_perfil is None:
+            ventana_comandos.addstr(estado.comando + "\n")
+            lienzo.marcar(ventana_comandos)
+        # Con la copia de la ROM, el desensamblador muestra un listado en lugar del registro
+        if disasm_enviado != l_disasm_enviado and sombra is None:
             ventana_disasm.addstr(disasm_enviado)
+            lienzo.marcar(ventana_disasm)
             l_disasm_enviado = disasm_enviado
-
-        micro0 = val3opb(u0, 0, "ACTIVADO", "DESACTIV", 8)
-        nmicro0 = val3opb(u0, 0, "DESACTIV", "ACTIVADO", 8)
-        ventana_banderas.addstr(3, 1, "{0:s}\t{1:s}\t{2:s}\t{3:s}".format(
-            micro0[0],
-            micro0[1],
-            micro0[2],
-            micro0[3]
-        ), A_BOLD | color_pair(4))
-
-        ventana_banderas.addstr(5, 1, "{0:s}\t{1:s}\t{2:s}\t{3:s}".format(
-            micro0[4],
-            micro0[5],
-            nmicro0[6],
-            nmicro0[7]
-        ), A_BOLD | color_pair(4))
-
-        micro1 = val3opb(u1, 0, "ACTIVADO", "DESACTIV", 8)
-        nmicro1 = val3opb(u1, 0, "DESACTIV", "ACTIVADO", 8)
-
-        ventana_banderas.addstr(8, 1, "{0:s}\t{1:s}\t{2:s}\t{3:s}".format(
-            nmicro1[0],
-            nmicro1[1],
-            nmicro1[2],
-            micro1[3]
-        ), A_BOLD | color_pair(4))
-
-        ventana_banderas.addstr(10, 1, "{0:s}\t{1:s}\t{2:s}\t{3:s}".format(
-            micro1[4],
-            micro1[5],
-            micro1[6],
-            nmicro1[7]
-        ), A_BOLD | color_pair(4))
-        ventana_banderas.addstr(11, 1, "CERO: {0:s},\tACARREO: {1:s},\tFASE: {2:s},\tRESET: {3:s}"
-                                .format(val3op(cero, "Sí", "No"),
-                                        val3op(acarreo, "Sí", "No"),
-                                        val3op(fase, "Sí", "No"),
-                                        val3op(reset, "Sí", "No")), A_BOLD)
-
         if cmd_enviado != l_cmd_enviado:
             ventana_entrada.addstr("{0:s}\n".format(cmd_enviado), A_BOLD)
+            lienzo.marcar(ventana_entrada)
             l_cmd_enviado = cmd_enviado
 
+    def rewrite():
+        """
+        Actualiza la información que se presenta en la pantalla. Solo se escriben los campos que cambiaron desde la
+        última vez.
+        """
+        mostrado = estado if vista is None else EstadoCpu(historial.obtener(vista))
+        con_ondas = analizador is not None and analizador.visible()
+        dibujar_estado(escribir, ventana_pc, ventana_datos, None if con_ondas else ventana_banderas, mostrado, colores)
+        if con_ondas and analizador.dibujar():
+            lienzo.marcar(ventana_banderas)
+        if sombra is not None:
+            dibujar_listado(mostrado)
+        if vista_perfil is not None:
+            dibujar_perfil()
+
     key = KEY_RESIZE
     enviado_arduino = deque([])  # type: deque
     datosio = deque([])
-    datosio.extend(abrir_puerto(puerto, baud, str(modo)))
-    comando = datos = pc = ejec = u0 = u1 = cero = acarreo = fase = reset = boton = progb = accum = salida = 0
+    posicion = -1
+    # Todas las placas se atienden desde este hilo: un solo `select` espera sobre sus puertos y sobre el teclado
+    placas = MultiplexorNibbler()
+    placa = None
+    # El historial de cada placa y el bloque del historial que se muestra, o None para mostrar el estado actual
+    historiales = {}
+    historial = None  # type: HistorialTramas
+    vista = None
+    anchos = [0]
+    # La copia de la ROM de cada placa, que se llena con los bloques que llegan; en una reproducción es la de None
+    imagen = bytearray(open(opciones.rom, "rb").read()) if opciones.rom else None
+    etiquetas = []
+    sombras = {}
+    sombra = None
+    # El perfil de ejecución de cada placa y la vista del perfil que se muestra, o None para mostrar los comandos
+    perfiles = {}
+    perfil = None
+    vista_perfil = None  # type: str
+    if reproductor is None:
+        for archivo in puerto.split(","):
+            conexion = placas.agregar(ConexionNibbler())
+            # Solo se graba la primera placa
+            if opciones.grabar and len(placas) == 1:
+                conexion.grabar(opciones.grabar)
+            # Arduino se reinicia al abrir el puerto: todas las placas se abren a la vez, en segundo plano, y la
+            # interfaz se muestra mientras tanto. Los bloques iniciales se leen como cualquier otro
+            conexion.abrir_en_segundo_plano(archivo, baud, str(modo), opciones.protocolo)
+            historiales[conexion] = HistorialTramas(int(opciones.historia * (1 << 20)))
+            # El perfil que se exporta al salir cuenta desde el primer bloque, aunque no se vea
+            if opciones.perfil:
+                perfil_de(conexion)
+            if placa is None:
+                placa = conexion
+        historial = historiales[placa]
+        perfil = perfiles.get(placa)
+    else:
+        posicion, comandos = reproductor.siguiente_bloque(posicion)
+        enviado_arduino.extend(comandos)
+        if posicion >= 0:
+            datosio.append(reproductor.entrada(posicion)[2])
+    estado = EstadoCpu(bytearray(bits))
     cmd_enviado = "Inicializando..."
     disasm_enviado = ""
+    dibujo_pendiente = True
+    siguiente_estado = 0.0
+    # Las teclas de los comandos que llevan un argumento y abren el editor de la línea
+    teclas_argumento = set(bytearray(b"kKwW" + (b"gG" if reproductor is not None else
+                                                 b"nNuU*bB" + (b"iI" if modo == 1 else b""))))
+    argumento = ""
+    # La ejecución de muchos pasos ('n', 'u' o 'e') en curso, que avanza una parte en cada vuelta
+    corrida = None  # type: Corrida
+    # El número en el historial del bloque donde se detuvo la última corrida, para mostrarlo cuando llegue su final
+    ruptura = None
     while key != ord('q'):
-        if key != -1 or len(datosio) > 0 or len(enviado_arduino) > 0:
+        # La línea de estado del enlace se actualiza una vez por segundo
+        if reproductor is None and reloj_monotonico() >= siguiente_estado:
+            dibujo_pendiente = True
+        if key != -1 or len(datosio) > 0 or len(enviado_arduino) > 0 or dibujo_pendiente:
             if key == KEY_RESIZE:
                 y_principal, x_principal = pantalla.getmaxyx()
                 # Configura los mínimos absolutos y calcula la ventana principal
@@ -167,9 +530,6 @@ def interface(pantalla):
                 ventana_principal.resize(y_principal, x_principal)
                 ventana_principal.clear()
                 ventana_principal.box()
-                ventana_principal.addstr(0, 1, "Depurador de la CPU Nibbler ({0:s})".format(
-                    "MODO PROGRAMA" if modo == 0 else "MODO INSTRUCCIÓN"),
-                                         A_BOLD | color_pair(1))
 
                 # Calcula las dimensiones de las ventanas internas
                 y_principal, x_principal = ventana_principal.getmaxyx()
@@ -201,8 +561,7 @@ def interface(pantalla):
 
                 marco_comandos.resize(y_comando, x_comando)
                 marco_comandos.mvwin(1, x_pc + x_data + 1)
-                marco_comandos.box()
-                marco_comandos.addstr(0, 1, "REGISTRO DE COMANDOS", A_BOLD | color_pair(2))
+                titulo_comandos()
                 ventana_comandos.resize(y_comando - 2, x_comando - 2)
                 ventana_comandos.mvwin(2, x_pc + x_data + 2)
 
@@ -214,17 +573,24 @@ def interface(pantalla):
                 ventana_disasm.resize(y_disasm - 2, x_disasm - 2)
                 ventana_disasm.mvwin(y_comando + 2, x_pc + x_data + 2)
 
+                # Las subventanas del analizador se vuelven a crear con el nuevo tamaño
+                if analizador is not None:
+                    analizador.quitar()
                 ventana_banderas.resize(y_banderas, x_banderas)
                 ventana_banderas.mvwin(y_pc + 1, 1)
                 ventana_banderas.clear()
                 ventana_banderas.box()
-                ventana_banderas.addstr(0, 1, "BANDERAS", A_BOLD | color_pair(2))
-                ventana_banderas.addstr(1, 1, "MICROROM0", A_BOLD)
-                ventana_banderas.addstr(2, 1, "nLOADOUT\tnOEPERAND\tnOEIN\t\tnOEALU")
-                ventana_banderas.addstr(4, 1, "nWERAM\t\tnCSPRAM\t\tS0ALU\t\tS1ALU")
-                ventana_banderas.addstr(6, 1, "MICROROM1", A_BOLD)
-                ventana_banderas.addstr(7, 1, "S2ALU\t\tS3ALU\t\tMALU\t\tnCARRYIN")
-                ventana_banderas.addstr(9, 1, "nLDFLAGS\tnLOADA\t\tnLOADPC\t\tINCPC")
+                if con_analizador:
+                    ventana_banderas.addstr(0, 1, "ANALIZADOR LÓGICO", A_BOLD | color_pair(2))
+                    analizador.ubicar(ventana_banderas, colores[1])
+                else:
+                    ventana_banderas.addstr(0, 1, "BANDERAS", A_BOLD | color_pair(2))
+                    ventana_banderas.addstr(1, 1, "MICROROM0", A_BOLD)
+                    ventana_banderas.addstr(2, 1, "nLOADOUT\tnOEPERAND\tnOEIN\t\tnOEALU")
+                    ventana_banderas.addstr(4, 1, "nWERAM\t\tnCSPRAM\t\tS0ALU\t\tS1ALU")
+                    ventana_banderas.addstr(6, 1, "MICROROM1", A_BOLD)
+                    ventana_banderas.addstr(7, 1, "S2ALU\t\tS3ALU\t\tMALU\t\tnCARRYIN")
+                    ventana_banderas.addstr(9, 1, "nLDFLAGS\tnLOADA\t\tnLOADPC\t\tINCPC")
 
                 marco_entrada.resize(y_entrada, x_entrada)
                 marco_entrada.mvwin(y_banderas + y_pc + 1, 1)
@@ -232,90 +598,395 @@ def interface(pantalla):
                 marco_entrada.addstr(0, 1, "ENTRADA DE COMANDOS", A_BOLD | color_pair(2))
                 ventana_entrada.resize(y_entrada - 2, x_entrada - 2)
                 ventana_entrada.mvwin(y_banderas + y_pc + 2, 2)
-
-            if len(datosio) > 0 or key == KEY_RESIZE:
+                lienzo.invalidar()
+                titulo()
+                dibujo_pendiente = True
+
+            if len(datosio) > 0:
+                if sombra is None and modo == 0:
+                    sombra = sombra_de(placa)
+                # Todos los bloques se decodifican y se registran, pero solo se dibuja el último estado
                 for i in range(len(datosio)):
-                    cmd, comando, datos, pc, ejec, u0, u1, \
-                    cero, acarreo, fase, reset, boton, progb, accum, salida = decodificar_datos(datosio.popleft())
+                    trama = datosio.popleft()
+                    estado = EstadoCpu(trama)
+                    if historial is not None:
+                        historial.agregar(trama)
+                    if sombra is not None:
+                        sombra.observar(trama)
+                    if perfil is not None:
+                        perfil.registrar(trama)
+                    if analizador is not None:
+                        analizador.agregar(trama)
                     for j in range(len(enviado_arduino)):
                         cmd_enviado = enviado_arduino.popleft()
-                        disasm_enviado = disasm(pc, ejec, progb, fase, acarreo, cero)
-                        rewrite()
+                        disasm_enviado = disasm(estado.pc, estado.ejec, estado.progb, estado.fase, estado.acarreo,
+                                                estado.cero)
+                        registrar()
+                    registrar()
+                if vista is not None or ruptura is not None:
+                    # Al llegar bloques nuevos se regresa al estado actual, o al bloque donde se detuvo una corrida
+                    vista = ruptura
+                    ruptura = None
+                    titulo()
+                dibujo_pendiente = True
+
+            if dibujo_pendiente and (lienzo.listo() or key == KEY_RESIZE):
+                try:
                     rewrite()
-            if key == KEY_RESIZE:
-                rewrite()
-
-            try:
-                pantalla.addstr(y_principal + 1, 1, "> ")
-                pantalla.refresh()
-                ventana_principal.refresh()
-                ventana_pc.refresh()
-                ventana_datos.refresh()
-                marco_comandos.refresh()
-                ventana_comandos.refresh()
-                marco_disasm.refresh()
-                ventana_disasm.refresh()
-                ventana_banderas.refresh()
-                marco_entrada.refresh()
-                ventana_entrada.refresh()
-                pantalla.refresh()
-            except:
-                continue
-
-        echo(True)
+                    escribir(ventana_principal, y_principal + 1, 1, "> ")
+                    columna = 3
+                    if editor.activo():
+                        columna = dibujar_editor()
+                    elif reproductor is None and reloj_monotonico() >= siguiente_estado:
+                        linea = placa.linea_estado() if placa.conectada() else estado_conexion(placa)
+                        escribir(ventana_principal, y_principal + 1, 5,
+                                 " {0:s} ".format(linea)[:x_principal - 6].ljust(x_principal - 6))
+                        siguiente_estado = reloj_monotonico() + (1.0 if placa.conectada() else 0.1)
+                    pantalla.move(y_principal + 1, columna)
+                    lienzo.actualizar()
+                except error:
+                    continue
+                dibujo_pendiente = False
+
+        if corrida is not None:
+            bloques = corrida.avanzar()
+            observar_bloques(corrida.conexion, bloques)
+            if bloques and corrida.conexion is placa:
+                datosio.append(bloques[-1])
+            if corrida.terminada():
+                # Si la condición se cumplió antes del último bloque, se muestra ese bloque del historial en cuanto se
+                # registre el último, que es el estado actual
+                if corrida.conexion is placa and 0 <= corrida.indice < len(bloques) - 1:
+                    ruptura = historial.total - (len(bloques) - 1) + corrida.indice
+                # El resumen se registra con el último bloque, si lo hay
+                if bloques:
+                    enviado_arduino.append(corrida.resumen(mostrada=ruptura is not None))
+                else:
+                    mensaje(corrida.resumen(), A_BOLD)
+                    dibujo_pendiente = True
+                corrida = None
 
         key = pantalla.getch()
-        indata = leer_puerto()
-        sleep(0.075)
-        if indata:
-            datosio.append(indata)
+        if key == -1 and len(datosio) == 0 and corrida is None:
+            # Duerme hasta que llegue un bloque, se presione una tecla o se pueda dibujar lo pendiente
+            conectando = any(conexion.conectando() for conexion in placas)
+            placas.esperar([sys.stdin], lienzo.restante() if dibujo_pendiente else
+                           espera_conexion if conectando else espera_maxima)
+            key = pantalla.getch()
+        if reproductor is None:
+            for conexion in placas:
+                if conexion.terminar_apertura():
+                    al_conectar(conexion)
+                    dibujo_pendiente = True
+            if placa.conectada():
+                datosio.extend(placa.leer_tramas())
+            # De las demás placas solo se conserva el último bloque
+            for conexion in placas:
+                if conexion is not placa and conexion.conectada():
+                    conexion.leer_tramas()
+
+        # Los comandos con argumento lo reciben del editor de la línea, tecla por tecla, sin dejar de leer los bloques.
+        # Cuando se presiona Enter, la tecla del comando se atiende como si se acabara de presionar
+        if editor.activo() and key not in (-1, KEY_RESIZE):
+            orden = editor.orden
+            argumento = editor.tecla(key)
+            key = orden if argumento is not None else -1
+            if not editor.activo():
+                escribir(ventana_principal, y_principal + 1, 5, "".ljust(x_principal - 6))
+                siguiente_estado = 0.0
+            dibujo_pendiente = True
+        elif key in teclas_argumento:
+            editor.abrir(key, previa_instruccion if key in (ord('i'), ord('I')) else
+                         previa_condicion if key in (ord('k'), ord('K')) else None)
+            dibujo_pendiente = True
+            key = -1
 
+        # Puntos de ruptura ('k'), de vigilancia ('w') y borrarlos ('x'), en ambos modos
+        if key in (ord('k'), ord('K'), ord('w'), ord('W')):
+            try:
+                punto = puntos.agregar(argumento) if key in (ord('k'), ord('K')) else puntos.vigilar(argumento)
+                mensaje(str(punto), A_BOLD)
+            except ValueError as e:
+                mensaje(e.args[0])
+            dibujo_pendiente = True
+            key = -1
+        elif key == ord('x') or key == ord('X'):
+            puntos.limpiar()
+            mensaje("Puntos de ruptura eliminados", A_BOLD)
+            dibujo_pendiente = True
+            key = -1
+        elif key == ord('a') or key == ord('A'):
+            # Cambia entre las etiquetas de las banderas y el analizador lógico; el cambio rehace la interfaz
+            if analizador is None:
+                analizador = nuevo_analizador()
+            con_analizador = not con_analizador
+            key = KEY_RESIZE
+        elif key == ESCAPE and corrida is not None:
+            # Los pasos que ya estaban en camino se reciben en la siguiente lectura
+            mensaje(corrida.resumen(True), A_BOLD)
+            corrida = None
+            dibujo_pendiente = True
+            key = -1
+        elif reproductor is None and key in teclas_placa and corrida is not None:
+            mensaje("Hay una ejecución en curso; Esc la detiene")
+            dibujo_pendiente = True
+            key = -1
+        elif reproductor is None and key in teclas_placa:
+            # Los comandos para Arduino esperan a que la placa, o todas con '*', termine de abrirse
+            for conexion in (placas if key == ord('*') else [placa]):
+                if not conexion.conectada():
+                    mensaje("{0:s}: {1:s}".format(conexion.archivo, estado_conexion(conexion)))
+                    dibujo_pendiente = True
+                    key = -1
+                    break
+
+        # En una reproducción, las teclas recorren la grabación en lugar de enviar comandos
+        if reproductor is not None:
+            if key in (KEY_RIGHT, KEY_LEFT, ord('.'), ord(',')):
+                siguiente, comandos = reproductor.siguiente_bloque(posicion,
+                                                                   1 if key in (KEY_RIGHT, ord('.')) else -1)
+                enviado_arduino.extend(comandos)
+                key = -1
+            elif key == ord('g') or key == ord('G'):
+                try:
+                    siguiente = reproductor.ciclo(int(argumento))
+                except (ValueError, IndexError):
+                    siguiente = -1
+                    mensaje("Ciclo inválido")
+                    dibujo_pendiente = True
+                key = -1
+            elif (key == ord('e') or key == ord('E')) and puntos:
+                # Busca hacia adelante el siguiente pulso o instrucción que cumpla algún punto de ruptura
+                puntos.reiniciar(reproductor.entrada(posicion)[2] if posicion >= 0 else None)
+                siguiente = -1
+                i = posicion + 1
+                while siguiente < 0 and i < len(reproductor):
+                    numeros, bloques = reproductor.bloques(i, comandos=BLOQUES_FINALES)
+                    encontrado, punto = puntos.buscar(bloques)
+                    if encontrado >= 0:
+                        siguiente = numeros[encontrado]
+                        mensaje(str(punto), A_BOLD)
+                    i += 4096
+                if siguiente < 0:
+                    mensaje("Sin ruptura hasta el final de la grabación")
+                dibujo_pendiente = True
+                key = -1
+            else:
+                siguiente = -1
+            if siguiente >= 0:
+                if siguiente < posicion:
+                    # Las columnas del analizador solo avanzan; al regresar se comienza de nuevo
+                    if analizador is not None:
+                        analizador.limpiar()
+                posicion = siguiente
+                datosio.append(reproductor.entrada(posicion)[2])
         # Teclas que se envían automáticamente
-        if key == ord('r') or key == ord('R'):
-            datosio.extend(escribir_puerto('R'))
+        elif key in (KEY_LEFT, KEY_RIGHT, ord(','), ord('.'), KEY_END):
+            # Recorre el historial de la placa; avanzar desde el último bloque, o Fin, regresa al estado actual
+            if len(historial) > 1 and key != KEY_END:
+                actual = (historial.total - 1 if vista is None else vista) + (-1 if key in (KEY_LEFT, ord(',')) else 1)
+                vista = None if actual >= historial.total - 1 else max(actual, historial.primero)
+            else:
+                vista = None
+            titulo()
+            dibujo_pendiente = True
+            key = -1
+        elif key == ord('r') or key == ord('R'):
+            datosio.extend(placa.escribir('R'))
             enviado_arduino.append("R")
             key = -1
         elif key == ord('o') or key == ord('O'):
-            datosio.extend(escribir_puerto('O'))
+            datosio.extend(placa.escribir('O'))
             enviado_arduino.append("O")
             key = -1
         elif key == ord('c') or key == ord('C'):
-            datosio.extend(escribir_puerto('C'))
+            datosio.extend(placa.escribir('C'))
             enviado_arduino.append("C")
             key = -1
         elif key == ord('p') or key == ord('P'):
-            datosio.extend(escribir_puerto('P'))
+            datosio.extend(placa.escribir('P'))
             enviado_arduino.append("P")
             key = -1
+        elif key in (ord('n'), ord('N'), ord('u'), ord('U')):
+            # 'n' envía N pulsos (o N instrucciones con "N p"); 'u' ejecuta instrucciones hasta que el PC llegue a
+            # una dirección ("DIR [límite]")
+            partes = argumento.split()
+            hasta = key in (ord('u'), ord('U'))
+            try:
+                valor = int(partes[0], 0)
+                limite = int(partes[1], 0) if hasta and len(partes) > 1 else pasos_maximos
+            except (ValueError, IndexError):
+                mensaje("Cantidad inválida")
+                dibujo_pendiente = True
+                key = -1
+                continue
+            paso = "P" if hasta or (len(partes) > 1 and partes[1].upper() == "P") else "C"
+            if hasta:
+                corrida = Corrida(placa, paso, limite, lambda trama: (trama[2] | trama[3] << 8) == valor,
+                                  lambda detenido: "PC=0x{0:03X} {1:s}".format(
+                                      valor, "en el paso {0:d}".format(detenido) if detenido else "no se alcanzó"))
+            else:
+                corrida = Corrida(placa, paso, valor)
+            key = -1
+        elif key == 9 or key == KEY_BTAB:
+            # Tab y Shift+Tab cambian la placa que se muestra
+            if len(placas) > 1:
+                placa = placas[(placas.conexiones.index(placa) + (1 if key == 9 else -1)) % len(placas)]
+                historial = historiales[placa]
+                sombra = sombra_de(placa) if modo == 0 else None
+                perfil = perfil_de(placa) if vista_perfil is not None else perfiles.get(placa)
+                if analizador is not None:
+                    analizador.limpiar()
+                vista = None
+                titulo()
+                mensaje(resumen_placa(placas.conexiones.index(placa) + 1, placa), A_BOLD)
+                if placa.ultima is not None:
+                    estado = EstadoCpu(placa.ultima)
+                dibujo_pendiente = True
+            key = -1
+        elif key == ord('v') or key == ord('V'):
+            # Una fila con el resumen de cada placa
+            for i, conexion in enumerate(placas, 1):
+                mensaje(resumen_placa(i, conexion), A_BOLD)
+            dibujo_pendiente = True
+            key = -1
+        elif key == ord('*'):
+            # Envía un comando a todas las placas: "r", "o", "c [n]", "p [n]" o "b n"
+            partes = argumento.split()
+            try:
+                orden = partes[0].upper()
+                valor = int(partes[1], 0) if len(partes) > 1 else 1
+                if orden not in ("R", "O", "C", "P", "B") or (orden == "B" and len(partes) < 2):
+                    raise ValueError(orden)
+            except (ValueError, IndexError):
+                mensaje("Comando inválido para difundir")
+                dibujo_pendiente = True
+                key = -1
+                continue
+            if orden in ("R", "O"):
+                # En el modo instrucción, el reset termina escribiendo el byte del programa
+                comando, pasos, final = orden, 1, "i" if orden == "R" and modo == 1 else None
+            elif orden == "B":
+                comando, pasos, final = "B " + str(valor), 1, None
+            else:
+                comando, pasos, final = orden, valor, None
+            inicio = reloj_monotonico()
+            resultados = placas.ejecutar_pasos(comando, pasos, ventana=1 if pasos == 1 else 32, final=final)
+            for conexion, (bloques, completados) in zip(placas, resultados):
+                observar_bloques(conexion, bloques)
+            bloques = resultados[placas.conexiones.index(placa)][0]
+            if bloques:
+                datosio.append(bloques[-1])
+            enviado_arduino.append("* {0:s} x{1:d}: {2:s} en {3:.2f} s".format(
+                comando, pasos, "/".join(str(completados) for bloques, completados in resultados),
+                reloj_monotonico() - inicio))
+            key = -1
+        elif key == ord('f') or key == ord('F'):
+            # Recorre las vistas del perfil y regresa al registro de comandos; sin mapa no hay vista por etiquetas
+            if reproductor is not None:
+                mensaje("No hay perfil en una reproducción (ver perfilador.py)")
+            else:
+                from perfilador import VISTAS
+                perfil = perfil_de(placa)
+                vistas = [nombre for nombre in VISTAS if nombre != "etiquetas" or simbolos()] + [None]
+                vista_perfil = vistas[(vistas.index(vista_perfil) + 1) % len(vistas)]
+                ventana_comandos.clear()
+                titulo_comandos()
+                lienzo.invalidar()
+            dibujo_pendiente = True
+            key = -1
+        elif key == ord('s') or key == ord('S'):
+            mensaje(", ".join("{0:s}={1}".format(*campo) for campo in volcar_estadisticas().items()), A_BOLD)
+            dibujo_pendiente = True
+            key = -1
+        elif key == ord('e') or key == ord('E'):
+            # Ejecuta instrucciones hasta que se cumpla algún punto de ruptura
+            if puntos:
+                puntos.reiniciar(estado.empaquetar())
+                # Los puntos se evalúan en cada bloque, también en los flancos del reloj dentro de una instrucción
+                corrida = Corrida(placa, "P", pasos_maximos, puntos.condicion,
+                                  lambda detenido: str(puntos.disparado) if detenido else "sin ruptura", True)
+            else:
+                mensaje("No hay puntos de ruptura")
+                dibujo_pendiente = True
+            key = -1
         elif key == ord('b') or key == ord('B'):
-            pantalla.nodelay(0)
-            val = int(pantalla.getstr())
-            pantalla.nodelay(1)
-            datosio.extend(escribir_puerto("B " + str(val)))
-            enviado_arduino.append("B " + str(val))
+            try:
+                val = int(argumento, 0)
+            except ValueError:
+                mensaje("Valor inválido")
+                dibujo_pendiente = True
+            else:
+                datosio.extend(placa.escribir("B " + str(val)))
+                enviado_arduino.append("B " + str(val))
             key = -1
         elif (key == ord('i') or key == ord('I')) and modo == 1:
-            pantalla.nodelay(0)
-            instr = pantalla.getstr()
-            pantalla.nodelay(1)
+            from ensamblador import ensamblar
             try:
-                asmed, larga = ensamblar(instr)
-            except:
-                ventana_entrada.addstr("Instrucción inválida", A_BOLD | color_pair(4))
-            datosio.extend(escribir_puerto("I " + str(asmed) + " " + str(larga)))
-            enviado_arduino.append("I " + str(asmed) + " " + str(larga))
+                asmed, larga = ensamblar(argumento)
+            except ValueError:
+                mensaje("Instrucción inválida")
+                dibujo_pendiente = True
+            else:
+                datosio.extend(placa.escribir("I " + str(asmed) + " " + str(larga)))
+                enviado_arduino.append("I " + str(asmed) + " " + str(larga))
             key = -1
-
-
-args = sys.argv
-try:
-    puerto = args[1]
-    baud = int(args[2])
-    modo = int(args[3])
-except IndexError:
-    raise IndexError("Se requieren los siguientes argumentos en el siguiente orden:"
-                     "\n\t1. El puerto serial"
-                     "\n\t2. La tasa de baudios"
-                     "\n\t3. Modo de operación")
-
-wrapper(interface)
+    if reproductor is None and opciones.estadisticas:
+        for conexion in placas:
+            volcar_estadisticas(conexion)
+    if reproductor is None and opciones.perfil:
+        nombre, extension = os.path.splitext(opciones.perfil)
+        for i, conexion in enumerate(placas, 1):
+            # Con varias placas, cada perfil va en su propio archivo
+            archivo = opciones.perfil if len(placas) == 1 else "{0:s}-{1:d}{2:s}".format(nombre, i, extension)
+            perfil_de(conexion).exportar(archivo, desensamblar(conexion))
+    placas.cerrar()
+
+
+if __name__ == "__main__":
+    argumentos = argparse.ArgumentParser(description="Depurador para la CPU Nibbler.")
+    argumentos.add_argument("puerto", nargs="?",
+                            help="el puerto serial o host:puerto de servidor.py, o varios separados por comas para "
+                                 "depurar varias placas: Tab cambia de placa, 'v' las resume y '*' envía un comando a "
+                                 "todas")
+    argumentos.add_argument("baud", nargs="?", type=int, help="la tasa de baudios")
+    argumentos.add_argument("modo", nargs="?", type=int, help="modo de operación: 0 programa, 1 instrucción")
+    argumentos.add_argument("--grabar", metavar="ARCHIVO", help="graba la sesión en ARCHIVO")
+    argumentos.add_argument("--reproducir", metavar="ARCHIVO",
+                            help="reproduce una grabación sin puerto serial: flechas o ',' y '.' para moverse, 'g' "
+                                 "para ir a un ciclo")
+    argumentos.add_argument("--cuadros", metavar="N", type=float, default=cuadros_por_segundo,
+                            help="máximo de actualizaciones de la pantalla por segundo, 0 para no limitarlas "
+                                 "(por omisión %(default)s)")
+    argumentos.add_argument("--historia", metavar="MB", type=float, default=32,
+                            help="memoria para el historial de bloques de cada placa, que se recorre con las flechas o "
+                                 "',' y '.' (por omisión %(default)s)")
+    argumentos.add_argument("--estadisticas", metavar="ARCHIVO",
+                            help="agrega a ARCHIVO una instantánea en JSON de la salud del enlace al salir y al "
+                                 "presionar 's'")
+    argumentos.add_argument("--protocolo", type=int, choices=(1, 2), default=VERSION_PROTOCOLO,
+                            help="la versión más alta del protocolo con Arduino (por omisión %(default)s)")
+    argumentos.add_argument("--rom", metavar="ARCHIVO",
+                            help="en el modo programa, la imagen de la ROM (ver ensamblador.py) con la que se precarga "
+                                 "el listado del desensamblador; sin ella, el listado se llena con lo que se observa")
+    argumentos.add_argument("--mapa", metavar="ARCHIVO",
+                            help="el mapa de símbolos de la imagen, para mostrar etiquetas en el listado y sumar el "
+                                 "perfil por etiqueta")
+    argumentos.add_argument("--perfil", metavar="ARCHIVO",
+                            help="escribe al salir el perfil de ejecución en ARCHIVO como CSV; 'f' recorre sus vistas "
+                                 "en el panel de los comandos")
+    opciones = argumentos.parse_args()
+    if opciones.reproducir is None and opciones.modo is None:
+        argumentos.error("Se requieren los siguientes argumentos en el siguiente orden:"
+                         "\n\t1. El puerto serial"
+                         "\n\t2. La tasa de baudios"
+                         "\n\t3. Modo de operación")
+    puerto = opciones.puerto
+    baud = opciones.baud
+    modo = opciones.modo or 0
+    cuadros_por_segundo = opciones.cuadros
+    reproductor = Reproductor(opciones.reproducir) if opciones.reproducir else None
+
+    wrapper(interface)
+    if reproductor is not None:
+        reproductor.cerrar()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+"""
+Editor de la línea de comandos del depurador. A diferencia de `getstr`, no bloquea: recibe una tecla a la vez desde el
+ciclo principal, que sigue leyendo los bloques de Arduino mientras se escribe. Cada comando que lleva un argumento
+tiene su propio historial, que se recorre con las flechas arriba y abajo, y puede mostrar una vista previa de lo que se
+escribe, por ejemplo la instrucción ensamblada.
+"""
+from curses import KEY_BACKSPACE, KEY_DC, KEY_DOWN, KEY_END, KEY_ENTER, KEY_HOME, KEY_LEFT, KEY_RIGHT, KEY_UP
+
+# Las teclas que terminan o cancelan la edición y las que borran
+ENTRADAS = frozenset((10, 13, KEY_ENTER))
+ESCAPE = 27
+RETROCESOS = frozenset((8, 127, KEY_BACKSPACE))
+# Control-A, Control-E y Control-U, como en la terminal
+INICIO_LINEA = 1
+FIN_LINEA = 5
+BORRAR_LINEA = 21
+
+
+class EditorLinea(object):
+    """
+    Una línea de texto que se edita tecla por tecla.
+    :param maximo: cuántas líneas se recuerdan en el historial de cada comando
+    """
+
+    def __init__(self, maximo=100):  # type: (int) -> None
+        self.maximo = maximo
+        self.historiales = {}  # type: dict
+        # La tecla del comando que se edita, o None si no se está editando
+        self.orden = None  # type: int
+        self.texto = ""
+        self.cursor = 0
+        self.vista_previa = None  # type: callable
+        # La línea del historial que se muestra y lo que se había escrito antes de recorrerlo
+        self.posicion = None  # type: int
+        self.borrador = ""
+
+    def activo(self):  # type: () -> bool
+        return self.orden is not None
+
+    def abrir(self, orden, vista_previa=None):  # type: (int, callable) -> None
+        """
+        Comienza a editar el argumento de un comando.
+        :param orden: la tecla del comando; también elige el historial
+        :param vista_previa: una función que recibe el texto y devuelve lo que se muestra junto a él
+        """
+        self.orden = orden
+        self.texto = ""
+        self.cursor = 0
+        self.vista_previa = vista_previa
+        self.posicion = None
+        self.borrador = ""
+
+    def cerrar(self):
+        self.orden = None
+        self.vista_previa = None
+
+    def previa(self):  # type: () -> str
+        if self.vista_previa is None or not self.texto.strip():
+            return ""
+        return self.vista_previa(self.texto)
+
+    def _recorrer(self, historial, paso):  # type: (list, int) -> None
+        if not historial:
+            return
+        if self.posicion is None:
+            if paso > 0:
+                return
+            self.borrador = self.texto
+            posicion = len(historial) - 1
+        else:
+            posicion = self.posicion + paso
+        if posicion < 0:
+            return
+        if posicion >= len(historial):
+            self.posicion = None
+            self.texto = self.borrador
+        else:
+            self.posicion = posicion
+            self.texto = historial[posicion]
+        self.cursor = len(self.texto)
+
+    def tecla(self, key):  # type: (int) -> str
+        """
+        Procesa una tecla de `getch`.
+        :return: el texto cuando se presiona Enter, y None mientras se sigue editando o si se cancela con Escape; en
+        ambos casos la edición termina
+        """
+        historial = self.historiales.setdefault(self.orden, [])
+        if key in ENTRADAS:
+            texto = self.texto
+            if texto.strip() and (not historial or historial[-1] != texto):
+                historial.append(texto)
+                del historial[:-self.maximo]
+            self.cerrar()
+            return texto
+        if key == ESCAPE:
+            self.cerrar()
+        elif key in RETROCESOS:
+            if self.cursor > 0:
+                self.texto = self.texto[:self.cursor - 1] + self.texto[self.cursor:]
+                self.cursor -= 1
+        elif key == KEY_DC:
+            self.texto = self.texto[:self.cursor] + self.texto[self.cursor + 1:]
+        elif key == KEY_LEFT:
+            self.cursor = max(0, self.cursor - 1)
+        elif key == KEY_RIGHT:
+            self.cursor = min(len(self.texto), self.cursor + 1)
+        elif key in (KEY_HOME, INICIO_LINEA):
+            self.cursor = 0
+        elif key in (KEY_END, FIN_LINEA):
+            self.cursor = len(self.texto)
+        elif key == BORRAR_LINEA:
+            self.texto = self.texto[self.cursor:]
+            self.cursor = 0
+        elif key in (KEY_UP, KEY_DOWN):
+            self._recorrer(historial, -1 if key == KEY_UP else 1)
+        elif 32 <= key < 127:
+            self.texto = self.texto[:self.cursor] + chr(key) + self.texto[self.cursor:]
+            self.cursor += 1
+        return None
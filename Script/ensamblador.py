@@ -4,6 +4,40 @@
 """
 Un ensamblador simple para la CPU Nibbler
 """
+import re
+import sys
+
+from ensamblador_reverso import TABLA_INSTRUCCIONES
+
+# Diccionario con las instrucciones, generado a partir de la tabla del ensamblador reverso
+# "INSTR": (INSTR_BIN, USA_DIR, USA_CARRY, USA_CERO)
+instr_dicc = dict((nombre, (codigo, usa_dir, usa_carry, usa_cero))
+                  for codigo, (nombre, usa_dir, usa_carry, usa_cero) in enumerate(TABLA_INSTRUCCIONES))
+
+# Tamaño máximo de la ROM del programa, el PC es de 12 bits
+TAMANO_ROM = 4096
+
+_OPERADORES = re.compile(r"([+-])")
+
+
+def codificar(instruccion, operando):  # type: (str, int) -> bytearray
+    """
+    Codifica una instrucción en los bytes que ocupa en la ROM del programa, en el orden en que la CPU los lee.
+    :param instruccion: el nombre de la instrucción, en mayúsculas
+    :param operando: el operando ya resuelto, un dato inmediato de 4 bits o una dirección de 12 bits
+    :return: uno o dos bytes
+    """
+    if instruccion not in instr_dicc:
+        raise ValueError("La instrucción {0:s} no existe en el diccionario de instrucciones válidas.".format(
+            instruccion), instruccion)
+    instr_bin, usa_dir, usa_carry, usa_cero = instr_dicc[instruccion]
+    if usa_dir:
+        if not 0 <= operando < TAMANO_ROM:
+            raise ValueError("La dirección 0x{0:X} está fuera de la memoria.".format(operando), operando)
+        return bytearray((instr_bin << 4 | operando >> 8, operando & 0xFF))
+    if not -8 <= operando <= 0xF:
+        raise ValueError("El dato inmediato {0:d} no cabe en 4 bits.".format(operando), operando)
+    return bytearray((instr_bin << 4 | operando & 0xF,))
 
 
 def ensamblar(instr):  # type: (str) -> (int, int)
@@ -16,34 +50,175 @@ def ensamblar(instr):  # type: (str) -> (int, int)
     :param instr: la instrucción en texto a ensamblar
     :return: el valor numérico de la instrucción ensamblada
     """
-    instr_dicc = {
-        "JC": (0, 1, 1, 0),
-        "JNC": (1, 1, 1, 0),
-        "COMPI": (2, 0, 0, 0),
-        "COMPM": (3, 1, 0, 0),
-        "LIT": (4, 0, 0, 0),
-        "IN": (5, 0, 0, 0),
-        "LD": (6, 1, 0, 0),
-        "ST": (7, 1, 0, 0),
-        "JZ": (8, 1, 0, 1),
-        "JNZ": (9, 1, 0, 1),
-        "ADDI": (10, 0, 0, 0),
-        "ADDM": (11, 1, 0, 0),
-        "JMP": (12, 1, 0, 0),
-        "OUT": (13, 0, 0, 0),
-        "NORI": (14, 0, 0, 0),
-        "NORM": (15, 1, 0, 0)
-    }
     comando = instr.strip().split()
     if len(comando) != 2:
         raise ValueError("La instrucción que se ingresó no parece ser una instrucción con sintaxis correcta.", instr)
     instruccion = comando[0].upper()
     operando = int(comando[1], 0)
-    if instruccion in instr_dicc:
-        instr_bin, usa_dir, usa_carry, usa_cero = instr_dicc[instruccion]
-        if usa_dir:
-            return (instr_bin << 4 | (operando >> 8 & 0xF) | ((operando << 8) & 0xFF00)), usa_dir
-        else:
-            return ((instr_bin << 4 | (operando & 0xF)) & 0xFF), usa_dir
+    codigo = codificar(instruccion, operando)
+    if len(codigo) == 2:
+        return codigo[0] | codigo[1] << 8, 1
     else:
-        raise ValueError("La instrucción {0:s} no existe en el diccionario de instrucciones válidas.", instruccion)
+        return codigo[0], 0
+
+
+def _valor(texto, simbolos):  # type: (str, dict) -> int
+    """
+    Evalúa un operando: números, símbolos y sumas o restas entre ellos, por ejemplo `tabla+2`.
+    """
+    total = 0
+    signo = 1
+    vacio = True
+    for parte in _OPERADORES.split(texto.replace(" ", "").replace("\t", "")):
+        if parte == "+":
+            signo = 1
+        elif parte == "-":
+            signo = -signo
+        elif parte:
+            if parte[0].isdigit():
+                valor = int(parte, 0)
+            elif parte in simbolos:
+                valor = simbolos[parte]
+            else:
+                raise ValueError("El símbolo {0:s} no está definido.".format(parte), parte)
+            total += signo * valor
+            signo = 1
+            vacio = False
+    if vacio:
+        raise ValueError("Se esperaba un operando.", texto)
+    return total
+
+
+def ensamblar_programa(texto, relleno=0):  # type: (str, int) -> (bytearray, list)
+    """
+    Ensambla un programa completo en dos pasadas. La primera asigna una dirección a cada etiqueta y constante, y la
+    segunda resuelve los operandos y escribe la ROM. La sintaxis es:
+        etiqueta:               define una etiqueta con la dirección actual
+        NOMBRE = valor          define una constante (también `.equ NOMBRE, valor`)
+        .org dirección          cambia la dirección actual
+        .db valor, valor, ...   escribe bytes tal cual
+        INSTR operando          una instrucción; `IN` y `OUT` no requieren operando
+    Todo lo que sigue a `;` es un comentario. Los operandos pueden sumar o restar números y símbolos.
+    :param texto: el código fuente del programa
+    :param relleno: el valor de los bytes de la ROM que el programa no usa
+    :return: la imagen de la ROM, con el orden de bytes de la CPU, y una lista ordenada de (dirección, etiqueta)
+    """
+    simbolos = {}  # type: dict
+    etiquetas = []  # type: list
+    pendientes = []  # type: list
+    addr = 0
+    fin = 0
+
+    def definir(nombre, valor, numero):
+        if not nombre or not (nombre[0].isalpha() or nombre[0] == "_") or nombre.upper() in instr_dicc:
+            raise ValueError("Línea {0:d}: el nombre {1:s} no es válido.".format(numero, nombre), nombre)
+        if nombre in simbolos:
+            raise ValueError("Línea {0:d}: el símbolo {1:s} ya está definido.".format(numero, nombre), nombre)
+        simbolos[nombre] = valor
+
+    # Primera pasada: direcciones de las etiquetas y constantes
+    for numero, linea in enumerate(texto.splitlines(), 1):
+        linea = linea.split(";", 1)[0].strip()
+        try:
+            while ":" in linea:
+                etiqueta, linea = linea.split(":", 1)
+                etiqueta = etiqueta.strip()
+                definir(etiqueta, addr, numero)
+                etiquetas.append((addr, etiqueta))
+                linea = linea.strip()
+            if not linea:
+                continue
+            partes = linea.split(None, 1)
+            directiva = partes[0].lower()
+            argumento = partes[1] if len(partes) > 1 else ""
+            if "=" in linea and directiva != ".db":
+                nombre, valor = linea.split("=", 1)
+                definir(nombre.strip(), _valor(valor, simbolos), numero)
+            elif directiva == ".equ":
+                nombre, valor = argumento.split(",", 1)
+                definir(nombre.strip(), _valor(valor, simbolos), numero)
+            elif directiva == ".org":
+                addr = _valor(argumento, simbolos)
+            elif directiva == ".db":
+                valores = argumento.split(",")
+                pendientes.append((numero, addr, None, valores))
+                addr += len(valores)
+            else:
+                instruccion = partes[0].upper()
+                if instruccion not in instr_dicc:
+                    raise ValueError("La instrucción {0:s} no existe en el diccionario de instrucciones "
+                                     "válidas.".format(partes[0]), partes[0])
+                pendientes.append((numero, addr, instruccion, argumento))
+                addr += 1 + instr_dicc[instruccion][1]
+        except ValueError as e:
+            if e.args and str(e.args[0]).startswith("Línea"):
+                raise
+            raise ValueError("Línea {0:d}: {1:s}".format(numero, e.args[0] if e.args else str(e)), linea)
+        if not 0 <= addr <= TAMANO_ROM:
+            raise ValueError("Línea {0:d}: el programa no cabe en la ROM.".format(numero), addr)
+        fin = max(fin, addr)
+
+    # Segunda pasada: escribir la ROM con todos los símbolos conocidos
+    rom = bytearray([relleno & 0xFF]) * fin
+    usado = bytearray(fin)
+    for numero, addr, instruccion, argumento in pendientes:
+        try:
+            if instruccion is None:
+                codigo = bytearray()
+                for valor in argumento:
+                    valor = _valor(valor, simbolos)
+                    if not -0x80 <= valor <= 0xFF:
+                        raise ValueError("El valor {0:d} no cabe en un byte.".format(valor), valor)
+                    codigo.append(valor & 0xFF)
+            else:
+                operando = _valor(argumento, simbolos) if argumento or instruccion not in ("IN", "OUT") else 0
+                codigo = codificar(instruccion, operando)
+        except ValueError as e:
+            raise ValueError("Línea {0:d}: {1:s}".format(numero, e.args[0] if e.args else str(e)), argumento)
+        if any(usado[addr:addr + len(codigo)]):
+            raise ValueError("Línea {0:d}: la dirección 0x{1:03X} ya está ocupada.".format(numero, addr), addr)
+        rom[addr:addr + len(codigo)] = codigo
+        usado[addr:addr + len(codigo)] = b"\x01" * len(codigo)
+    etiquetas.sort()
+    return rom, etiquetas
+
+
+def escribir_mapa(etiquetas, archivo):  # type: (list, str) -> None
+    """
+    Escribe la tabla de símbolos en un archivo de texto, una línea `0xDIR etiqueta` por símbolo.
+    """
+    with open(archivo, "w") as mapa:
+        for addr, etiqueta in etiquetas:
+            mapa.write("0x{0:03X} {1:s}\n".format(addr, etiqueta))
+
+
+def leer_mapa(archivo):  # type: (str) -> list
+    """
+    Lee una tabla de símbolos escrita por `escribir_mapa`.
+    :return: una lista ordenada de (dirección, etiqueta)
+    """
+    etiquetas = []
+    with open(archivo) as mapa:
+        for linea in mapa:
+            partes = linea.split()
+            if len(partes) == 2:
+                etiquetas.append((int(partes[0], 0), partes[1]))
+    etiquetas.sort()
+    return etiquetas
+
+
+if __name__ == "__main__":
+    try:
+        fuente = sys.argv[1]
+        destino = sys.argv[2]
+    except IndexError:
+        raise IndexError("Se requieren los siguientes argumentos en el siguiente orden:"
+                         "\n\t1. El archivo del programa"
+                         "\n\t2. El archivo de la imagen de la ROM"
+                         "\n\t3. El archivo del mapa de símbolos (opcional)")
+    with open(fuente) as f:
+        imagen, tabla = ensamblar_programa(f.read())
+    with open(destino, "wb") as f:
+        f.write(imagen)
+    if len(sys.argv) > 3:
+        escribir_mapa(tabla, sys.argv[3])
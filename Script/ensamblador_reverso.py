@@ -1,6 +1,85 @@
 #!/usr/bin/env python2
 # -*- coding: utf-8 -*-
 import array
+import struct
+import sys
+from collections import OrderedDict
+
+
+# Formato de los primeros 12 bytes de un bloque: comando, datos, PC (2 bytes, LSBF), ejec, u0, u1, banderas (cero,
+# acarreo, fase y reset), botón, progbyte, acumulador y salida. Los últimos 2 bytes del bloque son la cabecera.
+FORMATO_BLOQUE = struct.Struct("<BBHBBBBBBBB")
+BYTES_BLOQUE = 14
+
+# Nombre de cada comando que envía Arduino, indexado por el primer byte del bloque
+NOMBRES_COMANDOS = ["Comando desconocido!"] * 256  # type: list
+NOMBRES_COMANDOS[ord('o')] = "OBTENER"
+NOMBRES_COMANDOS[ord('C')] = "PULSO"
+NOMBRES_COMANDOS[ord('c')] = "pulso"
+NOMBRES_COMANDOS[ord('P')] = "PROPAGAR"
+NOMBRES_COMANDOS[ord('p')] = "propagar"
+NOMBRES_COMANDOS[ord('a')] = "AJUSTE_FASE"
+NOMBRES_COMANDOS[ord('n')] = "AJUSTE_EJEC"
+NOMBRES_COMANDOS[ord('B')] = "BOTON"
+NOMBRES_COMANDOS[ord('b')] = "boton"
+NOMBRES_COMANDOS[ord('R')] = "RESET"
+NOMBRES_COMANDOS[ord('r')] = "reset"
+NOMBRES_COMANDOS[ord('I')] = "INSTRUCCION"
+NOMBRES_COMANDOS[ord('i')] = "instruccion"
+
+# Las señales de MICROROM0 (u0) y MICROROM1 (u1) que se activan con 0, del bit 0 al 7
+ACTIVAS_EN_BAJO0 = 0x3F
+ACTIVAS_EN_BAJO1 = 0x78
+
+
+class EstadoCpu(object):
+    """
+    El estado de la CPU Nibbler contenido en un bloque enviado por Arduino. Todos los campos se obtienen con un solo
+    `struct.unpack` y el objeto no tiene `__dict__`, de modo que es barato crearlo por cada bloque.
+    """
+    __slots__ = ("cmd", "datos", "pc", "ejec", "u0", "u1", "banderas", "boton", "progb", "acc", "out")
+
+    def __init__(self, arr):  # type: (bytearray) -> None
+        if not isinstance(arr, (bytearray, bytes)):
+            arr = bytearray(arr[:BYTES_BLOQUE - 2])
+        (self.cmd, self.datos, self.pc, self.ejec, self.u0, self.u1, self.banderas, self.boton, self.progb, self.acc,
+         self.out) = FORMATO_BLOQUE.unpack_from(arr)
+
+    @property
+    def cero(self):  # type: () -> bool
+        return self.banderas & 1 == 1
+
+    @property
+    def acarreo(self):  # type: () -> bool
+        return self.banderas >> 1 & 1 == 1
+
+    @property
+    def fase(self):  # type: () -> bool
+        return self.banderas >> 2 & 1 == 1
+
+    @property
+    def reset(self):  # type: () -> bool
+        return self.banderas >> 3 & 1 == 1
+
+    @property
+    def comando(self):  # type: () -> str
+        """
+        El comando en palabras
+        """
+        if self.cmd == ord('B'):
+            return "BOTON " + str(self.boton)
+        elif self.cmd == ord('i'):
+            return "instruccion " + disasm(self.pc, self.ejec, self.progb, self.fase, self.acarreo, self.cero)
+        return NOMBRES_COMANDOS[self.cmd]
+
+    def empaquetar(self):  # type: () -> bytearray
+        """
+        Vuelve a construir el bloque, con el mismo formato que entrega `receptor`.
+        """
+        arr = bytearray(FORMATO_BLOQUE.pack(self.cmd, self.datos, self.pc, self.ejec, self.u0, self.u1, self.banderas,
+                                            self.boton, self.progb, self.acc, self.out))
+        arr += b"\n\r"
+        return arr
 
 
 def decodificar_datos(arr):  # type: (array) -> (int, int, int, int, int, bool, bool, bool, bool, int, int, int, int)
@@ -9,62 +88,61 @@ def decodificar_datos(arr):  # type: (array) -> (int, int, int, int, int, bool,
     :return: comando, datos, pc, ejec, u0, u1, cero, acarreo, fase, reset, boton, progb, acc, out
     :param arr: array a decodificar
     """
-    # El primer byte es el comando
-    comando = arr[0]  # type: int
-    # El segundo byte es el bus de datos
-    datos = arr[1]  # type: int
-    # El tercer byte es el primer byte de PC y el cuarto es el segundo byte de PC
-    pc = arr[2] | arr[3] << 8  # type: int
-    # El quinto byte es la instruccion en ejecución
-    ejec = arr[4]  # type: int
-    # El sexto byte son las banderas de la MICRO0
-    u0 = arr[5]  # type: int
-    # El séptimo byte son las banderas de la MICROq
-    u1 = arr[6]  # type: int
-    # El octavo byte cotiene carry, zero, phase y reset
-    cero = arr[7] >> 0 & 1 == 1  # type: bool
-    acarreo = arr[7] >> 1 & 1 == 1  # type: bool
-    fase = arr[7] >> 2 & 1 == 1  # type: bool
-    reset = arr[7] >> 3 & 1 == 1  # type: bool
-    # El noveno byte contiene el estado actual de los botones
-    boton = arr[8]  # type: int
-    # por último, el décimo byte contiene el PROGRAMBYTE
-    progb = arr[9]  # type: int
-    # leer ACUMULADOR
-    acc = arr[10]  # type: int
-    # leer OUT
-    out = arr[11]  # type: int
-
-    # Determina el comando en palabras
-    if comando == ord('o'):
-        comando = "OBTENER"
-    elif comando == ord('C'):
-        comando = "PULSO"
-    elif comando == ord('c'):
-        comando = "pulso"
-    elif comando == ord('P'):
-        comando = "PROPAGAR"
-    elif comando == ord('p'):
-        comando = "propagar"
-    elif comando == ord('a'):
-        comando = "AJUSTE_FASE"
-    elif comando == ord('n'):
-        comando = "AJUSTE_EJEC"
-    elif comando == ord('B'):
-        comando = "BOTON " + str(boton)
-    elif comando == ord('b'):
-        comando = "boton"
-    elif comando == ord('R'):
-        comando = "RESET"
-    elif comando == ord('r'):
-        comando = "reset"
-    elif comando == ord('I'):
-        comando = "INSTRUCCION"
-    elif comando == ord('i'):
-        comando = "instruccion " + disasm(pc, ejec, progb, fase, acarreo, cero)
-    else:
-        comando = "Comando desconocido!"
-    return arr[0], comando, datos, pc, ejec, u0, u1, cero, acarreo, fase, reset, boton, progb, acc, out
+    e = EstadoCpu(arr)
+    return e.cmd, e.comando, e.datos, e.pc, e.ejec, e.u0, e.u1, e.cero, e.acarreo, e.fase, e.reset, e.boton, e.progb, \
+        e.acc, e.out
+
+
+# Columnas que produce `decodificar_lote`, con su posición en el bloque y el tipo de `array`
+COLUMNAS_LOTE = (
+    ("cmd", 0, "B"),
+    ("datos", 1, "B"),
+    ("pc", 2, "H"),
+    ("ejec", 4, "B"),
+    ("u0", 5, "B"),
+    ("u1", 6, "B"),
+    ("banderas", 7, "B"),
+    ("boton", 8, "B"),
+    ("progb", 9, "B"),
+    ("acc", 10, "B"),
+    ("out", 11, "B"),
+)
+
+
+def decodificar_lote(bloques, como_numpy=False):  # type: (bytearray, bool) -> dict
+    """
+    Decodifica de una sola vez muchos bloques consecutivos, para análisis de sesiones largas. Cada columna se obtiene
+    con un corte con paso sobre el buffer, sin crear objetos de Python por cada bloque.
+    :param bloques: los bloques concatenados (o una lista de bloques), cada uno con el formato que entrega `receptor`
+    :param como_numpy: si es verdadero, devuelve un arreglo estructurado de NumPy que comparte la memoria de `bloques`
+    :return: un diccionario con una `array` por cada columna de `COLUMNAS_LOTE`, o el arreglo de NumPy
+    """
+    if not isinstance(bloques, (bytearray, bytes)):
+        bloques = bytearray().join(bloques)
+    if len(bloques) % BYTES_BLOQUE:
+        raise ValueError("El buffer no contiene una cantidad entera de bloques.", len(bloques))
+    if como_numpy:
+        import numpy
+        tipo = numpy.dtype([(nombre, "<u2" if tipo == "H" else "u1") for nombre, _, tipo in COLUMNAS_LOTE] +
+                           [("cabecera", "V2")])
+        return numpy.frombuffer(bloques, dtype=tipo)
+    columnas = {}
+    for nombre, posicion, tipo in COLUMNAS_LOTE:
+        if tipo == "B":
+            columnas[nombre] = array.array("B", bloques[posicion::BYTES_BLOQUE])
+        else:
+            palabras = bytearray(len(bloques) // BYTES_BLOQUE * 2)
+            palabras[0::2] = bloques[posicion::BYTES_BLOQUE]
+            palabras[1::2] = bloques[posicion + 1::BYTES_BLOQUE]
+            columna = array.array("H")
+            if hasattr(columna, "frombytes"):
+                columna.frombytes(bytes(palabras))
+            else:
+                columna.fromstring(bytes(palabras))
+            if sys.byteorder != "little":
+                columna.byteswap()
+            columnas[nombre] = columna
+    return columnas
 
 
 # JC: DIR
@@ -84,6 +162,87 @@ def decodificar_datos(arr):  # type: (array) -> (int, int, int, int, int, bool,
 # NORI: INM
 # NORM: DIR
 
+# Tabla con las instrucciones, indexada por el código de operación (los 4 bits más significativos del fetch)
+# ("INSTR", USA_DIR, USA_CARRY, USA_CERO)
+TABLA_INSTRUCCIONES = (
+    ("JC", 1, 1, 0),
+    ("JNC", 1, 1, 0),
+    ("COMPI", 0, 0, 0),
+    ("COMPM", 1, 0, 0),
+    ("LIT", 0, 0, 0),
+    ("IN", 0, 0, 0),
+    ("LD", 1, 0, 0),
+    ("ST", 1, 0, 0),
+    ("JZ", 1, 0, 1),
+    ("JNZ", 1, 0, 1),
+    ("ADDI", 0, 0, 0),
+    ("ADDM", 1, 0, 0),
+    ("JMP", 1, 0, 0),
+    ("OUT", 0, 0, 0),
+    ("NORI", 0, 0, 0),
+    ("NORM", 1, 0, 0)
+)
+
+# Texto de cada byte de instrucción: completo para las instrucciones cortas, y solo el nombre para las largas (el
+# operando depende del siguiente byte del programa)
+TEXTO_INSTRUCCIONES = tuple(
+    "{0:s}\t0x{1:01X}\t".format(TABLA_INSTRUCCIONES[i >> 4][0], i & 0xF) if not TABLA_INSTRUCCIONES[i >> 4][1]
+    else TABLA_INSTRUCCIONES[i >> 4][0] + "\t" for i in range(256))  # type: tuple
+
+# Longitud en bytes de cada byte de instrucción
+LONGITUD_INSTRUCCIONES = bytearray(1 + TABLA_INSTRUCCIONES[i >> 4][1] for i in range(256))  # type: bytearray
+
+# Texto del operando de las instrucciones largas, indexado por la dirección de 12 bits
+TEXTO_DIRECCIONES = tuple("0x{0:04X}\t".format(i) for i in range(4096))  # type: tuple
+
+try:
+    from functools import lru_cache
+except ImportError:
+    def lru_cache(maxsize=128):
+        """
+        Sustituto de `functools.lru_cache` para Python 2, solo para funciones con argumentos posicionales.
+        """
+
+        def decorador(funcion):
+            cache = OrderedDict()
+
+            def envoltura(*args):
+                try:
+                    valor = cache.pop(args)
+                except KeyError:
+                    valor = funcion(*args)
+                    if len(cache) >= maxsize:
+                        cache.popitem(last=False)
+                cache[args] = valor
+                return valor
+
+            return envoltura
+
+        return decorador
+
+
+@lru_cache(maxsize=4096)
+def formatear_instruccion(fetch, progb, banderas):  # type: (int, int, int) -> str
+    """
+    Da formato a una instrucción, sin la dirección. Los argumentos que no afectan el resultado deben normalizarse antes
+    de llamar esta función (ver `disasm`), para que el cache no se llene con valores repetidos.
+    :param fetch: el byte de la instrucción
+    :param progb: el byte que le sigue en el programa, solo se usa en las instrucciones largas
+    :param banderas: el acarreo en el bit 0 y el cero en el bit 1, o -1 para no mostrar las banderas
+    :return: el texto de la instrucción
+    """
+    instr_asm, usa_dir, usa_carry, usa_cero = TABLA_INSTRUCCIONES[fetch >> 4]
+    retorno = TEXTO_INSTRUCCIONES[fetch]
+    if usa_dir:
+        retorno += TEXTO_DIRECCIONES[(fetch & 0xF) << 8 | progb]
+    if banderas >= 0:
+        if usa_carry:
+            retorno += "[C: {0:s}]".format("Sí" if banderas & 1 else "No")
+        if usa_cero:
+            retorno += "[Z: {0:s}]".format("Sí" if banderas & 2 else "No")
+    return retorno
+
+
 def disasm(addr, fetch, progb, fase, carry, cero):
     """
     Desensamblador rápido para el juego de instrucciones de la CPU Nibbler. Este desensamblador requiere conocer:
@@ -105,38 +264,36 @@ def disasm(addr, fetch, progb, fase, carry, cero):
     # Si la fase es 0, retornar
     if fase != 0:
         return ""
-    # Diccionario con las instrucciones
-    # ("INSTR", INMD, CARRY, CERO)
-    instr_dicc = {
-        0: ("JC", 1, 1, 0),
-        1: ("JNC", 1, 1, 0),
-        2: ("COMPI", 0, 0, 0),
-        3: ("COMPM", 1, 0, 0),
-        4: ("LIT", 0, 0, 0),
-        5: ("IN", 0, 0, 0),
-        6: ("LD", 1, 0, 0),
-        7: ("ST", 1, 0, 0),
-        8: ("JZ", 1, 0, 1),
-        9: ("JNZ", 1, 0, 1),
-        10: ("ADDI", 0, 0, 0),
-        11: ("ADDM", 1, 0, 0),
-        12: ("JMP", 1, 0, 0),
-        13: ("OUT", 0, 0, 0),
-        14: ("NORI", 0, 0, 0),
-        15: ("NORM", 1, 0, 0)
-    }
-    # Extraer la instrucción desde Fetch
-    instr_bin, opernd = (fetch >> 4, fetch & 0xF)
-    # Obtener la instruccion desde el dicc.
-    instr_asm, usa_dir, usa_carry, usa_cero = instr_dicc[instr_bin]
-    retorno = "0x{0:04X}:\t{1:s}\t".format(addr, instr_asm)
-    if usa_dir == 0:
-        retorno += "0x{0:01X}\t".format(opernd)
-    elif usa_dir == 1:
-        retorno += "0x{0:04X}\t".format(opernd << 8 | progb)
-    if usa_carry == 1:
-        retorno += "[C: {0:s}]".format("Sí" if carry else "No")
-    if usa_cero:
-        retorno += "[Z: {0:s}]".format("Sí" if carry else "No")
-    retorno += '\n'
-    return retorno
+    instr_asm, usa_dir, usa_carry, usa_cero = TABLA_INSTRUCCIONES[fetch >> 4]
+    # Solo las banderas que la instrucción usa y el progbyte de las instrucciones largas forman parte de la llave
+    banderas = (1 if usa_carry and carry else 0) | (2 if usa_cero and cero else 0)
+    return "0x{0:04X}:\t{1:s}\n".format(addr, formatear_instruccion(fetch, progb if usa_dir else 0, banderas))
+
+
+def disasm_rom(imagen, inicio=0):  # type: (bytearray, int) -> OrderedDict
+    """
+    Desensambla una imagen completa de la ROM del programa (hasta 4K bytes), recorriéndola de forma lineal desde
+    `inicio`. Las instrucciones largas ocupan dos bytes, así que solo las direcciones donde comienza una instrucción
+    aparecen en el índice.
+    :param imagen: los bytes de la ROM del programa
+    :param inicio: la dirección donde comienza el recorrido
+    :return: un diccionario ordenado por dirección, con el texto de la instrucción en cada dirección
+    """
+    imagen = bytearray(imagen)
+    indice = OrderedDict()
+    texto = TEXTO_INSTRUCCIONES
+    direcciones = TEXTO_DIRECCIONES
+    longitud = LONGITUD_INSTRUCCIONES
+    fin = len(imagen)
+    addr = inicio
+    while addr < fin:
+        fetch = imagen[addr]
+        if longitud[fetch] == 1:
+            indice[addr] = texto[fetch]
+            addr += 1
+        else:
+            # Solo las instrucciones largas necesitan unir el operando, que depende del siguiente byte
+            progb = imagen[addr + 1] if addr + 1 < fin else 0
+            indice[addr] = texto[fetch] + direcciones[(fetch & 0xF) << 8 | progb]
+            addr += 2
+    return indice
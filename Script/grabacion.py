@@ -0,0 +1,191 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+"""
+Grabación y reproducción de sesiones del depurador. Cada bloque recibido y cada comando enviado se guarda como una
+entrada de tamaño fijo con una marca de tiempo monotónica, de modo que una grabación se puede abrir con `mmap` y
+recorrer sin convertirla completa a objetos de Python.
+
+Formato del archivo:
+    cabecera: "NBTR", versión (2 bytes) y tamaño de entrada (2 bytes)
+    entradas: tiempo (double), tipo (1 byte), longitud (1 byte), carga (14 bytes)
+
+Junto a la grabación se escribe un índice (`archivo.idx`) con el número de entrada de cada pulso de reloj, para buscar
+por ciclo.
+"""
+import array
+import mmap
+import os
+import struct
+import threading
+import time
+
+MAGIA = b"NBTR"
+VERSION = 1
+CABECERA = struct.Struct("<4sHH")
+ENTRADA = struct.Struct("<dBB14s")
+INDICE = struct.Struct("<I")
+CARGA_MAXIMA = 14
+
+# Tipos de entrada
+BLOQUE = 0
+COMANDO = 1
+
+# Los bloques que Arduino envía justo después de un flanco de reloj (ver `pulso` y `propagar` en NibblerArduino.ino)
+BLOQUES_RELOJ = frozenset(bytearray(b"can"))
+# Los mismos, como una tabla indexada por el comando, para consultarla en cada bloque sin calcular un hash
+FLANCOS = bytearray(256)
+for _comando in BLOQUES_RELOJ:
+    FLANCOS[_comando] = 1
+# Los bloques con los que termina un pulso (`C`) o una instrucción (`P`)
+BLOQUES_FINALES = frozenset(bytearray(b"cp"))
+
+reloj_monotonico = getattr(time, "monotonic", time.time)
+
+
+class Grabadora(object):
+    """
+    Agrega entradas a una grabación. Se puede usar desde el hilo lector y desde el hilo principal a la vez.
+    """
+
+    def __init__(self, archivo):  # type: (str) -> None
+        self.archivo = open(archivo, "wb")
+        self.indice = open(archivo + ".idx", "wb")
+        self.archivo.write(CABECERA.pack(MAGIA, VERSION, ENTRADA.size))
+        self.entradas = 0
+        self.candado = threading.Lock()
+
+    def _agregar(self, tipo, carga):  # type: (int, bytes) -> None
+        entrada = ENTRADA.pack(reloj_monotonico(), tipo, len(carga), bytes(carga))
+        with self.candado:
+            if self.archivo.closed:
+                return
+            self.archivo.write(entrada)
+            if tipo == BLOQUE and carga[0] in BLOQUES_RELOJ:
+                self.indice.write(INDICE.pack(self.entradas))
+            self.entradas += 1
+
+    def bloques(self, tramas):  # type: (list) -> None
+        """
+        Graba los bloques recibidos, con el formato que entrega `receptor`.
+        """
+        for trama in tramas:
+            self._agregar(BLOQUE, trama)
+
+    def comando(self, comando):  # type: (str) -> None
+        """
+        Graba un comando enviado a Arduino. Los comandos de más de 14 bytes se recortan.
+        """
+        carga = bytearray(comando if isinstance(comando, bytes) else comando.encode())[:CARGA_MAXIMA]
+        self._agregar(COMANDO, carga)
+
+    def cerrar(self):
+        with self.candado:
+            self.archivo.close()
+            self.indice.close()
+
+
+class Reproductor(object):
+    """
+    Acceso aleatorio a una grabación mediante `mmap`. Abrir una grabación no lee las entradas; cada una se decodifica
+    solo cuando se pide.
+    """
+
+    def __init__(self, archivo):  # type: (str) -> None
+        self.nombre = archivo
+        self.archivo = open(archivo, "rb")
+        tamano = os.fstat(self.archivo.fileno()).st_size
+        if tamano < CABECERA.size:
+            raise IOError("El archivo {0:s} no es una grabación del depurador.".format(archivo))
+        self.mapa = mmap.mmap(self.archivo.fileno(), 0, access=mmap.ACCESS_READ)
+        magia, version, tamano_entrada = CABECERA.unpack_from(self.mapa)
+        if magia != MAGIA or version != VERSION or tamano_entrada != ENTRADA.size:
+            raise IOError("El archivo {0:s} no es una grabación del depurador.".format(archivo))
+        self.entradas = (tamano - CABECERA.size) // ENTRADA.size
+        self.indice = None  # type: mmap.mmap
+        self.ciclos = 0
+
+    def __len__(self):
+        return self.entradas
+
+    def entrada(self, i):  # type: (int) -> (float, int, bytearray)
+        """
+        :return: el tiempo, el tipo y la carga de la entrada `i`
+        """
+        if not 0 <= i < self.entradas:
+            raise IndexError(i)
+        tiempo, tipo, longitud, carga = ENTRADA.unpack_from(self.mapa, CABECERA.size + i * ENTRADA.size)
+        return tiempo, tipo, bytearray(carga[:longitud])
+
+    def _abrir_indice(self):
+        """
+        Abre el índice de ciclos; si no existe, lo construye recorriendo la grabación una sola vez.
+        """
+        nombre = self.nombre + ".idx"
+        if not os.path.exists(nombre):
+            self._construir_indice(nombre)
+        indice = open(nombre, "rb")
+        self.ciclos = os.fstat(indice.fileno()).st_size // INDICE.size
+        if self.ciclos:
+            self.indice = mmap.mmap(indice.fileno(), 0, access=mmap.ACCESS_READ)
+        indice.close()
+
+    def _construir_indice(self, nombre):
+        posiciones = array.array("I")
+        for i in range(self.entradas):
+            tiempo, tipo, carga = self.entrada(i)
+            if tipo == BLOQUE and carga and carga[0] in BLOQUES_RELOJ:
+                posiciones.append(i)
+        with open(nombre, "wb") as indice:
+            indice.write(posiciones.tobytes() if hasattr(posiciones, "tobytes") else posiciones.tostring())
+
+    def ciclo(self, n):  # type: (int) -> int
+        """
+        Busca el pulso de reloj número `n` (contando desde 0) en el índice.
+        :return: el número de la entrada del bloque enviado justo después del pulso
+        """
+        self.total_ciclos()
+        if not 0 <= n < self.ciclos:
+            raise IndexError(n)
+        return INDICE.unpack_from(self.indice, n * INDICE.size)[0]
+
+    def total_ciclos(self):  # type: () -> int
+        if self.indice is None and not self.ciclos:
+            self._abrir_indice()
+        return self.ciclos
+
+    def siguiente_bloque(self, i, paso=1):  # type: (int, int) -> (int, list)
+        """
+        Avanza (o retrocede, si `paso` es -1) desde la entrada `i` hasta el siguiente bloque.
+        :return: el número de la entrada del bloque, o -1 si no hay más, y los comandos encontrados en el camino
+        """
+        comandos = []
+        i += paso
+        while 0 <= i < self.entradas:
+            tiempo, tipo, carga = self.entrada(i)
+            if tipo == BLOQUE:
+                return i, comandos
+            comandos.append(carga.decode())
+            i += paso
+        return -1, comandos
+
+    def bloques(self, i, cantidad=4096, comandos=None):  # type: (int, int, frozenset) -> (list, list)
+        """
+        Lee de una sola vez los bloques que hay entre las entradas `i` e `i + cantidad`, sin los comandos.
+        :param comandos: si se indica, solo los bloques cuyo primer byte está en el conjunto
+        :return: los números de las entradas y los bloques
+        """
+        numeros = []
+        bloques = []
+        for j in range(max(i, 0), min(i + cantidad, self.entradas)):
+            tiempo, tipo, carga = self.entrada(j)
+            if tipo == BLOQUE and (comandos is None or carga[0] in comandos):
+                numeros.append(j)
+                bloques.append(carga)
+        return numeros, bloques
+
+    def cerrar(self):
+        if self.indice is not None:
+            self.indice.close()
+        self.mapa.close()
+        self.archivo.close()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+"""
+Historial en memoria de los bloques recibidos, para regresar a cualquier ciclo reciente sin una grabación. Entre dos
+pulsos de reloj cambian pocos bytes del bloque, así que cada bloque se guarda como la diferencia con el anterior: una
+máscara de 2 bytes con los campos que cambiaron seguida de sus valores nuevos. Cada `intervalo` bloques se guarda uno
+completo (un cuadro clave) y se comienza un segmento nuevo; reconstruir un bloque cuesta a lo más `intervalo`
+diferencias, sin importar la longitud de la sesión. Cuando los segmentos exceden el presupuesto de memoria se descartan
+los más antiguos.
+"""
+import sys
+from collections import deque
+from itertools import islice
+
+# La cabecera es siempre la misma y no se guarda, solo los bytes de información
+from receptor import BYTES_INFORMACION, CABECERA
+
+# Lo que ocupa cada segmento además de sus bytes: el objeto `bytearray` y su lugar en la cola
+SOBRECARGA_SEGMENTO = sys.getsizeof(bytearray()) + 8
+
+
+def _aplicar(segmento, j, trama):  # type: (bytearray, int, bytearray) -> int
+    """
+    Aplica a `trama` la diferencia que comienza en la posición `j` del segmento.
+    :return: la posición de la siguiente diferencia
+    """
+    mascara = segmento[j] | segmento[j + 1] << 8
+    j += 2
+    i = 0
+    while mascara:
+        if mascara & 1:
+            trama[i] = segmento[j]
+            j += 1
+        mascara >>= 1
+        i += 1
+    return j
+
+
+class HistorialTramas(object):
+    """
+    Anillo de bloques comprimidos con un presupuesto de memoria.
+    :param presupuesto: el máximo aproximado de bytes que ocupan los segmentos
+    :param intervalo: la cantidad de bloques entre dos cuadros clave
+    """
+
+    def __init__(self, presupuesto=32 << 20, intervalo=64):  # type: (int, int) -> None
+        self.presupuesto = presupuesto
+        self.intervalo = intervalo
+        # Los segmentos más antiguos se descartan del inicio
+        self.segmentos = deque()  # type: deque
+        # El número del primer bloque que se conserva y la cantidad de bloques que se han agregado
+        self.primero = 0
+        self.total = 0
+        self.memoria = 0
+        self.anterior = None  # type: bytearray
+
+    def __len__(self):
+        return self.total - self.primero
+
+    def agregar(self, trama):  # type: (bytearray) -> int
+        """
+        Agrega un bloque con el formato que entrega `receptor`.
+        :return: el número del bloque
+        """
+        informacion = trama[:BYTES_INFORMACION]
+        if self.total % self.intervalo == 0:
+            segmento = bytearray(informacion)
+            self.segmentos.append(segmento)
+            self.memoria += BYTES_INFORMACION + SOBRECARGA_SEGMENTO
+            if self.memoria > self.presupuesto and len(self.segmentos) > 1:
+                self.memoria -= len(self.segmentos[0]) + SOBRECARGA_SEGMENTO
+                self.segmentos.popleft()
+                self.primero += self.intervalo
+        else:
+            anterior = self.anterior
+            mascara = 0
+            cambios = bytearray()
+            for i in range(BYTES_INFORMACION):
+                if informacion[i] != anterior[i]:
+                    mascara |= 1 << i
+                    cambios.append(informacion[i])
+            segmento = self.segmentos[-1]
+            segmento.append(mascara & 0xFF)
+            segmento.append(mascara >> 8)
+            segmento += cambios
+            self.memoria += 2 + len(cambios)
+        self.anterior = informacion
+        self.total += 1
+        return self.total - 1
+
+    def obtener(self, n):  # type: (int) -> bytearray
+        """
+        Reconstruye un bloque a partir del cuadro clave de su segmento.
+        :param n: el número del bloque, entre `primero` y `total - 1`
+        :return: el bloque con el formato que entrega `receptor`
+        """
+        if not self.primero <= n < self.total:
+            raise IndexError(n)
+        segmento = self.segmentos[(n - self.primero) // self.intervalo]
+        trama = segmento[:BYTES_INFORMACION]
+        j = BYTES_INFORMACION
+        for k in range(n % self.intervalo):
+            j = _aplicar(segmento, j, trama)
+        trama += CABECERA
+        return trama
+
+    def tramas(self, desde=None):  # type: (int) -> iter
+        """
+        Recorre en orden los bloques que se conservan; cada uno se reconstruye a partir del anterior, sin volver al
+        cuadro clave. No se deben agregar bloques mientras tanto.
+        :param desde: el número del primer bloque; por omisión, `primero`
+        :return: un iterador de los bloques con el formato que entrega `receptor`
+        """
+        desde = self.primero if desde is None else max(desde, self.primero)
+        inicial = (desde - self.primero) // self.intervalo
+        n = self.primero + inicial * self.intervalo
+        for segmento in islice(self.segmentos, inicial, None):
+            trama = segmento[:BYTES_INFORMACION]
+            j = BYTES_INFORMACION
+            while True:
+                if n >= desde:
+                    yield trama + CABECERA
+                n += 1
+                if j >= len(segmento):
+                    break
+                j = _aplicar(segmento, j, trama)
+
+    def limpiar(self):
+        self.segmentos.clear()
+        self.primero = self.total = self.memoria = 0
+        self.anterior = None
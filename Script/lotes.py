@@ -0,0 +1,166 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+"""
+Ejecuta un guion de comandos sobre el depurador sin la interfaz de `curses` y escribe cada bloque recibido como JSON
+Lines o CSV, para pruebas de regresión en las placas. Los comandos se envían tan rápido como lo permite el puerto y
+las filas se escriben conforme llegan, sin acumular la sesión en memoria.
+
+El guion tiene un comando por línea; todo lo que sigue a `#` es un comentario:
+    R               aplica la rutina RESET
+    O               obtiene el estado actual
+    B n             cambia el valor de los botones
+    C [n]           envía n pulsos de reloj (1 si se omite)
+    P [n]           ejecuta n instrucciones (1 si se omite)
+    I instrucción   ensambla y envía una instrucción, solo en el modo instrucción; por ejemplo `I LIT 7`
+    HASTA condición ejecuta instrucciones hasta que se cumpla la condición (ver `puntos_ruptura`)
+
+Al terminar, el tiempo de la ejecución, los bloques por segundo y las estadísticas del enlace (ver
+`receptor.estadisticas`) se escriben en la salida de errores.
+"""
+import argparse
+import csv
+import json
+import sys
+from collections import OrderedDict
+from itertools import chain
+
+import receptor
+from ensamblador import ensamblar
+from ensamblador_reverso import COLUMNAS_LOTE, FORMATO_BLOQUE
+from grabacion import reloj_monotonico
+from puntos_ruptura import PuntosRuptura
+
+# Las columnas de cada fila: la línea del guion, el comando enviado y los campos del bloque
+COLUMNAS = ("linea", "comando") + tuple(nombre for nombre, posicion, tipo in COLUMNAS_LOTE)
+
+
+def leer_guion(lineas):  # type: (list) -> iter
+    """
+    Genera (número de línea, comando, argumento) por cada comando del guion.
+    """
+    for numero, linea in enumerate(lineas, 1):
+        linea = linea.split("#", 1)[0].strip()
+        if not linea:
+            continue
+        partes = linea.split(None, 1)
+        yield numero, partes[0].upper(), partes[1].strip() if len(partes) > 1 else ""
+
+
+def traducir(orden, argumento, modo, limite):  # type: (str, str, int, int) -> tuple
+    """
+    Convierte un comando del guion en los argumentos de `receptor.ejecutar_pasos`.
+    :return: el comando para Arduino, los pasos, la condición, la ventana y el bloque final
+    """
+    if orden in ("C", "P"):
+        return orden, int(argumento, 0) if argumento else 1, None, 32, None
+    if orden == "HASTA":
+        puntos = PuntosRuptura()
+        puntos.agregar(argumento)
+        return "P", limite, puntos.condicion, 1, None
+    if orden == "B":
+        return "B " + str(int(argumento, 0)), 1, None, 1, None
+    if orden == "I":
+        if modo != 1:
+            raise ValueError("El comando I solo existe en el modo instrucción.", orden)
+        asmed, larga = ensamblar(argumento)
+        return "I " + str(asmed) + " " + str(larga), 1, None, 1, None
+    if orden == "R":
+        # En el modo instrucción, el reset termina escribiendo el byte del programa
+        return "R", 1, None, 1, "i" if modo == 1 else None
+    if orden == "O":
+        return "O", 1, None, 1, None
+    raise ValueError("El comando {0:s} no existe.".format(orden), orden)
+
+
+def ejecutar(instrucciones, modo, limite=10000):  # type: (iter, int, int) -> iter
+    """
+    Ejecuta cada comando del guion y genera (número de línea, comando, bloque) por cada bloque recibido. Los bloques
+    que llegan después de que termina un comando se atribuyen a ese comando.
+    """
+    anterior = (0, "")
+    for numero, orden, argumento in instrucciones:
+        try:
+            comando, pasos, condicion, ventana, final = traducir(orden, argumento, modo, limite)
+        except ValueError as e:
+            raise ValueError("Línea {0:d}: {1:s}".format(numero, e.args[0] if e.args else str(e)), argumento)
+        for trama in receptor.leer_tramas():
+            yield anterior + (trama,)
+        anterior = (numero, comando)
+        bloques, completados, detenido = receptor.ejecutar_pasos(comando, pasos, condicion, ventana, final=final)
+        for trama in bloques:
+            yield numero, comando, trama
+        if completados < pasos and not detenido:
+            raise IOError("Línea {0:d}: Arduino dejó de responder después de {1:d} de {2:d} pasos.".format(
+                numero, completados, pasos))
+    for trama in receptor.leer_tramas():
+        yield anterior + (trama,)
+
+
+def filas(eventos):  # type: (iter) -> iter
+    """
+    Decodifica cada bloque en una tupla con las `COLUMNAS`.
+    """
+    for numero, comando, trama in eventos:
+        valores = FORMATO_BLOQUE.unpack_from(trama)
+        yield (numero, comando, chr(valores[0])) + valores[1:]
+
+
+def escribir_jsonl(filas_lote, salida):  # type: (iter, file) -> int
+    cantidad = 0
+    for fila in filas_lote:
+        salida.write(json.dumps(OrderedDict(zip(COLUMNAS, fila))) + "\n")
+        cantidad += 1
+    return cantidad
+
+
+def escribir_csv(filas_lote, salida):  # type: (iter, file) -> int
+    escritor = csv.writer(salida)
+    escritor.writerow(COLUMNAS)
+    cantidad = 0
+    for fila in filas_lote:
+        escritor.writerow(fila)
+        cantidad += 1
+    return cantidad
+
+
+FORMATOS = {"jsonl": escribir_jsonl, "csv": escribir_csv}
+
+if __name__ == "__main__":
+    argumentos = argparse.ArgumentParser(description="Ejecuta un guion de comandos en el depurador sin interfaz.")
+    argumentos.add_argument("puerto", help="el puerto serial, o host:puerto para conectarse a servidor.py")
+    argumentos.add_argument("baud", type=int, help="la tasa de baudios")
+    argumentos.add_argument("modo", type=int, choices=(0, 1), help="modo de operación: 0 programa, 1 instrucción")
+    argumentos.add_argument("guion", help="el archivo con los comandos, o - para leerlos de la entrada estándar")
+    argumentos.add_argument("--formato", choices=sorted(FORMATOS), default="jsonl", help="el formato de la salida")
+    argumentos.add_argument("--salida", metavar="ARCHIVO", help="el archivo de salida (por omisión, la salida "
+                                                                "estándar)")
+    argumentos.add_argument("--limite", metavar="N", type=int, default=10000,
+                            help="máximo de instrucciones para HASTA (por omisión %(default)s)")
+    argumentos.add_argument("--protocolo", type=int, choices=(1, 2), default=receptor.VERSION_PROTOCOLO,
+                            help="la versión más alta del protocolo con Arduino (por omisión %(default)s)")
+    opciones = argumentos.parse_args()
+
+    guion = sys.stdin if opciones.guion == "-" else open(opciones.guion)
+    salida = open(opciones.salida, "w") if opciones.salida else sys.stdout
+    inicio = reloj_monotonico()
+    # Los mensajes de `abrir_puerto` no deben mezclarse con las filas
+    sys.stdout, consola = sys.stderr, sys.stdout
+    try:
+        iniciales = receptor.abrir_puerto(opciones.puerto, opciones.baud, str(opciones.modo), opciones.protocolo)
+    finally:
+        sys.stdout = consola
+    conexion = reloj_monotonico() - inicio
+    receptor.iniciar_lector()
+    inicio = reloj_monotonico()
+    try:
+        eventos = chain(((0, "", trama) for trama in iniciales),
+                        ejecutar(leer_guion(guion), opciones.modo, opciones.limite))
+        total = FORMATOS[opciones.formato](filas(eventos), salida)
+    finally:
+        duracion = reloj_monotonico() - inicio
+        receptor.detener_lector()
+        salida.flush()
+    sys.stderr.write("Conexión: {0:.3f} s. Ejecución: {1:d} bloques en {2:.3f} s, {3:.1f} bloques/s.\n".format(
+        conexion, total, duracion, total / duracion if duracion > 0 else 0.0))
+    sys.stderr.write("Enlace: {0:s}\n".format(json.dumps(receptor.estadisticas())))
@@ -0,0 +1,220 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+"""
+Perfilador de ejecución para los programas de la Nibbler, a partir de los bloques que Arduino ya envía. Cada bloque que
+sigue a un flanco del reloj es un ciclo de la instrucción que está en el fetch; los de la fase de ejecución además
+marcan el inicio de una instrucción en la dirección anterior al PC. Las banderas no cambian durante el fetch, así que
+ese mismo bloque dice si un salto condicional se va a tomar. Todo se acumula en arreglos de tamaño fijo, sin asignar
+memoria por bloque, para dejarlo activo también durante los pasos encadenados.
+
+También se puede usar sin Arduino sobre una grabación (ver `grabacion`):
+
+    python perfilador.py sesion.nib --mapa programa.map --salida perfil.csv
+"""
+import argparse
+import array
+import csv
+import heapq
+import sys
+from bisect import bisect_right
+
+from ensamblador import TAMANO_ROM, leer_mapa
+from ensamblador_reverso import TABLA_INSTRUCCIONES
+from grabacion import BLOQUE, FLANCOS, Reproductor
+
+# Para cada salto condicional, la bandera que lo decide (1 cero, 2 acarreo) y el valor con el que se toma
+CONDICIONES = {"JC": (2, 2), "JNC": (2, 0), "JZ": (1, 1), "JNZ": (1, 0)}
+MASCARAS_SALTO = bytearray(16)
+VALORES_SALTO = bytearray(16)
+for _codigo, _instruccion in enumerate(TABLA_INSTRUCCIONES):
+    if _instruccion[0] in CONDICIONES:
+        MASCARAS_SALTO[_codigo], VALORES_SALTO[_codigo] = CONDICIONES[_instruccion[0]]
+# Las formas de ordenar el panel del depurador, en el orden en el que se recorren
+VISTAS = ("visitas", "dirección", "etiquetas", "instrucciones")
+
+
+class Perfilador(object):
+    """
+    Histograma de las direcciones donde comienza cada instrucción ejecutada, y los ciclos, las instrucciones y los
+    saltos tomados y no tomados de cada código de operación.
+    """
+
+    def __init__(self, tamano=TAMANO_ROM):  # type: (int) -> None
+        self.visitas = array.array("L", [0]) * tamano
+        self.ciclos = array.array("L", [0]) * 16
+        self.instrucciones = array.array("L", [0]) * 16
+        self.tomados = array.array("L", [0]) * 16
+        self.no_tomados = array.array("L", [0]) * 16
+        # Las direcciones de las etiquetas, ordenadas, y sus nombres
+        self.direcciones = []  # type: list
+        self.etiquetas = []  # type: list
+
+    def cargar_simbolos(self, etiquetas):  # type: (list) -> None
+        """
+        :param etiquetas: una lista ordenada de (dirección, etiqueta), como la que devuelve `ensamblador.leer_mapa`
+        """
+        self.direcciones = [addr for addr, etiqueta in etiquetas]
+        self.etiquetas = [etiqueta for addr, etiqueta in etiquetas]
+
+    def registrar(self, trama):  # type: (bytearray) -> None
+        """
+        Cuenta un bloque con el formato que entrega `receptor`. Los bloques que no siguen a un flanco del reloj y los
+        ciclos con la CPU en reset no se cuentan.
+        """
+        banderas = trama[7]
+        if not FLANCOS[trama[0]] or banderas & 8:
+            return
+        codigo = trama[4] >> 4
+        self.ciclos[codigo] += 1
+        if banderas & 4:
+            self.visitas[((trama[2] | (trama[3] & 0xF) << 8) - 1) & 0xFFF] += 1
+            self.instrucciones[codigo] += 1
+            mascara = MASCARAS_SALTO[codigo]
+            if mascara:
+                if banderas & mascara == VALORES_SALTO[codigo]:
+                    self.tomados[codigo] += 1
+                else:
+                    self.no_tomados[codigo] += 1
+
+    def registrar_bloques(self, tramas):  # type: (list) -> None
+        registrar = self.registrar
+        for trama in tramas:
+            registrar(trama)
+
+    def limpiar(self):
+        for arreglo in (self.visitas, self.ciclos, self.instrucciones, self.tomados, self.no_tomados):
+            for i in range(len(arreglo)):
+                arreglo[i] = 0
+
+    def total(self):  # type: () -> int
+        """
+        :return: la cantidad de instrucciones contadas
+        """
+        return sum(self.instrucciones)
+
+    def nombre(self, addr):  # type: (int) -> str
+        """
+        :return: la dirección como la etiqueta anterior más un desplazamiento, o en hexadecimal si no hay etiquetas
+        """
+        i = bisect_right(self.direcciones, addr) - 1
+        if i < 0:
+            return "0x{0:03X}".format(addr)
+        desplazamiento = addr - self.direcciones[i]
+        return self.etiquetas[i] + ("+{0:d}".format(desplazamiento) if desplazamiento else "")
+
+    def mas_visitadas(self, cantidad, por_direccion=False):  # type: (int, bool) -> list
+        """
+        :return: una lista de (dirección, visitas) con las `cantidad` direcciones más visitadas, ordenada por visitas
+        o por dirección
+        """
+        visitas = self.visitas
+        direcciones = heapq.nlargest(cantidad, (addr for addr in range(len(visitas)) if visitas[addr]),
+                                     key=visitas.__getitem__)
+        if por_direccion:
+            direcciones.sort()
+        return [(addr, visitas[addr]) for addr in direcciones]
+
+    def por_etiqueta(self):  # type: () -> list
+        """
+        Suma las visitas de cada dirección en la etiqueta anterior; las direcciones antes de la primera etiqueta se
+        suman en "0x000".
+        :return: una lista de (etiqueta, visitas), de la más visitada a la menos visitada
+        """
+        sumas = [0] * (len(self.etiquetas) + 1)
+        visitas = self.visitas
+        for addr in range(len(visitas)):
+            if visitas[addr]:
+                sumas[bisect_right(self.direcciones, addr)] += visitas[addr]
+        nombres = ["0x000"] + self.etiquetas
+        return sorted(((nombres[i], suma) for i, suma in enumerate(sumas) if suma), key=lambda fila: -fila[1])
+
+    def filas(self, vista, cantidad, texto=None):  # type: (str, int, callable) -> list
+        """
+        El contenido del panel del perfil en el depurador.
+        :param vista: una de `VISTAS`
+        :param texto: una función que desensambla la instrucción de una dirección, para mostrarla junto a ella
+        :return: una lista de a lo más `cantidad` líneas
+        """
+        total = max(1, self.total())
+        if vista == "instrucciones":
+            codigos = sorted((codigo for codigo in range(16) if self.ciclos[codigo]), key=lambda c: -self.ciclos[c])
+            # Los saltos condicionales muestran el porcentaje de veces que se tomaron
+            lineas = ["INSTR    VECES   CICLOS  SALTA"]
+            for codigo in codigos[:cantidad - 1]:
+                linea = "{0:<5s}{1:>9d}{2:>9d}".format(TABLA_INSTRUCCIONES[codigo][0], self.instrucciones[codigo],
+                                                       self.ciclos[codigo])
+                if MASCARAS_SALTO[codigo]:
+                    linea += "{0:>6.0f}%".format(100.0 * self.tomados[codigo] /
+                                                 max(1, self.tomados[codigo] + self.no_tomados[codigo]))
+                lineas.append(linea)
+            return lineas
+        if vista == "etiquetas":
+            return ["{0:<16s}{1:>9d} {2:5.1f}%".format(etiqueta, suma, 100.0 * suma / total)
+                    for etiqueta, suma in self.por_etiqueta()[:cantidad]]
+        lineas = []
+        for addr, visitas in self.mas_visitadas(cantidad, vista == "dirección"):
+            linea = "0x{0:03X} {1:>9d} {2:5.1f}%".format(addr, visitas, 100.0 * visitas / total)
+            if self.direcciones:
+                linea += "  " + self.nombre(addr)
+            if texto is not None:
+                linea += "  " + texto(addr)
+            lineas.append(linea)
+        return lineas
+
+    def exportar(self, archivo, texto=None):  # type: (str, callable) -> None
+        """
+        Escribe el perfil en un archivo CSV plano, una fila por dirección visitada, por etiqueta y por código de
+        operación, con la columna `tipo` para distinguirlas.
+        :param texto: una función que desensambla la instrucción de una dirección
+        """
+        with open(archivo, "w") as salida:
+            tabla = csv.writer(salida, lineterminator="\n")
+            tabla.writerow(("tipo", "nombre", "direccion", "instruccion", "visitas", "ciclos", "tomados",
+                            "no_tomados"))
+            for addr, visitas in self.mas_visitadas(len(self.visitas), True):
+                tabla.writerow(("pc", self.nombre(addr), "0x{0:03X}".format(addr), texto(addr) if texto else "",
+                                visitas, "", "", ""))
+            if self.direcciones:
+                for etiqueta, suma in self.por_etiqueta():
+                    tabla.writerow(("etiqueta", etiqueta, "", "", suma, "", "", ""))
+            for codigo in range(16):
+                if self.ciclos[codigo]:
+                    condicional = MASCARAS_SALTO[codigo]
+                    tabla.writerow(("instruccion", TABLA_INSTRUCCIONES[codigo][0], "", "",
+                                    self.instrucciones[codigo], self.ciclos[codigo],
+                                    self.tomados[codigo] if condicional else "",
+                                    self.no_tomados[codigo] if condicional else ""))
+
+
+if __name__ == "__main__":
+    argumentos = argparse.ArgumentParser(description="Perfila la ejecución de una grabación del depurador.")
+    argumentos.add_argument("grabacion", help="la grabación (ver depurador.py --grabar)")
+    argumentos.add_argument("--mapa", metavar="ARCHIVO",
+                            help="el mapa de símbolos, para sumar las visitas por etiqueta")
+    argumentos.add_argument("--salida", metavar="ARCHIVO", help="escribe el perfil completo en ARCHIVO como CSV")
+    argumentos.add_argument("-n", metavar="N", type=int, default=20,
+                            help="cuántas filas mostrar de cada tabla (por omisión %(default)s)")
+    opciones = argumentos.parse_args()
+
+    perfil = Perfilador()
+    if opciones.mapa:
+        perfil.cargar_simbolos(leer_mapa(opciones.mapa))
+    reproductor = Reproductor(opciones.grabacion)
+    try:
+        for i in range(len(reproductor)):
+            tiempo, tipo, carga = reproductor.entrada(i)
+            if tipo == BLOQUE:
+                perfil.registrar(carga)
+    finally:
+        reproductor.cerrar()
+    print("{0:d} instrucciones, {1:d} ciclos".format(perfil.total(), sum(perfil.ciclos)))
+    for vista in VISTAS:
+        if vista == "dirección" or (vista == "etiquetas" and not opciones.mapa):
+            continue
+        print("\n" + vista.upper())
+        for linea in perfil.filas(vista, opciones.n):
+            print(linea)
+    if opciones.salida:
+        perfil.exportar(opciones.salida)
+        sys.stderr.write("Perfil escrito en {0:s}\n".format(opciones.salida))
@@ -0,0 +1,215 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+"""
+Puntos de ruptura y de vigilancia evaluados en la computadora sobre los bloques que envía Arduino. Cada condición se
+escribe como una expresión de Python sobre los campos del bloque, por ejemplo `pc == 0x12` o `acc == 0xF and cero`, y
+todas las condiciones activas se traducen una sola vez a una función que lee directamente los bytes del bloque, sin
+interpretar la expresión ni crear objetos por cada bloque.
+"""
+import ast
+import re
+
+# Cómo se obtiene cada campo a partir de un bloque `t`, con el formato que entrega `receptor`
+CAMPOS = {
+    "cmd": "t[0]",
+    "datos": "t[1]",
+    "pc": "(t[2] | t[3] << 8)",
+    "ejec": "t[4]",
+    "u0": "t[5]",
+    "u1": "t[6]",
+    "banderas": "t[7]",
+    "cero": "(t[7] & 1)",
+    "acarreo": "(t[7] >> 1 & 1)",
+    "fase": "(t[7] >> 2 & 1)",
+    "reset": "(t[7] >> 3 & 1)",
+    "boton": "t[8]",
+    "progb": "t[9]",
+    "acc": "t[10]",
+    "out": "t[11]",
+}
+
+# Otros nombres aceptados para los campos
+ALIAS = {
+    "accum": "acc",
+    "acumulador": "acc",
+    "salida": "out",
+    "carry": "acarreo",
+    "zero": "cero",
+    "botones": "boton",
+    "instruccion": "ejec",
+}
+
+# Los nodos que puede contener una condición: números, campos, operadores aritméticos, de bits, de comparación y
+# lógicos. Cualquier otra cosa (llamadas, atributos, cadenas) se rechaza.
+_NODOS = tuple(getattr(ast, nombre) for nombre in (
+    "Expression", "BoolOp", "BinOp", "UnaryOp", "Compare", "Name", "Load", "Num", "Constant", "And", "Or", "Not",
+    "Invert", "USub", "UAdd", "Add", "Sub", "Mult", "FloorDiv", "Mod", "BitAnd", "BitOr", "BitXor", "LShift",
+    "RShift", "Eq", "NotEq", "Lt", "LtE", "Gt", "GtE") if hasattr(ast, nombre))
+
+_CONSTANTES = tuple(getattr(ast, nombre) for nombre in ("Num", "Constant") if hasattr(ast, nombre))
+_PALABRAS = frozenset(("and", "or", "not"))
+_NOMBRE = re.compile(r"\b[A-Za-z_]\w*\b")
+
+
+def _campo(nombre):  # type: (str) -> str
+    nombre = ALIAS.get(nombre.lower(), nombre.lower())
+    if nombre not in CAMPOS:
+        raise ValueError("El campo {0:s} no existe.".format(nombre), nombre)
+    return nombre
+
+
+def traducir(texto):  # type: (str) -> str
+    """
+    Verifica una condición y la traduce a una expresión de Python sobre el bloque `t`.
+    :param texto: la condición, por ejemplo `acc == 0xF and cero`; un número solo equivale a `pc == número`
+    :return: el código de la expresión traducida
+    """
+    texto = texto.strip()
+    try:
+        return "{0:s} == {1:d}".format(CAMPOS["pc"], int(texto, 0))
+    except ValueError:
+        pass
+    try:
+        arbol = ast.parse(texto, mode="eval")
+    except SyntaxError:
+        raise ValueError("La condición {0:s} no es una expresión válida.".format(texto), texto)
+    for nodo in ast.walk(arbol):
+        if not isinstance(nodo, _NODOS):
+            raise ValueError("La condición {0:s} contiene {1:s}, que no está permitido.".format(
+                texto, type(nodo).__name__), texto)
+        if isinstance(nodo, ast.Name):
+            _campo(nodo.id)
+        elif isinstance(nodo, _CONSTANTES) and not isinstance(getattr(nodo, "n", getattr(nodo, "value", None)), int):
+            raise ValueError("La condición {0:s} solo puede contener números enteros.".format(texto), texto)
+    return "({0:s})".format(_NOMBRE.sub(lambda m: m.group(0) if m.group(0) in _PALABRAS else
+                                        CAMPOS[_campo(m.group(0))], texto))
+
+
+class PuntoRuptura(object):
+    """
+    Una condición de ruptura o un campo vigilado.
+    """
+    __slots__ = ("texto", "codigo", "vigilancia", "activo", "disparos")
+
+    def __init__(self, texto, codigo, vigilancia=False):  # type: (str, str, bool) -> None
+        self.texto = texto
+        self.codigo = codigo
+        self.vigilancia = vigilancia
+        self.activo = True
+        self.disparos = 0
+
+    def __str__(self):
+        return "{0:s} {1:s}".format("vigilar" if self.vigilancia else "romper", self.texto)
+
+
+class PuntosRuptura(object):
+    """
+    El conjunto de puntos de ruptura y de vigilancia. Los puntos activos se compilan en dos funciones: una que evalúa
+    un bloque y otra que recorre una lista de bloques completa dentro del mismo ciclo de Python. Las vigilancias
+    comparan cada bloque con el anterior.
+    """
+
+    def __init__(self):
+        self.puntos = []  # type: list
+        self.anterior = None  # type: bytearray
+        self.disparado = None  # type: PuntoRuptura
+        self._evaluar = None
+        self._buscar = None
+
+    def __len__(self):
+        return len(self.puntos)
+
+    def agregar(self, texto):  # type: (str) -> PuntoRuptura
+        """
+        Agrega un punto de ruptura; ver `traducir`.
+        """
+        punto = PuntoRuptura(texto.strip(), traducir(texto))
+        self.puntos.append(punto)
+        self.compilar()
+        return punto
+
+    def vigilar(self, campo):  # type: (str) -> PuntoRuptura
+        """
+        Agrega un punto de vigilancia que se dispara cuando el campo cambia de valor.
+        """
+        campo = _campo(campo.strip())
+        codigo = CAMPOS[campo]
+        punto = PuntoRuptura(campo, "{0:s} != {1:s}".format(codigo, codigo.replace("t[", "p[")), True)
+        self.puntos.append(punto)
+        self.compilar()
+        return punto
+
+    def quitar(self, i):  # type: (int) -> PuntoRuptura
+        punto = self.puntos.pop(i)
+        self.compilar()
+        return punto
+
+    def limpiar(self):
+        del self.puntos[:]
+        self.compilar()
+
+    def compilar(self):
+        """
+        Genera las funciones de evaluación para los puntos activos. Cada función devuelve el número del punto que se
+        cumplió, contando desde 1, o 0.
+        """
+        condiciones = ["".join(("    if ", punto.codigo, ": return ", str(i + 1), "\n"))
+                       for i, punto in enumerate(self.puntos) if punto.activo]
+        codigo = "def _evaluar(t, p):\n" + "".join(condiciones) + "    return 0\n"
+        codigo += "def _buscar(tramas, p):\n    for i, t in enumerate(tramas):\n"
+        codigo += "".join("    " + condicion.replace(": return ", ": return i, ") for condicion in condiciones)
+        codigo += "        p = t\n    return -1, 0\n"
+        funciones = {}
+        exec(compile(codigo, "<puntos de ruptura>", "exec"), funciones)
+        self._evaluar = funciones["_evaluar"]
+        self._buscar = funciones["_buscar"]
+
+    def reiniciar(self, anterior=None):  # type: (bytearray) -> None
+        """
+        Olvida el último bloque visto; `anterior` es el bloque contra el que se comparan las vigilancias.
+        """
+        self.anterior = anterior
+        self.disparado = None
+
+    def evaluar(self, trama):  # type: (bytearray) -> PuntoRuptura
+        """
+        Evalúa un bloque y lo recuerda para las vigilancias.
+        :return: el punto que se cumplió, o None
+        """
+        anterior = self.anterior if self.anterior is not None else trama
+        self.anterior = trama
+        i = self._evaluar(trama, anterior)
+        if not i:
+            return None
+        punto = self.puntos[i - 1]
+        punto.disparos += 1
+        self.disparado = punto
+        return punto
+
+    def condicion(self, trama):  # type: (bytearray) -> bool
+        """
+        Igual que `evaluar`, con la forma que espera `receptor.ejecutar_pasos`.
+        """
+        return self.evaluar(trama) is not None
+
+    def buscar(self, tramas):  # type: (list) -> (int, PuntoRuptura)
+        """
+        Busca el primer bloque de una lista que cumple algún punto.
+        :return: el índice del bloque y el punto, o -1 y None
+        """
+        if not tramas:
+            return -1, None
+        anterior = self.anterior if self.anterior is not None else tramas[0]
+        i, n = self._buscar(tramas, anterior)
+        if i < 0:
+            self.anterior = tramas[-1]
+            return -1, None
+        self.anterior = tramas[i]
+        punto = self.puntos[n - 1]
+        punto.disparos += 1
+        self.disparado = punto
+        return i, punto
+
+    def puntos_activos(self):  # type: () -> list
+        return [punto for punto in self.puntos if punto.activo]
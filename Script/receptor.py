@@ -1,110 +1,985 @@
 #!/usr/bin/env python2
 # -*- coding: utf-8 -*-
-from collections import deque
+import array
+import errno
+import fcntl
+import os
+import select
+import threading
+from collections import OrderedDict, deque
+from math import frexp
 
 import serial
 
+from grabacion import Grabadora, reloj_monotonico
+
+try:
+    from Queue import Queue, Empty, Full
+except ImportError:
+    from queue import Queue, Empty, Full
+
 archivo_puerto = "/dev/null"  # type: str
 tasa_transferencia = 9600  # type: int
 tiempo_espera = 0  # type: int
 conexion_serial = None  # type: serial
 bits = 14
 
+# Cada bloque que envía Arduino comienza con estos dos bytes (ver `enviarEstado` en NibblerArduino.ino)
+CABECERA = bytearray(b'\n\r')
+# Comandos que Arduino puede enviar como primer byte de información de un bloque
+COMANDOS_VALIDOS = frozenset(bytearray(b'oCcPpanBbRrIi'))
+# Los bytes de información de cada bloque
+BYTES_INFORMACION = 12
 
-# Envía una cadena de caracteres al puerto serial y espera una respuesta
-def escribir_puerto(comando):  # type: () -> list
+# Protocolo 2 (ver `enviarEstado` y `atenderPaquete` en NibblerArduino.ino). Después de elegir el modo, el programa
+# envía `V`; Arduino responde "0v2" y desde entonces cada bloque es: el byte de sincronía, la longitud de la
+# información, un número de secuencia, la información y un CRC-8 de la longitud, la secuencia y la información. Un
+# Arduino con el protocolo 1 ignora la `V` y no responde.
+VERSION_PROTOCOLO = 2
+SINCRONIA = 0xA5
+LARGO_BLOQUE_V2 = BYTES_INFORMACION + 4
+# Los comandos se envían como paquetes de 7 bytes: sincronía, la letra del comando, la cantidad de veces que se
+# ejecuta, el primer argumento (16 bits, el byte menos significativo primero), el segundo argumento y el CRC-8 de los
+# 5 bytes anteriores
+LARGO_PAQUETE = 7
+# Tiempo máximo de espera para la respuesta a `V`
+ESPERA_NEGOCIACION = 0.5
+# Al abrir el puerto, Arduino se reinicia: tiempo máximo de espera para el byte de listo. Después, el modo se envía
+# hasta `REINTENTOS_MODO` veces, esperando la respuesta desde `ESPERA_MODO` segundos y el doble en cada intento
+ESPERA_ARRANQUE = 10.0
+REINTENTOS_MODO = 7
+ESPERA_MODO = 0.02
+
+
+def _tabla_crc8(polinomio=0x07):  # type: (int) -> bytearray
+    tabla = bytearray(256)
+    for i in range(256):
+        crc = i
+        for j in range(8):
+            crc = (crc << 1 ^ polinomio if crc & 0x80 else crc << 1) & 0xFF
+        tabla[i] = crc
+    return tabla
+
+
+# CRC-8 con el polinomio x^8 + x^2 + x + 1, el mismo que calcula `crc8` en NibblerArduino.ino
+TABLA_CRC8 = _tabla_crc8()
+
+
+def crc8(datos, crc=0):  # type: (bytearray, int) -> int
+    tabla = TABLA_CRC8
+    for byte in bytearray(datos):
+        crc = tabla[crc ^ byte]
+    return crc
+
+
+def codificar_comando(comando, veces=1):  # type: (str, int) -> bytearray
     """
-    Envía un comando al puerto serial, un String tal cual se recibe en `comando`. Posteriormente espera una respuesta
-    y divide las respuestas en los bloques enviados por el depurador, como un arreglo de dos dimensiones.
-    :param comando: el comando a enviar al depurador Arduino
-    :return: una lista de dos dimensiones, en una dimensión son las respuestas de Arduino y en la otra la información
-    obtenida
+    Convierte un comando del protocolo 1 (por ejemplo "P", "B 5" o "I 4660 1") en paquetes del protocolo 2. Un paquete
+    ejecuta el comando hasta 255 veces, así que se devuelven los paquetes necesarios para `veces`.
     """
-    global conexion_serial
-    conexion_serial.write(comando)
-    bloques = []
-    while conexion_serial.inWaiting() >= bits:
-        bloque = leer_puerto()
-        if len(bloque) == bits:
-            bloques.append(bloque)
-    conexion_serial.write([0])
-    while conexion_serial.inWaiting():
-        conexion_serial.read()
-    return bloques
+    argumentos = [int(argumento) for argumento in comando[1:].split()] + [0, 0]
+    paquetes = bytearray()
+    while veces > 0:
+        cantidad = min(veces, 255)
+        paquete = bytearray((SINCRONIA, ord(comando[0]), cantidad, argumentos[0] & 0xFF, argumentos[0] >> 8 & 0xFF,
+                             argumentos[1] & 0xFF))
+        paquete.append(crc8(paquete[1:]))
+        paquetes += paquete
+        veces -= cantidad
+    return paquetes
 
 
-def leer_puerto():  # type: () -> list
+def _codificar_texto(texto):  # type: (str) -> bytearray
     """
-    Obtiene un bloque de bytes con el formato conocido desde el depurador y lo devuelve como una lista.
-    :return: información obtenida del depurador mediante el puerto serial
+    Los bytes de un comando del protocolo 1 (latin-1): pyserial no acepta texto en Python 3.
     """
-    global conexion_serial
+    return bytearray(ord(caracter) for caracter in texto)
+
+
+def codificar_bloque(trama, secuencia):  # type: (bytearray, int) -> bytearray
+    """
+    Codifica los 12 bytes de información de un bloque como los envía Arduino con el protocolo 2.
+    """
+    bloque = bytearray((SINCRONIA, BYTES_INFORMACION, secuencia & 0xFF))
+    bloque += trama[:BYTES_INFORMACION]
+    bloque.append(crc8(bloque[1:]))
+    return bloque
+
+
+class DecodificadorTramas(object):
+    """
+    Decodificador incremental para el flujo de bytes que envía el depurador. Los bytes se acumulan en un mismo
+    `bytearray` y se buscan las cabeceras de cada bloque, de modo que los bloques incompletos se conservan hasta la
+    siguiente llamada. Cada bloque se entrega con el mismo formato que usaba `leer_puerto`: los 12 bytes de información
+    seguidos de la cabecera.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()  # type: bytearray
+        self.tramas = 0  # type: int
+        self.resincronizaciones = 0  # type: int
+        self.bytes_descartados = 0  # type: int
+        self.bytes = 0  # type: int
+        # Solo el protocolo 2 detecta bloques corruptos o perdidos
+        self.errores_crc = 0  # type: int
+        self.bloques_perdidos = 0  # type: int
+        self.grabadora = None  # type: Grabadora
+
+    def alimentar(self, datos):  # type: (bytes) -> list
+        """
+        Agrega los bytes recibidos al buffer y devuelve todos los bloques completos que contenga.
+        :param datos: los bytes leídos desde el puerto serial
+        :return: una lista con los bloques completos, cada uno como un `bytearray` de `bits` bytes
+        """
+        self.buffer += datos
+        self.bytes += len(datos)
+        tramas = list(self.extraer())
+        if self.grabadora is not None:
+            self.grabadora.bloques(tramas)
+        return tramas
+
+    def extraer(self):
+        """
+        Genera cada bloque completo que se encuentre en el buffer. Los bytes que no pertenecen a ningún bloque se
+        descartan y se cuentan como una resincronización; lo que quede de un bloque incompleto se conserva.
+        """
+        buf = self.buffer
+        inicio = 0
+        fin = 0
+        try:
+            while True:
+                i = buf.find(CABECERA, inicio)
+                if i < 0:
+                    # Conservar el último byte, podría ser la primera mitad de la siguiente cabecera
+                    fin = max(inicio, len(buf) - 1) if buf[-1:] == CABECERA[:1] else len(buf)
+                    if fin > inicio:
+                        self.resincronizaciones += 1
+                        self.bytes_descartados += fin - inicio
+                    break
+                if i > inicio:
+                    self.resincronizaciones += 1
+                    self.bytes_descartados += i - inicio
+                if len(buf) - i < bits:
+                    fin = i
+                    break
+                # Un '\n\r' también puede aparecer dentro de la información: si el comando no es válido o el siguiente
+                # bloque no comienza donde debería, esta no era una cabecera real
+                siguiente = buf[i + bits:i + bits + 2]
+                if buf[i + 2] not in COMANDOS_VALIDOS or (len(siguiente) == 2 and siguiente != CABECERA):
+                    self.resincronizaciones += 1
+                    self.bytes_descartados += 1
+                    inicio = fin = i + 1
+                    continue
+                trama = buf[i + 2:i + bits]
+                trama += CABECERA
+                inicio = fin = i + bits
+                self.tramas += 1
+                yield trama
+        finally:
+            del buf[:fin]
+
+
+class DecodificadorTramasV2(DecodificadorTramas):
+    """
+    Decodificador para el protocolo 2. Cada bloque comienza con el byte de sincronía y su longitud, así que no es
+    necesario buscar la cabecera: mientras los bloques lleguen íntegros, cada uno comienza donde terminó el anterior.
+    Solo cuando el CRC no coincide se busca el siguiente byte de sincronía. Los saltos en el número de secuencia se
+    cuentan como bloques perdidos. Los bloques se entregan con el mismo formato que `DecodificadorTramas`.
+    """
+
+    def __init__(self, anterior=None):  # type: (DecodificadorTramas) -> None
+        DecodificadorTramas.__init__(self)
+        self.secuencia = None  # type: int
+        if anterior is not None:
+            # Continúa las cuentas y la grabación del decodificador del protocolo 1 usado durante el saludo
+            self.tramas = anterior.tramas
+            self.resincronizaciones = anterior.resincronizaciones
+            self.bytes_descartados = anterior.bytes_descartados
+            self.bytes = anterior.bytes
+            self.grabadora = anterior.grabadora
+
+    def extraer(self):
+        buf = self.buffer
+        inicio = 0
+        try:
+            while len(buf) - inicio >= 2:
+                if buf[inicio] != SINCRONIA or buf[inicio + 1] != BYTES_INFORMACION:
+                    i = buf.find(bytearray((SINCRONIA,)), inicio + 1)
+                    i = len(buf) if i < 0 else i
+                    self.resincronizaciones += 1
+                    self.bytes_descartados += i - inicio
+                    inicio = i
+                    continue
+                fin = inicio + LARGO_BLOQUE_V2
+                if len(buf) < fin:
+                    break
+                if crc8(buf[inicio + 1:fin - 1]) != buf[fin - 1]:
+                    self.errores_crc += 1
+                    self.resincronizaciones += 1
+                    self.bytes_descartados += 1
+                    inicio += 1
+                    continue
+                secuencia = buf[inicio + 2]
+                if self.secuencia is not None and secuencia != self.secuencia:
+                    self.bloques_perdidos += (secuencia - self.secuencia) & 0xFF
+                self.secuencia = (secuencia + 1) & 0xFF
+                trama = buf[inicio + 3:fin - 1]
+                trama += CABECERA
+                inicio = fin
+                self.tramas += 1
+                yield trama
+        finally:
+            del buf[:inicio]
+
+
+class LectorSerial(threading.Thread):
+    """
+    Hilo dedicado a leer el puerto serial. Todo lo que llega se entrega al decodificador y los bloques completos se
+    colocan en una cola acotada; si la cola se llena, se descarta el bloque más antiguo para que la interfaz siempre
+    reciba el estado más reciente. Cada vez que llegan bloques se escribe un byte en una tubería, de modo que el hilo
+    principal puede esperar con `select` a que lleguen datos o se presione una tecla.
+    """
+
+    def __init__(self, conexion, decodificador_tramas, capacidad=4096, espera=0.1):
+        # type: (serial.Serial, DecodificadorTramas, int, float) -> None
+        threading.Thread.__init__(self, name="LectorSerial")
+        self.daemon = True
+        self.conexion = conexion
+        self.decodificador = decodificador_tramas
+        self.cola = Queue(capacidad)  # type: Queue
+        self.descartadas = 0  # type: int
+        self.error = None  # type: Exception
+        self.activo = True
+        self.espera = espera
+        self.aviso_lectura, self.aviso_escritura = os.pipe()
+        for fd in (self.aviso_lectura, self.aviso_escritura):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def run(self):
+        # Una lectura bloqueante con tiempo de espera: el hilo duerme hasta que llegan bytes
+        self.conexion.timeout = self.espera
+        while self.activo:
+            try:
+                datos = self.conexion.read(max(1, self.conexion.inWaiting()))
+            except (IOError, OSError, serial.SerialException) as e:
+                self.error = e
+                break
+            if not datos:
+                continue
+            tramas = self.decodificador.alimentar(datos)
+            for trama in tramas:
+                try:
+                    self.cola.put_nowait(trama)
+                except Full:
+                    try:
+                        self.cola.get_nowait()
+                        self.descartadas += 1
+                    except Empty:
+                        pass
+                    self.cola.put_nowait(trama)
+            if tramas:
+                self.avisar()
+        self.avisar()
+
+    def avisar(self):
+        try:
+            os.write(self.aviso_escritura, b'.')
+        except OSError as e:
+            # Si la tubería está llena, el hilo principal todavía no ha atendido el aviso anterior
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def detener(self):
+        self.activo = False
+        self.join(2 * self.espera + 1)
+        os.close(self.aviso_lectura)
+        os.close(self.aviso_escritura)
+
+
+class Histograma(object):
+    """
+    Histograma con cubetas logarítmicas: cada potencia de 2 se divide en cuatro cubetas, así que registrar un valor
+    cuesta lo mismo sin importar cuántos se hayan registrado y los percentiles se obtienen con un error menor al 25%.
+    """
+
+    def __init__(self, minimo=1e-5, octavas=24):  # type: (float, int) -> None
+        self.minimo = minimo
+        self.cuentas = array.array("L", [0] * (octavas * 4))
+        self.cantidad = 0
+        self.suma = 0.0
+        self.maximo = 0.0
+
+    def registrar(self, valor):  # type: (float) -> None
+        # valor / minimo = m * 2 ** e, con m en [0.5, 1): la octava es e y la cubeta dentro de ella, la parte de m
+        m, e = frexp(valor / self.minimo)
+        i = e * 4 + int(m * 8) - 4 if valor > self.minimo else 0
+        self.cuentas[min(i, len(self.cuentas) - 1)] += 1
+        self.cantidad += 1
+        self.suma += valor
+        if valor > self.maximo:
+            self.maximo = valor
+
+    def percentil(self, p):  # type: (float) -> float
+        """
+        :return: el límite superior de la cubeta que contiene el percentil `p`, o 0 si no hay valores
+        """
+        objetivo = self.cantidad * p / 100.0
+        acumulado = 0
+        for i, cuenta in enumerate(self.cuentas):
+            acumulado += cuenta
+            if cuenta and acumulado >= objetivo:
+                limite = self.minimo * 2 ** (i // 4 - 1) * (1 + (i % 4 + 1) / 4.0) if i >= 4 else self.minimo
+                return min(limite, self.maximo)
+        return 0.0
+
+
+class EstadisticasEnlace(object):
+    """
+    Mide la latencia de ida y vuelta de cada comando: desde que se escribe en el puerto hasta que llega su bloque
+    final (la misma letra del comando, en minúscula). Los comandos se atienden en orden, así que basta una cola.
+    """
+
+    def __init__(self, olvido=5.0):  # type: (float) -> None
+        self.inicio = reloj_monotonico()
+        self.latencias = Histograma()
+        self.en_camino = deque()  # type: deque
+        self.comandos = 0
+        self.sin_respuesta = 0
+        self.olvido = olvido
+        self.anterior = (self.inicio, 0, 0)
+        # Los segundos desde que se abre el puerto hasta el byte de listo de Arduino y hasta los primeros bloques
+        self.arranque = None  # type: float
+        self.primer_bloque = None  # type: float
+
+    def enviado(self, comando, final=None):  # type: (str, str) -> None
+        self.comandos += 1
+        self.en_camino.append((ord(final or comando[0].lower()), reloj_monotonico()))
+
+    def recibidos(self, tramas):  # type: (list) -> None
+        ahora = reloj_monotonico()
+        en_camino = self.en_camino
+        # Los comandos que nunca recibieron respuesta no deben bloquear la medición de los siguientes
+        while en_camino and ahora - en_camino[0][1] > self.olvido:
+            en_camino.popleft()
+            self.sin_respuesta += 1
+        for trama in tramas:
+            if en_camino and trama[0] == en_camino[0][0]:
+                self.latencias.registrar(ahora - en_camino.popleft()[1])
+
+
+def url_puerto(archivo):  # type: (str) -> str
+    """
+    Convierte `host:puerto` en una URL de `pyserial` para conectarse a `servidor.py`; los archivos y las URLs no
+    cambian.
+    """
+    if "://" not in archivo and not archivo.startswith("/") and ":" in archivo:
+        return "socket://" + archivo
+    return archivo
+
+
+class ConexionNibbler(object):
+    """
+    Una conexión con un depurador Arduino. Cada instancia tiene su propio puerto, decodificador, bloques pendientes,
+    grabación y estadísticas, de modo que un mismo proceso puede atender varias placas (ver `MultiplexorNibbler`).
+    """
+
+    def __init__(self):
+        self.archivo = "/dev/null"  # type: str
+        self.baudios = 9600  # type: int
+        self.modo = "0"  # type: str
+        self.serial = None  # type: serial.Serial
+        self.decodificador = DecodificadorTramas()  # type: DecodificadorTramas
+        self.pendientes = deque()  # type: deque
+        self.lector = None  # type: LectorSerial
+        self.grabadora = None  # type: Grabadora
+        self.enlace = EstadisticasEnlace()  # type: EstadisticasEnlace
+        self.ultima = None  # type: bytearray
+        self.protocolo = 1  # type: int
+        # La apertura en segundo plano (ver `abrir_en_segundo_plano`), en qué paso va y su error, si lo hubo
+        self.apertura = None  # type: threading.Thread
+        self.paso_apertura = ""  # type: str
+        self.error = None  # type: Exception
+
+    def __str__(self):
+        return self.archivo
+
+    def fileno(self):  # type: () -> int
+        return self.serial.fileno()
+
+    def abrir(self, archivo, baud, modo, protocolo=VERSION_PROTOCOLO, avisar=True):
+        # type: (str, int, str, int, bool) -> list
+        """
+        Dado el puerto serial, el baudrate y el modo de operación, intenta establecer comunicación con del depurador.
+        :param archivo: el archivo de UNIX que representa al puerto serial (debe tener permiso para acceder al archivo,
+        o pertenecer al grupo de usuarios `dialout`), o `host:puerto` para conectarse a `servidor.py`.
+        :param protocolo: la versión más alta del protocolo que se solicita; si Arduino no la acepta se usa la 1
+        :param avisar: si se imprime un aviso mientras se espera a Arduino
+        :return: los bloques que Arduino envió al inicializar
+        """
+        inicio = reloj_monotonico()
+        self.paso_apertura = "abriendo el puerto"
+        serial_tmp = serial.serial_for_url(url_puerto(archivo), baudrate=baud, timeout=ESPERA_ARRANQUE)
+        try:
+            self.paso_apertura = "esperando a que Arduino inicialice el puerto"
+            if avisar:
+                print("Esperando a que Arduino inicialice el puerto...")
+            # Lee un byte que envía Arduino cuando la conexión está lista
+            if bytearray(serial_tmp.read(1)) != bytearray(b"@"):
+                raise IOError("El depurador de Arduino no respondió correctamente a la inicialización. Verifique la "
+                              "conexión y que Arduino esté ejecutando el programa correcto.")
+            self.enlace.arranque = reloj_monotonico() - inicio
+            # Arduino responde al modo en cuanto lo lee; si la respuesta no llega, se vuelve a enviar esperando el
+            # doble cada vez
+            line = b""
+            espera = ESPERA_MODO
+            for intento in range(1, REINTENTOS_MODO + 1):
+                self.paso_apertura = "eligiendo el modo (intento {0:d} de {1:d})".format(intento, REINTENTOS_MODO)
+                serial_tmp.timeout = espera
+                serial_tmp.write(modo.encode())
+                line = serial_tmp.readline()
+                if line:
+                    break
+                espera *= 2
+            serial_tmp.timeout = tiempo_espera
+            if line != ("0p" + modo + "\r\n").encode():
+                raise IOError("No se puede conectar con el depurador.")
+        except Exception:
+            serial_tmp.close()
+            raise
+        self.archivo = archivo
+        self.baudios = baud
+        self.modo = modo
+        self.serial = serial_tmp
+        self.pendientes.clear()
+        if protocolo >= 2:
+            self.paso_apertura = "negociando el protocolo"
+            self.negociar()
+        self.recibir()
+        bloques = list(self.pendientes)
+        self.pendientes.clear()
+        if self.protocolo == 1:
+            self.serial.write([0])
+        self.recibir()
+        if bloques:
+            self.enlace.primer_bloque = reloj_monotonico() - inicio
+        self.paso_apertura = ""
+        return bloques
+
+    def abrir_en_segundo_plano(self, archivo, baud, modo, protocolo=VERSION_PROTOCOLO):
+        # type: (str, int, str, int) -> threading.Thread
+        """
+        Igual que `abrir`, en un hilo, para no detener la interfaz mientras Arduino se reinicia. Hasta que termine, la
+        conexión no se debe usar (ver `conectando`); después, los bloques que Arduino envió al inicializar quedan al
+        principio de `pendientes` o el error queda en `error`.
+        :return: el hilo de la apertura
+        """
+        self.archivo = archivo
+        self.error = None
+
+        def abrir():
+            try:
+                bloques = self.abrir(archivo, baud, modo, protocolo, False)
+            except (IOError, OSError, ValueError) as e:
+                self.error = e
+                self.paso_apertura = ""
+            else:
+                self.pendientes.extendleft(reversed(bloques))
+
+        self.apertura = threading.Thread(target=abrir)
+        # Si se sale mientras Arduino no responde, el hilo no debe impedirlo
+        self.apertura.daemon = True
+        self.apertura.start()
+        return self.apertura
+
+    def conectando(self):  # type: () -> bool
+        return self.apertura is not None and self.apertura.is_alive()
+
+    def terminar_apertura(self):  # type: () -> bool
+        """
+        :return: verdadero una sola vez, la primera vez que se llama después de que la apertura en segundo plano
+        termina, con éxito o con un error
+        """
+        if self.apertura is None or self.apertura.is_alive():
+            return False
+        self.apertura = None
+        return True
+
+    def conectada(self):  # type: () -> bool
+        """
+        :return: si el puerto está abierto y la apertura en segundo plano, si la hubo, ya terminó
+        """
+        return self.serial is not None and not self.conectando()
+
+    def negociar(self):  # type: () -> int
+        """
+        Solicita el protocolo 2. Los bloques del protocolo 1 que lleguen antes de la respuesta (los del reset con el
+        que Arduino inicia) se decodifican como tales y quedan en `pendientes`.
+        :return: la versión del protocolo que se usará
+        """
+        self.serial.write(b"V")
+        recibido = bytearray()
+        limite = reloj_monotonico() + ESPERA_NEGOCIACION
+        i = -1
+        while reloj_monotonico() < limite:
+            if not _seleccionar([self.serial], limite - reloj_monotonico()):
+                continue
+            recibido += self.serial.read(max(self.serial.inWaiting(), 4096))
+            i = recibido.find(b"0v")
+            if 0 <= i <= len(recibido) - 5 and recibido[i + 3:i + 5] == b"\r\n":
+                break
+            i = -1
+        # Arduino responde a cada modo repetido del saludo; esas respuestas quedan entre los bloques del reset
+        antes = recibido[:i if i >= 0 else len(recibido)].replace(b"0p" + self.modo.encode() + b"\r\n", b"")
+        self.pendientes.extend(self.decodificador.alimentar(antes))
+        if i < 0:
+            return self.protocolo
+        if recibido[i + 2] == ord("2"):
+            self.protocolo = 2
+            self.decodificador = DecodificadorTramasV2(self.decodificador)
+        self.pendientes.extend(self.decodificador.alimentar(recibido[i + 5:]))
+        if self.pendientes:
+            self.ultima = self.pendientes[-1]
+        return self.protocolo
+
+    def recibir(self):  # type: () -> int
+        """
+        Lee en una sola operación todo lo que esté esperando en el puerto serial y lo entrega al decodificador. Los
+        bloques completos quedan en `pendientes`.
+        :return: la cantidad de bloques completos que se obtuvieron
+        """
+        if self.lector is not None:
+            # El hilo lector es el único que lee el puerto, solo se recogen los bloques de su cola
+            tramas = []
+            try:
+                while True:
+                    tramas.append(self.lector.cola.get_nowait())
+            except Empty:
+                pass
+        else:
+            disponibles = self.serial.inWaiting()
+            if not disponibles:
+                return 0
+            # Un puerto `socket://` solo indica si hay datos, no cuántos; sin tiempo de espera, leer de más no bloquea
+            tramas = self.decodificador.alimentar(self.serial.read(max(disponibles, 4096) if self.serial.timeout == 0
+                                                                   else disponibles))
+        if tramas:
+            if self.enlace.en_camino:
+                self.enlace.recibidos(tramas)
+            self.pendientes.extend(tramas)
+            self.ultima = tramas[-1]
+        return len(tramas)
+
+    def enviar(self, comando, final=None, veces=1):  # type: (str, str, int) -> None
+        """
+        Escribe un comando `veces` veces sin esperar la respuesta. Con el protocolo 1, los comandos con argumentos se
+        terminan con el byte 0, igual que en `escribir`, para que `Serial.parseInt` no espere su tiempo límite; con el
+        protocolo 2 basta un paquete con la cantidad de veces.
+        """
+        for i in range(veces):
+            self.enlace.enviado(comando, final)
+            if self.grabadora is not None:
+                self.grabadora.comando(comando)
+        if self.protocolo == 2:
+            self.serial.write(codificar_comando(comando, veces))
+        else:
+            self.serial.write(_codificar_texto((comando + "\x00" if len(comando) > 1 else comando) * veces))
+
+    def escribir(self, comando):  # type: (str) -> list
+        """
+        Envía un comando al puerto serial, un String tal cual se recibe en `comando`. Posteriormente espera una
+        respuesta y divide las respuestas en los bloques enviados por el depurador, como un arreglo de dos dimensiones.
+        :param comando: el comando a enviar al depurador Arduino
+        :return: una lista de dos dimensiones, en una dimensión son las respuestas de Arduino y en la otra la
+        información obtenida
+        """
+        if self.grabadora is not None:
+            self.grabadora.comando(comando)
+        self.enlace.enviado(comando)
+        if self.protocolo == 2:
+            self.serial.write(codificar_comando(comando))
+        else:
+            self.serial.write(_codificar_texto(comando))
+        self.recibir()
+        bloques = list(self.pendientes)
+        self.pendientes.clear()
+        if self.protocolo == 1:
+            self.serial.write([0])
+        # Lo que llegue después del comando se conserva para la siguiente llamada a `leer`
+        self.recibir()
+        return bloques
+
+    def ejecutar_pasos(self, comando, pasos, condicion=None, ventana=32, espera=1.0, final=None, plazo=None,
+                       todas=False):
+        # type: (str, int, object, int, float, str, float, bool) -> (list, int, int)
+        """
+        Envía `pasos` comandos `C` o `P` sin esperar la respuesta de cada uno y recoge todos los bloques en una sola
+        pasada. Arduino lee un byte a la vez y su búfer de recepción es de 64 bytes, así que nunca hay más de `ventana`
+        comandos en camino: se envía un lote nuevo conforme llegan los bloques finales (`c` o `p`) de los anteriores.
+        :param comando: "C" para pulsos de reloj o "P" para instrucciones completas; también sirve cualquier otro
+        comando, por ejemplo "B 5", para enviarlo y esperar su bloque final
+        :param pasos: la cantidad máxima de comandos a enviar
+        :param condicion: una función que recibe el bloque final de cada paso y devuelve True para detenerse; los
+        comandos que ya estaban en camino se ejecutan de todas formas
+        :param ventana: la cantidad máxima de comandos sin respuesta
+        :param espera: el tiempo máximo sin recibir bloques antes de abandonar
+        :param final: el comando del bloque con el que termina cada paso; por omisión, la primera letra de `comando`
+        en minúscula
+        :param plazo: el momento (según `reloj_monotonico`) después del cual ya no se envían comandos, aunque falten
+        pasos, para ejecutar una corrida larga por partes; los que ya estaban en camino se reciben
+        :param todas: si es verdadero, la condición recibe todos los bloques de cada paso, incluidos los de los flancos
+        del reloj, y no solo el final
+        :return: los bloques recibidos desde el primer comando, la cantidad de pasos completados y el número del paso
+        (contando desde 1) en que se cumplió la condición, o 0 si no se cumplió
+        """
+        final = final or comando[0].lower()
+        codigo_final = ord(final)
+        # Lo que llegó antes de empezar no pertenece a estos pasos: vuelve a `pendientes` al terminar, para la
+        # siguiente lectura
+        self.recibir()
+        anteriores = list(self.pendientes)
+        self.pendientes.clear()
+        bloques = []
+        enviados = 0
+        completados = 0
+        detenido = 0
+        while True:
+            # El primer lote se envía aunque el plazo ya haya pasado
+            enviar = enviados < pasos and not detenido and (plazo is None or not enviados or
+                                                            reloj_monotonico() < plazo)
+            if completados >= enviados and not enviar:
+                break
+            if enviar and enviados - completados < ventana:
+                lote = min(ventana - (enviados - completados), pasos - enviados)
+                self.enviar(comando, final, lote)
+                enviados += lote
+            if not self.recibir():
+                limite = reloj_monotonico() + espera
+                while not self.recibir() and reloj_monotonico() < limite:
+                    self.esperar([self.serial] if self.lector is None else [], limite - reloj_monotonico())
+                if not self.pendientes:
+                    break
+            for trama in self.pendientes:
+                bloques.append(trama)
+                es_final = trama[0] == codigo_final
+                if es_final:
+                    completados += 1
+                if not detenido and condicion is not None and (es_final or todas) and condicion(trama):
+                    # Un bloque intermedio pertenece al paso que todavía no termina
+                    detenido = completados if es_final else completados + 1
+            self.pendientes.clear()
+        self.pendientes.extendleft(reversed(anteriores))
+        return bloques, completados, detenido
 
-    def existe_en_lista(lista1, lista2):  # type: (list, list) -> bool
-        """
-        Determina si la sublista `lista1` existe en la lista `lista2`, y devuelve True si existe, o False si no.
-        :param lista1: sublista
-        :param lista2: lista
-        :return: True si la sublista existe en la lista
-        """
-        str1 = ''.join(map(str, lista1))
-        str2 = ''.join(map(str, lista2))
-        return str1 in str2
-
-    # Alinear el buffer: a veces, el puerto serial no recibe los datos alineados. Esto descarta la información inválida
-    # hasta el siguiente bloque de bits válido
-    bloque = []
-    d = deque(maxlen=2)
-    while conexion_serial.inWaiting() and not existe_en_lista([ord('\n'), ord('\r')], d):
-        d.append(ord(conexion_serial.read()))
-    while conexion_serial.inWaiting() and len(bloque) < bits - 2:
-        bloque.append(ord(conexion_serial.read()))
-
-    if len(bloque) == bits - 2:
-        bloque.extend(d)
-        return bloque
-    else:
+    def leer(self):  # type: () -> bytearray
+        """
+        Obtiene un bloque de bytes con el formato conocido desde el depurador y lo devuelve como una lista.
+        :return: información obtenida del depurador mediante el puerto serial, o una lista vacía si no hay un bloque
+        completo
+        """
+        if not self.pendientes:
+            self.recibir()
+        if self.pendientes:
+            return self.pendientes.popleft()
         return []
 
+    def leer_tramas(self):  # type: () -> list
+        """
+        Obtiene todos los bloques que ya llegaron desde el depurador, sin esperar.
+        :return: una lista con los bloques, posiblemente vacía
+        """
+        self.recibir()
+        bloques = list(self.pendientes)
+        self.pendientes.clear()
+        return bloques
+
+    def estadisticas(self):  # type: () -> OrderedDict
+        """
+        Obtiene una instantánea de la salud del enlace: bloques y bytes recibidos y por segundo desde el inicio,
+        resincronizaciones, bytes descartados por el decodificador, bloques descartados por la cola del hilo lector,
+        bloques con errores de CRC o perdidos (solo con el protocolo 2) y los percentiles de la latencia de los
+        comandos, en milisegundos.
+        """
+        decodificador = self.decodificador
+        tiempo = reloj_monotonico() - self.enlace.inicio
+        latencias = self.enlace.latencias
+        return OrderedDict((
+            ("protocolo", self.protocolo),
+            ("tiempo", round(tiempo, 3)),
+            ("bloques", decodificador.tramas),
+            ("bytes", decodificador.bytes),
+            ("bloques_s", round(decodificador.tramas / tiempo, 1) if tiempo > 0 else 0.0),
+            ("bytes_s", round(decodificador.bytes / tiempo, 1) if tiempo > 0 else 0.0),
+            ("resincronizaciones", decodificador.resincronizaciones),
+            ("bytes_descartados", decodificador.bytes_descartados),
+            ("bloques_descartados", self.lector.descartadas if self.lector is not None else 0),
+            ("errores_crc", decodificador.errores_crc),
+            ("bloques_perdidos", decodificador.bloques_perdidos),
+            ("comandos", self.enlace.comandos),
+            ("sin_respuesta", self.enlace.sin_respuesta),
+            ("latencia_p50", round(latencias.percentil(50) * 1000, 3)),
+            ("latencia_p90", round(latencias.percentil(90) * 1000, 3)),
+            ("latencia_p99", round(latencias.percentil(99) * 1000, 3)),
+            ("latencia_max", round(latencias.maximo * 1000, 3)),
+            ("arranque", round(self.enlace.arranque, 3) if self.enlace.arranque is not None else None),
+            ("primer_bloque", round(self.enlace.primer_bloque, 3) if self.enlace.primer_bloque is not None else None),
+        ))
+
+    def linea_estado(self):  # type: () -> str
+        """
+        Resume la salud del enlace en una línea. Las tasas se calculan desde la llamada anterior.
+        """
+        decodificador = self.decodificador
+        enlace = self.enlace
+        ahora = reloj_monotonico()
+        tiempo, tramas, cantidad_bytes = enlace.anterior
+        enlace.anterior = (ahora, decodificador.tramas, decodificador.bytes)
+        intervalo = max(ahora - tiempo, 1e-6)
+        return "{0:.0f} bloques/s {1:.0f} B/s resinc {2:d} desc {3:d}B/{4:d} RTT p50 {5:.1f} p99 {6:.1f} ms".format(
+            (decodificador.tramas - tramas) / intervalo, (decodificador.bytes - cantidad_bytes) / intervalo,
+            decodificador.resincronizaciones, decodificador.bytes_descartados,
+            self.lector.descartadas if self.lector is not None else 0, enlace.latencias.percentil(50) * 1000,
+            enlace.latencias.percentil(99) * 1000)
+
+    def grabar(self, archivo):  # type: (str) -> Grabadora
+        """
+        Comienza a grabar en `archivo` todos los bloques recibidos y los comandos enviados (ver `grabacion`).
+        :param archivo: el archivo de la grabación; el índice de ciclos se escribe en `archivo.idx`
+        :return: la grabadora
+        """
+        self.detener_grabacion()
+        self.grabadora = Grabadora(archivo)
+        self.decodificador.grabadora = self.grabadora
+        return self.grabadora
+
+    def detener_grabacion(self):
+        """
+        Termina la grabación en curso, si existe.
+        """
+        if self.grabadora is not None:
+            self.decodificador.grabadora = None
+            self.grabadora.cerrar()
+            self.grabadora = None
+
+    def iniciar_lector(self, capacidad=4096):  # type: (int) -> LectorSerial
+        """
+        Inicia el hilo que lee el puerto serial en segundo plano. A partir de este momento, `leer`, `leer_tramas` y
+        `escribir` solo toman los bloques de la cola del hilo.
+        :param capacidad: la cantidad máxima de bloques que se conservan sin leer
+        :return: el hilo lector
+        """
+        if self.lector is None:
+            self.lector = LectorSerial(self.serial, self.decodificador, capacidad)
+            self.lector.start()
+        return self.lector
+
+    def detener_lector(self):
+        """
+        Detiene el hilo lector, si existe, y regresa a la lectura directa del puerto.
+        """
+        if self.lector is not None:
+            self.lector.detener()
+            self.lector = None
+            self.serial.timeout = tiempo_espera
+
+    def esperar(self, entradas=(), espera=None):  # type: (list, float) -> list
+        """
+        Duerme hasta que el hilo lector reciba bloques, alguna de las `entradas` esté lista para leerse (por ejemplo,
+        `sys.stdin` cuando se presiona una tecla) o transcurra `espera`.
+        :param entradas: otros descriptores a vigilar
+        :param espera: el tiempo máximo a esperar en segundos, o None para esperar indefinidamente
+        :return: las entradas que están listas para leerse
+        """
+        aviso = self.lector.aviso_lectura if self.lector is not None else None
+        listos = _seleccionar(list(entradas) + ([aviso] if aviso is not None else []), espera)
+        if aviso is not None and aviso in listos:
+            listos.remove(aviso)
+            try:
+                os.read(aviso, 4096)
+            except OSError:
+                pass
+        return listos
+
+    def cerrar(self):
+        """
+        Detiene el hilo lector y la grabación, y cierra el puerto.
+        """
+        self.detener_lector()
+        self.detener_grabacion()
+        if self.serial is not None:
+            self.serial.close()
+
+
+def _seleccionar(vigilar, espera):  # type: (list, float) -> list
+    try:
+        return select.select(vigilar, [], [], espera)[0]
+    except (select.error, OSError) as e:
+        # Una señal (por ejemplo SIGWINCH al cambiar el tamaño de la terminal) interrumpe la espera
+        if e.args[0] != errno.EINTR:
+            raise
+        return []
+
+
+class MultiplexorNibbler(object):
+    """
+    Atiende varias placas desde un solo hilo, sin un hilo lector por puerto: un `select` espera sobre todos los
+    puertos a la vez (y sobre otras entradas, como la terminal) y cada puerto listo se lee sin bloquear. Las conexiones
+    no deben tener su hilo lector iniciado.
+    """
+
+    def __init__(self, conexiones=()):  # type: (list) -> None
+        self.conexiones = list(conexiones)
+
+    def __len__(self):
+        return len(self.conexiones)
+
+    def __getitem__(self, i):  # type: (int) -> ConexionNibbler
+        return self.conexiones[i]
+
+    def __iter__(self):
+        return iter(self.conexiones)
+
+    def agregar(self, conexion):  # type: (ConexionNibbler) -> ConexionNibbler
+        self.conexiones.append(conexion)
+        return conexion
+
+    def esperar(self, entradas=(), espera=None):  # type: (list, float) -> (list, list)
+        """
+        Duerme hasta que algún puerto o alguna de las `entradas` tenga datos, o transcurra `espera`. Los puertos listos
+        se leen y sus bloques quedan en los `pendientes` de cada conexión.
+        :return: las conexiones que recibieron datos y las entradas que están listas para leerse
+        """
+        # Las placas que todavía se están abriendo no se vigilan
+        listos = _seleccionar([conexion for conexion in self.conexiones if conexion.conectada()] + list(entradas),
+                              espera)
+        placas = []
+        otras = []
+        for listo in listos:
+            if isinstance(listo, ConexionNibbler):
+                listo.recibir()
+                placas.append(listo)
+            else:
+                otras.append(listo)
+        return placas, otras
+
+    def difundir(self, comando, final=None):  # type: (str, str) -> None
+        """
+        Envía un comando a todas las placas sin esperar las respuestas.
+        """
+        for conexion in self.conexiones:
+            conexion.enviar(comando, final)
+
+    def ejecutar_pasos(self, comando, pasos, ventana=32, espera=1.0, final=None):
+        # type: (str, int, int, float, str) -> list
+        """
+        Igual que `ConexionNibbler.ejecutar_pasos`, en todas las placas a la vez: cada placa tiene su propia ventana de
+        comandos en camino y se le envía un lote nuevo en cuanto llegan sus bloques finales, sin esperar a las demás.
+        :return: una lista con los bloques recibidos desde el primer comando y los pasos completados de cada placa
+        """
+        final = final or comando[0].lower()
+        codigo_final = ord(final)
+        # Los bloques que ya habían llegado se apartan y vuelven a `pendientes` al terminar
+        estados = []
+        anteriores = []
+        for conexion in self.conexiones:
+            conexion.recibir()
+            anteriores.append(list(conexion.pendientes))
+            estados.append([0, 0, []])
+            conexion.pendientes.clear()
+        while True:
+            faltan = False
+            for conexion, estado in zip(self.conexiones, estados):
+                enviados, completados = estado[0], estado[1]
+                if enviados < pasos and enviados - completados < ventana:
+                    lote = min(ventana - (enviados - completados), pasos - enviados)
+                    conexion.enviar(comando, final, lote)
+                    estado[0] += lote
+                if estado[1] < estado[0]:
+                    faltan = True
+            if not faltan:
+                break
+            placas = self.esperar((), espera)[0]
+            if not placas:
+                break
+            for conexion in placas:
+                estado = estados[self.conexiones.index(conexion)]
+                for trama in conexion.pendientes:
+                    estado[2].append(trama)
+                    if trama[0] == codigo_final:
+                        estado[1] += 1
+                conexion.pendientes.clear()
+        for conexion, tramas in zip(self.conexiones, anteriores):
+            conexion.pendientes.extendleft(reversed(tramas))
+        return [(estado[2], estado[1]) for estado in estados]
+
+    def cerrar(self):
+        for conexion in self.conexiones:
+            conexion.cerrar()
+
+
+# La conexión que usan las funciones de este módulo
+principal = ConexionNibbler()  # type: ConexionNibbler
+
+
+def recibir_puerto():  # type: () -> int
+    return principal.recibir()
+
+
+# Envía una cadena de caracteres al puerto serial y espera una respuesta
+def escribir_puerto(comando):  # type: (str) -> list
+    return principal.escribir(comando)
+
+
+def ejecutar_pasos(comando, pasos, condicion=None, ventana=32, espera=1.0, final=None, plazo=None, todas=False):
+    # type: (str, int, object, int, float, str, float, bool) -> (list, int, int)
+    return principal.ejecutar_pasos(comando, pasos, condicion, ventana, espera, final, plazo, todas)
+
+
+def leer_puerto():  # type: () -> bytearray
+    return principal.leer()
+
+
+def leer_tramas():  # type: () -> list
+    return principal.leer_tramas()
+
+
+def estadisticas():  # type: () -> OrderedDict
+    return principal.estadisticas()
+
+
+def linea_estado():  # type: () -> str
+    return principal.linea_estado()
+
+
+def grabar(archivo):  # type: (str) -> Grabadora
+    return principal.grabar(archivo)
+
+
+def detener_grabacion():
+    principal.detener_grabacion()
+
+
+def iniciar_lector(capacidad=4096):  # type: (int) -> LectorSerial
+    return principal.iniciar_lector(capacidad)
+
+
+def detener_lector():
+    principal.detener_lector()
+
+
+def esperar_datos(entradas=(), espera=None):  # type: (list, float) -> list
+    return principal.esperar(entradas, espera)
+
 
-def abrir_puerto(archivo, baud, modo):
+def abrir_puerto(archivo, baud, modo, protocolo=VERSION_PROTOCOLO):
     """
-    Dado el puerto serial, el baudrate y el modo de operación, intenta establecer comunicación con del depurador.
-    :param archivo: el archivo de UNIX que representa al puerto serial (debe tener permiso para acceder al archivo,
-    o pertenecer al grupo de usuarios `dialout`).
-    :param baud:
-    :param modo:
-    :return:
+    Dado el puerto serial, el baudrate y el modo de operación, intenta establecer comunicación con del depurador (ver
+    `ConexionNibbler.abrir`).
     """
     global archivo_puerto
     global tasa_transferencia
-    global tiempo_espera
     global conexion_serial
-    serial_tmp = serial.Serial(port=archivo, baudrate=baud, timeout=tiempo_espera)
-    print("Esperando a que Arduino inicialice el puerto...")
-    # Cambia el modo a bloqueador del hilo
-    serial_tmp.timeout = None
-    # Lee un byte que envía Arduino cuando la conexión está lista
-    initchr = ord(serial_tmp.read(1))
-    if initchr != 64:
-        raise IOError("El depurador de Arduino no respondió correctamente a la inicialización. Verifique la conexión "
-                      "y que Arduino esté ejecutando el programa correcto.")
-    serial_tmp.timeout = tiempo_espera
-    line = False
-    while not line:
-        serial_tmp.write(modo)
-        line = serial_tmp.readline()
-    if line != "0p" + modo + "\r\n":
-        raise IOError("No se puede conectar con el depurador.")
+    bloques = principal.abrir(archivo, baud, modo, protocolo)
     archivo_puerto = archivo
     tasa_transferencia = baud
-    conexion_serial = serial_tmp
-    bloques = []
-    while conexion_serial.inWaiting() > 0:
-        bloque = leer_puerto()
-        if len(bloque) != 0:
-            bloques.append(bloque)
-    conexion_serial.write([0])
-    while conexion_serial.inWaiting():
-        conexion_serial.read()
+    conexion_serial = principal.serial
     return bloques
@@ -0,0 +1,84 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+"""
+Capa de dibujo para la interfaz de `curses`. Recuerda lo último que se escribió en cada posición de cada ventana para
+no volver a escribir los campos que no cambiaron, agrupa las actualizaciones de todas las ventanas en un solo
+`doupdate` y limita cuántas veces por segundo se dibuja la pantalla.
+"""
+import curses
+
+from grabacion import reloj_monotonico
+
+
+class Lienzo(object):
+    """
+    Registro de lo que se dibujó en un conjunto de ventanas.
+    :param ventanas: las ventanas en el orden en que se deben copiar a la pantalla; los marcos van antes que su
+    contenido
+    :param cuadros: el máximo de actualizaciones de la pantalla por segundo, 0 para no limitarlas
+    :param cursor: la ventana que se copia al final para dejar el cursor en su lugar, normalmente la stdscr
+    """
+
+    def __init__(self, ventanas, cuadros=30, cursor=None):  # type: (list, float, object) -> None
+        self.ventanas = list(ventanas)
+        self.cursor = cursor
+        self.intervalo = 1.0 / cuadros if cuadros > 0 else 0.0
+        self.ultimo = {}  # type: dict
+        self.sucias = set()  # type: set
+        self.siguiente = 0.0
+        self.dibujos = 0
+
+    def escribir(self, ventana, y, x, texto, atributos=0):  # type: (object, int, int, str, int) -> None
+        """
+        Escribe `texto` en la posición (`y`, `x`) de la ventana, solo si es distinto de lo que ya estaba ahí.
+        """
+        llave = (id(ventana), y, x)
+        valor = (texto, atributos)
+        if self.ultimo.get(llave) != valor:
+            ventana.addstr(y, x, texto, atributos)
+            self.ultimo[llave] = valor
+            self.sucias.add(ventana)
+
+    def marcar(self, ventana):  # type: (object) -> None
+        """
+        Marca una ventana que se modificó directamente, por ejemplo los registros con desplazamiento.
+        """
+        self.sucias.add(ventana)
+
+    def invalidar(self):  # type: () -> None
+        """
+        Olvida todo lo dibujado, después de borrar o cambiar el tamaño de las ventanas.
+        """
+        self.ultimo.clear()
+        self.sucias.update(self.ventanas)
+
+    def listo(self):  # type: () -> bool
+        """
+        :return: si ya pasó el intervalo mínimo desde la última actualización de la pantalla
+        """
+        return reloj_monotonico() >= self.siguiente
+
+    def restante(self):  # type: () -> float
+        """
+        :return: los segundos que faltan para poder actualizar la pantalla otra vez
+        """
+        return max(0.0, self.siguiente - reloj_monotonico())
+
+    def actualizar(self):  # type: () -> None
+        """
+        Copia las ventanas modificadas a la pantalla virtual y actualiza la terminal una sola vez.
+        """
+        # La ventana del cursor se copia primero para que lo que tenga pendiente (por ejemplo, todo su contenido en el
+        # primer cuadro o después de cambiar el tamaño) no tape a las demás, y al final otra vez para dejar el cursor
+        if self.cursor is not None:
+            self.cursor.noutrefresh()
+        for ventana in self.ventanas:
+            if ventana in self.sucias:
+                ventana.noutrefresh()
+        self.sucias.clear()
+        if self.cursor is not None:
+            self.cursor.noutrefresh()
+        curses.doupdate()
+        self.siguiente = reloj_monotonico() + self.intervalo
+        self.dibujos += 1
@@ -0,0 +1,336 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+"""
+Mediciones de rendimiento de las rutas críticas del depurador en la computadora: la decodificación de bloques, el
+desensamblador, el ensamblador, el perfilador, el analizador lógico, la lectura y escritura del puerto contra un
+puerto serial falso en memoria y el dibujo de la pantalla contra ventanas de `curses` falsas. No se necesita Arduino
+ni una terminal.
+
+Para cada medición se reportan las operaciones por segundo y, en Python 3, los bytes que una llamada asigna en su
+punto más alto (con `tracemalloc`; Python 2 no tiene una forma de medirlo). Los resultados se pueden guardar como una
+línea base en JSON y comparar con ella en una ejecución posterior:
+
+    python rendimiento.py --guardar base.json
+    python rendimiento.py --comparar base.json --umbral 0.15
+
+Al comparar, el programa termina con un código distinto de 0 si alguna medición es más lenta, o asigna más memoria,
+que la línea base por más del umbral. Con rondas más cortas que `TIEMPO_ESTABLE` (`--tiempo`), el umbral de la
+velocidad se amplía, porque las mediciones cortas varían más.
+"""
+import argparse
+import json
+import platform
+import sys
+from collections import OrderedDict
+from timeit import default_timer
+
+from analizador import AnalizadorLogico
+from ensamblador import ensamblar
+from ensamblador_reverso import EstadoCpu, decodificar_datos, disasm
+from grabacion import BLOQUE, Reproductor
+from perfilador import Perfilador
+from receptor import CABECERA, ConexionNibbler, DecodificadorTramas
+from renderizador import Lienzo
+from simulador import FirmwareNibbler, NucleoNibbler
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# Un programa que recorre las instrucciones más comunes, para generar los bloques cuando no se da una grabación
+# Las llamadas de las que se promedia el punto más alto de memoria: cada medición recorre datos distintos en cada
+# llamada, así que una sola no es representativa
+LLAMADAS_MEMORIA = 32
+# Las rondas más cortas que esto varían más entre ejecuciones, así que al compararlas el umbral se amplía
+TIEMPO_ESTABLE = 0.5
+
+PROGRAMA = ("LIT 3", "ADDI 5", "OUT 0", "ST 0x20", "LD 0x20", "COMPI 8", "JZ 0x008", "NORI 1", "IN 0", "JMP 0x000")
+
+
+def generar_respuestas(cantidad=256):  # type: (int) -> list
+    """
+    Ejecuta el programa de prueba en el simulador y devuelve lo que Arduino respondería a cada comando `P`, con el
+    formato del puerto: la cabecera seguida de los 12 bytes de información de cada bloque.
+    """
+    rom = bytearray()
+    for instruccion in PROGRAMA:
+        asmed, larga = ensamblar(instruccion)
+        rom += bytearray((asmed & 0xFF, asmed >> 8)) if larga else bytearray((asmed,))
+    firmware = FirmwareNibbler(NucleoNibbler(rom))
+    firmware.nucleo.reset = False
+    respuestas = []
+    for i in range(cantidad):
+        del firmware.salida[:]
+        firmware.propagar()
+        respuestas.append(bytes(firmware.salida))
+    return respuestas
+
+
+def leer_respuestas(archivo):  # type: (str) -> list
+    """
+    Obtiene los bloques de una grabación (ver `grabacion`), agrupados en la respuesta de cada comando grabado.
+    """
+    reproductor = Reproductor(archivo)
+    respuestas = []
+    actual = bytearray()
+    try:
+        for i in range(len(reproductor)):
+            tiempo, tipo, carga = reproductor.entrada(i)
+            if tipo == BLOQUE:
+                actual += CABECERA + carga[:-2]
+            elif actual:
+                respuestas.append(bytes(actual))
+                actual = bytearray()
+    finally:
+        reproductor.cerrar()
+    if actual:
+        respuestas.append(bytes(actual))
+    if not respuestas:
+        raise ValueError("La grabación {0:s} no tiene bloques.".format(archivo), archivo)
+    return respuestas
+
+
+class SerialFalso(object):
+    """
+    Un `serial.Serial` en memoria. Cada comando que se escribe (cualquier byte distinto de 0) agrega al buffer de
+    lectura la siguiente respuesta grabada, y las lecturas sin comando repiten el flujo completo.
+    """
+
+    def __init__(self, respuestas):  # type: (list) -> None
+        self.respuestas = respuestas
+        self.flujo = b"".join(respuestas)
+        self.siguiente = 0
+        self.buffer = bytearray()
+        self.timeout = 0
+
+    def inWaiting(self):  # type: () -> int
+        return len(self.buffer)
+
+    def read(self, cantidad=1):  # type: (int) -> bytes
+        datos = bytes(self.buffer[:cantidad])
+        del self.buffer[:cantidad]
+        return datos
+
+    def write(self, datos):  # type: (bytes) -> int
+        # Igual que pyserial, que en Python 3 no acepta texto
+        if not isinstance(datos, (bytes, bytearray, list)):
+            raise TypeError("unicode strings are not supported, please encode to bytes: {0!r}".format(datos))
+        if bytearray(datos).strip(b"\x00"):
+            self.buffer += self.respuestas[self.siguiente]
+            self.siguiente = (self.siguiente + 1) % len(self.respuestas)
+        return len(datos)
+
+    def llenar(self):
+        self.buffer += self.flujo
+
+
+class VentanaFalsa(object):
+    """
+    Una ventana de `curses` que solo cuenta lo que se escribe en ella.
+    """
+
+    def __init__(self):
+        self.escrituras = 0
+
+    def addstr(self, *args):
+        self.escrituras += 1
+
+    def noutrefresh(self):
+        pass
+
+
+def _ciclo(valores):  # type: (list) -> callable
+    # Devuelve una función que entrega los valores uno tras otro, sin fin
+    estado = [0]
+
+    def siguiente():
+        i = estado[0]
+        estado[0] = i + 1 if i + 1 < len(valores) else 0
+        return valores[i]
+
+    return siguiente
+
+
+def preparar(respuestas):  # type: (list) -> OrderedDict
+    """
+    Prepara cada medición.
+    :return: para cada nombre, una función sin argumentos y la cantidad de operaciones que hace cada llamada
+    """
+    from depurador import dibujar_estado
+
+    tramas = DecodificadorTramas().alimentar(b"".join(respuestas))
+    estados = [EstadoCpu(trama) for trama in tramas]
+    siguiente_trama = _ciclo(tramas)
+    siguiente_estado = _ciclo(estados)
+    siguiente_instruccion = _ciclo(PROGRAMA + ("LD 0xABC", "JNC 0x123", "ST 0xFFF"))
+    flujo = b"".join(respuestas)
+
+    def medir_decodificar_datos():
+        decodificar_datos(siguiente_trama())
+
+    def medir_disasm():
+        e = siguiente_estado()
+        disasm(e.pc, e.ejec, e.progb, e.fase, e.acarreo, e.cero)
+
+    def medir_ensamblar():
+        ensamblar(siguiente_instruccion())
+
+    def medir_decodificador():
+        DecodificadorTramas().alimentar(flujo)
+
+    lectura = ConexionNibbler()
+    lectura.serial = SerialFalso(respuestas)
+
+    def medir_leer_puerto():
+        if not lectura.leer():
+            lectura.serial.llenar()
+            lectura.leer()
+
+    escritura = ConexionNibbler()
+    escritura.serial = SerialFalso(respuestas)
+
+    def medir_escribir_puerto():
+        escritura.escribir("P")
+
+    perfil = Perfilador()
+    analizador = AnalizadorLogico()
+
+    def medir_perfilador():
+        perfil.registrar(siguiente_trama())
+
+    def medir_analizador():
+        analizador.agregar(siguiente_trama())
+
+    ventanas = (VentanaFalsa(), VentanaFalsa(), VentanaFalsa())
+    lienzo = Lienzo(ventanas)
+
+    def medir_rewrite():
+        dibujar_estado(lienzo.escribir, ventanas[0], ventanas[1], ventanas[2], siguiente_estado(), (0, 0))
+
+    return OrderedDict((
+        ("decodificar_datos", (medir_decodificar_datos, 1)),
+        ("disasm", (medir_disasm, 1)),
+        ("ensamblar", (medir_ensamblar, 1)),
+        ("decodificador_tramas", (medir_decodificador, len(tramas))),
+        ("leer_puerto", (medir_leer_puerto, 1)),
+        ("escribir_puerto", (medir_escribir_puerto, 1)),
+        ("rewrite", (medir_rewrite, 1)),
+        ("perfilador", (medir_perfilador, 1)),
+        ("analizador", (medir_analizador, 1)),
+    ))
+
+
+def _mediana(valores):  # type: (list) -> float
+    valores = sorted(valores)
+    mitad = len(valores) // 2
+    return valores[mitad] if len(valores) % 2 else (valores[mitad - 1] + valores[mitad]) / 2.0
+
+
+def medir(funcion, operaciones, tiempo=0.5, rondas=5):  # type: (callable, int, float, int) -> OrderedDict
+    """
+    Llama a `funcion` en un ciclo durante al menos `tiempo` segundos por ronda, `rondas` veces, y se queda con la
+    mediana, que varía menos entre ejecuciones que la ronda más rápida.
+    :return: las operaciones por segundo y el promedio, en `LLAMADAS_MEMORIA` llamadas, de los bytes asignados en el
+    punto más alto de cada una
+    """
+    llamadas = 1
+    while True:
+        inicio = default_timer()
+        for i in range(llamadas):
+            funcion()
+        duracion = default_timer() - inicio
+        if duracion >= tiempo / 10:
+            break
+        llamadas *= 4
+    llamadas = max(1, int(llamadas * tiempo / max(duracion, 1e-9)))
+    duraciones = []
+    for ronda in range(rondas):
+        inicio = default_timer()
+        for i in range(llamadas):
+            funcion()
+        duraciones.append(default_timer() - inicio)
+    bytes_pico = None
+    if tracemalloc is not None:
+        picos = []
+        for i in range(LLAMADAS_MEMORIA):
+            tracemalloc.start()
+            base = tracemalloc.get_traced_memory()[0]
+            funcion()
+            picos.append(tracemalloc.get_traced_memory()[1] - base)
+            tracemalloc.stop()
+        bytes_pico = int(round(sum(picos) / float(len(picos))))
+    return OrderedDict((
+        ("ops_s", round(llamadas * operaciones / _mediana(duraciones), 1)),
+        ("bytes_pico", bytes_pico),
+    ))
+
+
+def comparar(resultados, base, umbral, tiempo=TIEMPO_ESTABLE):  # type: (OrderedDict, dict, float, float) -> list
+    """
+    :param tiempo: los segundos por ronda de la medición más corta, la actual o la de la línea base; por debajo de
+    `TIEMPO_ESTABLE`, el umbral de las operaciones por segundo crece con la raíz del cociente
+    :return: una descripción de cada medición que empeoró más que el umbral respecto a la línea base
+    """
+    umbral_ops = min(0.9, umbral * max(1.0, (TIEMPO_ESTABLE / tiempo) ** 0.5))
+    regresiones = []
+    for nombre, resultado in resultados.items():
+        anterior = base.get(nombre)
+        if anterior is None:
+            continue
+        if resultado["ops_s"] < anterior["ops_s"] * (1 - umbral_ops):
+            regresiones.append("{0:s}: {1:.1f} ops/s, la base es {2:.1f}".format(nombre, resultado["ops_s"],
+                                                                                anterior["ops_s"]))
+        if resultado["bytes_pico"] is not None and anterior.get("bytes_pico") is not None and \
+                resultado["bytes_pico"] > anterior["bytes_pico"] * (1 + umbral) + 64:
+            regresiones.append("{0:s}: {1:d} bytes por llamada, la base es {2:d}".format(
+                nombre, resultado["bytes_pico"], anterior["bytes_pico"]))
+    return regresiones
+
+
+if __name__ == "__main__":
+    argumentos = argparse.ArgumentParser(description="Mide el rendimiento de las rutas críticas del depurador.")
+    argumentos.add_argument("--grabacion", metavar="ARCHIVO",
+                            help="usa los bloques de una grabación en lugar de generarlos con el simulador")
+    argumentos.add_argument("--tiempo", metavar="S", type=float, default=0.5,
+                            help="segundos por ronda de cada medición (por omisión %(default)s)")
+    argumentos.add_argument("--solo", metavar="NOMBRE", action="append", help="ejecuta solo esta medición")
+    argumentos.add_argument("--guardar", metavar="ARCHIVO", help="guarda los resultados como línea base")
+    argumentos.add_argument("--comparar", metavar="ARCHIVO", help="compara los resultados con una línea base")
+    argumentos.add_argument("--umbral", type=float, default=0.2,
+                            help="fracción que una medición puede empeorar antes de considerarse una regresión "
+                                 "(por omisión %(default)s)")
+    opciones = argumentos.parse_args()
+
+    mediciones = preparar(leer_respuestas(opciones.grabacion) if opciones.grabacion else generar_respuestas())
+    if opciones.solo:
+        desconocidas = set(opciones.solo) - set(mediciones)
+        if desconocidas:
+            argumentos.error("No existen las mediciones: " + ", ".join(sorted(desconocidas)))
+    resultados = OrderedDict()
+    for nombre, (funcion, operaciones) in mediciones.items():
+        if opciones.solo and nombre not in opciones.solo:
+            continue
+        resultados[nombre] = medir(funcion, operaciones, opciones.tiempo)
+        print("{0:<22s}{1:>14.1f} ops/s{2:>12s}".format(
+            nombre, resultados[nombre]["ops_s"], "" if resultados[nombre]["bytes_pico"] is None else
+            "{0:d} B".format(resultados[nombre]["bytes_pico"])))
+        sys.stdout.flush()
+
+    if opciones.guardar:
+        with open(opciones.guardar, "w") as archivo:
+            json.dump(OrderedDict((("python", platform.python_version()), ("tiempo", opciones.tiempo),
+                                   ("resultados", resultados))), archivo, indent=2)
+    if opciones.comparar:
+        with open(opciones.comparar) as archivo:
+            base = json.load(archivo)
+        if base.get("python") != platform.python_version():
+            sys.stderr.write("Advertencia: la línea base se midió con Python {0:s}.\n".format(base.get("python")))
+        # Las líneas base anteriores no guardaban el tiempo por ronda; se usaba el de omisión
+        regresiones = comparar(resultados, base["resultados"], opciones.umbral,
+                               min(opciones.tiempo, base.get("tiempo", TIEMPO_ESTABLE)))
+        for regresion in regresiones:
+            sys.stderr.write("Regresión en " + regresion + "\n")
+        if regresiones:
+            sys.exit(1)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+"""
+Copia en la computadora de la ROM del programa, construida con lo que Arduino ya envía en cada bloque. En el modo
+programa, el byte del programa (`progb`) es siempre el contenido de la ROM en la dirección del PC, y durante la fase de
+ejecución el fetch contiene el byte de la dirección anterior. Con eso basta para desensamblar el programa alrededor del
+PC sin enviar ningún comando adicional. La copia se puede precargar con la imagen que produce `ensamblador.py`, y las
+etiquetas de su mapa de símbolos se muestran en el listado.
+"""
+import array
+
+from ensamblador import TAMANO_ROM
+from ensamblador_reverso import LONGITUD_INSTRUCCIONES, TABLA_INSTRUCCIONES, formatear_instruccion
+
+# El valor de las direcciones de las que todavía no se sabe nada
+DESCONOCIDO = -1
+# Las instrucciones cuyo operando es una dirección de la ROM, donde tiene sentido mostrar una etiqueta
+SALTOS = frozenset(("JC", "JNC", "JZ", "JNZ", "JMP"))
+
+
+class RomSombra(object):
+    """
+    La ROM del programa en un `array` indexado por dirección, con `DESCONOCIDO` donde no se ha observado nada. También
+    se recuerdan las direcciones donde se sabe que comienza una instrucción, para alinear el desensamblado.
+    """
+
+    def __init__(self, tamano=TAMANO_ROM):  # type: (int) -> None
+        self.valores = array.array("h", [DESCONOCIDO]) * tamano
+        self.inicios = bytearray(tamano)
+        self.simbolos = {}  # type: dict
+        self.conocidos = 0
+        # Las veces que un byte observado no coincidió con el que ya se conocía, por ejemplo con una imagen distinta
+        # de la que está grabada en la ROM
+        self.diferencias = 0
+
+    def __len__(self):
+        return len(self.valores)
+
+    def fijar(self, addr, valor):  # type: (int, int) -> None
+        anterior = self.valores[addr]
+        if anterior != valor:
+            if anterior == DESCONOCIDO:
+                self.conocidos += 1
+            else:
+                self.diferencias += 1
+            self.valores[addr] = valor
+
+    def precargar(self, imagen, inicio=0):  # type: (bytearray, int) -> None
+        """
+        Copia una imagen de la ROM y marca los inicios de instrucción con un recorrido lineal desde `inicio`. Los bytes
+        que se observen después reemplazan a los de la imagen.
+        """
+        imagen = bytearray(imagen)[:len(self.valores)]
+        for addr, valor in enumerate(imagen):
+            if self.valores[addr] == DESCONOCIDO:
+                self.conocidos += 1
+            self.valores[addr] = valor
+        addr = inicio
+        while addr < len(imagen):
+            self.inicios[addr] = 1
+            addr += LONGITUD_INSTRUCCIONES[imagen[addr]]
+
+    def cargar_simbolos(self, etiquetas):  # type: (list) -> None
+        """
+        :param etiquetas: una lista de (dirección, etiqueta), como la que devuelve `ensamblador.leer_mapa`
+        """
+        self.simbolos = dict(etiquetas)
+
+    def observar(self, trama):  # type: (bytearray) -> None
+        """
+        Agrega lo que se sabe de la ROM por un bloque con el formato que entrega `receptor`. Solo es válido en el modo
+        programa: en el modo instrucción, Arduino es quien maneja el byte del programa.
+        """
+        pc = trama[2] | (trama[3] & 0xF) << 8
+        if self.valores[pc] != trama[9]:
+            self.fijar(pc, trama[9])
+        if trama[7] & 4:
+            # En la fase de ejecución el PC ya avanzó: la instrucción que se ejecuta comienza en la dirección anterior
+            pc = (pc - 1) & 0xFFF
+            if self.valores[pc] != trama[4]:
+                self.fijar(pc, trama[4])
+        self.inicios[pc] = 1
+
+    def instruccion(self, addr, siguiente_inicio=False):  # type: (int, bool) -> (str, int)
+        """
+        Desensambla la instrucción que comienza en `addr`.
+        :param siguiente_inicio: si en `addr + 1` comienza otra instrucción; entonces una instrucción larga se muestra
+        como un byte suelto
+        :return: el texto y la cantidad de bytes que ocupa
+        """
+        valor = self.valores[addr]
+        if valor == DESCONOCIDO:
+            return "??", 1
+        if LONGITUD_INSTRUCCIONES[valor] == 1:
+            return formatear_instruccion(valor, 0, -1).replace("\t", " ").strip(), 1
+        progb = self.valores[addr + 1] if addr + 1 < len(self.valores) else DESCONOCIDO
+        if siguiente_inicio:
+            return ".db 0x{0:02X}".format(valor), 1
+        nombre = TABLA_INSTRUCCIONES[valor >> 4][0]
+        if progb == DESCONOCIDO:
+            return "{0:s} 0x{1:X}??".format(nombre, valor & 0xF), 2
+        destino = (valor & 0xF) << 8 | progb
+        if nombre in SALTOS and destino in self.simbolos:
+            return "{0:s} {1:s}".format(nombre, self.simbolos[destino]), 2
+        return formatear_instruccion(valor, progb, -1).replace("\t", " ").strip(), 2
+
+    def listado(self, pc, filas):  # type: (int, int) -> (list, int)
+        """
+        Desensambla las instrucciones alrededor de `pc`. El recorrido es lineal y comienza algunas direcciones antes;
+        el PC y los inicios de instrucción conocidos lo vuelven a alinear si una instrucción larga los cruzaría.
+        :param filas: la cantidad de líneas del listado
+        :return: una lista de (dirección, texto), con None como dirección en las líneas de las etiquetas, y la línea
+        del PC en la lista
+        """
+        lineas = []
+        fin = len(self.valores)
+        addr = max(0, pc - 2 * filas)
+        linea_pc = -1
+        while addr < fin and (linea_pc < 0 or len(lineas) - linea_pc < filas):
+            etiqueta = self.simbolos.get(addr)
+            if etiqueta is not None:
+                lineas.append((None, etiqueta + ":"))
+            if addr == pc:
+                linea_pc = len(lineas)
+            texto, longitud = self.instruccion(addr, addr + 1 < fin and (addr + 1 == pc or self.inicios[addr + 1]))
+            lineas.append((addr, "0x{0:03X}  {1:s}".format(addr, texto)))
+            addr += longitud
+        desde = max(0, min(linea_pc - filas // 2, len(lineas) - filas))
+        return lineas[desde:desde + filas], linea_pc - desde
@@ -0,0 +1,259 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+"""
+Servidor TCP para compartir un depurador de Arduino entre varios clientes. El servidor es el único proceso que abre el
+puerto serial; cada cliente recibe todos los bloques que envía Arduino y uno de ellos, el que controla, puede enviar
+comandos. El primer cliente que se conecta controla la sesión y, cuando se desconecta, el control pasa al cliente más
+antiguo.
+
+Con los clientes se habla el mismo protocolo que con Arduino: al conectarse reciben `@`, responden con el modo y
+reciben "0p<modo>" seguido de los bloques. Por eso `depurador.py` y `lotes.py` se conectan con `host:puerto` en lugar
+del puerto serial, por ejemplo `depurador.py localhost:5050 115200 0`. El modo lo decide el servidor; un cliente que
+pide otro modo rechaza la conexión. El servidor puede hablar con Arduino con el protocolo 2, pero con los clientes
+siempre usa el protocolo 1: a la solicitud `V` responde "0v1".
+
+Los bloques de cada lectura del puerto se codifican una sola vez y el mismo objeto se coloca en la cola de cada
+cliente. Las colas son acotadas: si un cliente no lee a tiempo se descartan sus bloques más antiguos y se cuentan, sin
+detener la lectura del puerto ni a los demás clientes.
+"""
+import argparse
+import errno
+import select
+import socket
+import sys
+from collections import deque
+
+from grabacion import reloj_monotonico
+from receptor import CABECERA, VERSION_PROTOCOLO, ConexionNibbler
+
+# Los bytes que un cliente envía durante el saludo: el modo, repetido hasta recibir la respuesta, y el byte 0 con el
+# que termina cada comando
+BYTES_SALUDO = frozenset(bytearray(b"01\x00"))
+# Arduino envía `@` cuando termina de reiniciarse al abrir el puerto. Al abrir un `socket://`, `pyserial` descarta lo
+# que ya llegó, así que el servidor espera este tiempo antes de enviarlo
+ESPERA_SALUDO = 0.2
+
+
+class ClienteTcp(object):
+    """
+    Un cliente conectado, con su cola acotada de bloques por enviar.
+    :param capacidad: el máximo de bytes en la cola antes de descartar los bloques más antiguos
+    """
+
+    def __init__(self, conexion, direccion, capacidad):  # type: (socket.socket, tuple, int) -> None
+        self.conexion = conexion
+        self.direccion = direccion
+        self.capacidad = capacidad
+        # Cada elemento es (bytes, cantidad de bloques); el mismo objeto se comparte con los demás clientes
+        self.salida = deque()  # type: deque
+        self.pendiente = 0
+        self.desplazamiento = 0
+        self.inicio = reloj_monotonico() + ESPERA_SALUDO
+        self.saludado = False
+        self.en_saludo = True
+        self.enviados = 0
+        self.descartados = 0
+        self.ignorados = 0
+
+    def __str__(self):
+        return "{0:s}:{1:d}".format(*self.direccion[:2])
+
+    def fileno(self):  # type: () -> int
+        return self.conexion.fileno()
+
+    def encolar(self, datos, bloques=0):  # type: (bytes, int) -> None
+        self.salida.append((datos, bloques))
+        self.pendiente += len(datos)
+        # El primer elemento no se descarta si ya se envió una parte, para no cortar un bloque
+        while self.pendiente > self.capacidad and len(self.salida) > 1 + (self.desplazamiento > 0):
+            i = 1 if self.desplazamiento else 0
+            descartado, cantidad = self.salida[i]
+            del self.salida[i]
+            self.pendiente -= len(descartado)
+            self.descartados += cantidad
+
+    def enviar(self):  # type: () -> None
+        """
+        Envía lo que el socket acepte sin bloquear.
+        """
+        while self.salida:
+            datos, bloques = self.salida[0]
+            enviado = self.conexion.send(memoryview(datos)[self.desplazamiento:])
+            self.desplazamiento += enviado
+            self.pendiente -= enviado
+            if self.desplazamiento < len(datos):
+                return
+            self.salida.popleft()
+            self.desplazamiento = 0
+            self.enviados += bloques
+
+    def resumen(self):  # type: () -> str
+        return "{0:s}: {1:d} bloques enviados, {2:d} descartados, {3:d} bytes ignorados".format(
+            str(self), self.enviados, self.descartados, self.ignorados)
+
+
+class ServidorNibbler(object):
+    """
+    Atiende el puerto serial y los clientes desde un solo hilo con `select`.
+    """
+
+    def __init__(self, placa, direccion, puerto_tcp, capacidad=65536):
+        # type: (ConexionNibbler, str, int, int) -> None
+        self.placa = placa
+        self.capacidad = capacidad
+        self.clientes = []  # type: list
+        self.escucha = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.escucha.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.escucha.bind((direccion, puerto_tcp))
+        self.escucha.listen(8)
+
+    def controlador(self):  # type: () -> ClienteTcp
+        """
+        :return: el cliente que puede enviar comandos: el más antiguo que ya recibió la respuesta al saludo
+        """
+        for cliente in self.clientes:
+            if cliente.saludado:
+                return cliente
+        return None
+
+    def aceptar(self):
+        conexion, direccion = self.escucha.accept()
+        conexion.setblocking(False)
+        conexion.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        cliente = ClienteTcp(conexion, direccion, self.capacidad)
+        self.clientes.append(cliente)
+        sys.stderr.write("Cliente {0:s} conectado\n".format(str(cliente)))
+
+    def desconectar(self, cliente):  # type: (ClienteTcp) -> None
+        if cliente is self.controlador():
+            # Termina un comando con argumentos que haya quedado a medias
+            self.placa.serial.write(b"\x00")
+        self.clientes.remove(cliente)
+        cliente.conexion.close()
+        sys.stderr.write("Cliente desconectado, {0:s}\n".format(cliente.resumen()))
+        nuevo = self.controlador()
+        if nuevo is not None:
+            sys.stderr.write("Cliente {0:s} controla la sesión\n".format(str(nuevo)))
+
+    def atender(self, cliente):  # type: (ClienteTcp) -> None
+        """
+        Lee lo que envió un cliente. Solo los bytes del cliente que controla la sesión llegan a Arduino.
+        """
+        try:
+            datos = bytearray(cliente.conexion.recv(4096))
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            datos = bytearray()
+        if not datos:
+            self.desconectar(cliente)
+            return
+        if cliente.en_saludo:
+            # Los modos repetidos que sigan llegando se descartan hasta el primer comando
+            inicio = 0
+            while inicio < len(datos) and datos[inicio] in BYTES_SALUDO:
+                inicio += 1
+            if not cliente.saludado:
+                cliente.saludado = True
+                cliente.encolar(b"0p" + self.placa.modo.encode() + b"\r\n")
+                # El último estado conocido, para que el cliente no espere al siguiente comando
+                if self.placa.ultima is not None:
+                    cliente.encolar(bytes(CABECERA + self.placa.ultima[:-2]), 1)
+                if cliente is self.controlador():
+                    sys.stderr.write("Cliente {0:s} controla la sesión\n".format(str(cliente)))
+            datos = datos[inicio:]
+            cliente.en_saludo = not datos
+        if b"V" in datos:
+            # Los bloques se reenvían con el protocolo 1 sin importar el que se use con Arduino
+            datos = datos.replace(b"V", b"")
+            cliente.encolar(b"0v1\r\n")
+        if not datos:
+            return
+        if cliente is self.controlador():
+            self.placa.serial.write(datos)
+        else:
+            cliente.ignorados += len(datos)
+
+    def difundir(self):
+        """
+        Codifica los bloques recibidos en un solo objeto y lo coloca en la cola de cada cliente.
+        """
+        tramas = self.placa.leer_tramas()
+        if not tramas:
+            return
+        # Cada bloque del receptor termina con la cabecera; en el puerto la cabecera va antes de la información
+        datos = bytes(bytearray(b"").join(CABECERA + trama[:-2] for trama in tramas))
+        for cliente in self.clientes:
+            if cliente.saludado:
+                cliente.encolar(datos, len(tramas))
+
+    def ejecutar(self):
+        while True:
+            ahora = reloj_monotonico()
+            for cliente in self.clientes:
+                if cliente.inicio is not None and cliente.inicio <= ahora:
+                    cliente.inicio = None
+                    cliente.encolar(b"@")
+            escribir = [cliente for cliente in self.clientes if cliente.salida]
+            inicios = [cliente.inicio - ahora for cliente in self.clientes if cliente.inicio is not None]
+            try:
+                listos, disponibles = select.select([self.escucha, self.placa] + self.clientes, escribir, [],
+                                                    max(0.0, min(inicios)) if inicios else None)[:2]
+            except (select.error, OSError) as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                continue
+            for listo in listos:
+                if listo is self.escucha:
+                    self.aceptar()
+                elif listo is self.placa:
+                    self.placa.recibir()
+                elif listo in self.clientes:
+                    self.atender(listo)
+            self.difundir()
+            for cliente in disponibles:
+                if cliente not in self.clientes:
+                    continue
+                try:
+                    cliente.enviar()
+                except socket.error as e:
+                    if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                        self.desconectar(cliente)
+
+    def cerrar(self):
+        for cliente in list(self.clientes):
+            self.desconectar(cliente)
+        self.escucha.close()
+        self.placa.cerrar()
+
+
+if __name__ == "__main__":
+    argumentos = argparse.ArgumentParser(description="Comparte el depurador de Arduino con varios clientes por TCP.")
+    argumentos.add_argument("puerto", help="el puerto serial")
+    argumentos.add_argument("baud", type=int, help="la tasa de baudios")
+    argumentos.add_argument("modo", type=int, choices=(0, 1), help="modo de operación: 0 programa, 1 instrucción")
+    argumentos.add_argument("--direccion", default="127.0.0.1",
+                            help="la dirección en la que se aceptan clientes (por omisión %(default)s)")
+    argumentos.add_argument("--tcp", metavar="PUERTO", type=int, default=5050,
+                            help="el puerto TCP (por omisión %(default)s)")
+    argumentos.add_argument("--capacidad", metavar="BYTES", type=int, default=65536,
+                            help="máximo de bytes sin enviar por cliente antes de descartar bloques "
+                                 "(por omisión %(default)s)")
+    argumentos.add_argument("--grabar", metavar="ARCHIVO", help="graba la sesión en ARCHIVO")
+    argumentos.add_argument("--protocolo", type=int, choices=(1, 2), default=VERSION_PROTOCOLO,
+                            help="la versión más alta del protocolo con Arduino (por omisión %(default)s)")
+    opciones = argumentos.parse_args()
+
+    placa = ConexionNibbler()
+    if opciones.grabar:
+        placa.grabar(opciones.grabar)
+    placa.abrir(opciones.puerto, opciones.baud, str(opciones.modo), opciones.protocolo)
+    servidor = ServidorNibbler(placa, opciones.direccion, opciones.tcp, opciones.capacidad)
+    sys.stderr.write("Escuchando en {0:s}:{1:d}\n".format(opciones.direccion, opciones.tcp))
+    try:
+        servidor.ejecutar()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        servidor.cerrar()
@@ -0,0 +1,542 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+"""
+Simulador de la CPU Nibbler y del depurador de Arduino. Abre una pseudo-terminal y habla exactamente el protocolo de
+`NibblerArduino.ino`, de modo que `depurador.py` y `receptor` pueden usarla como si fuera el puerto serial de Arduino:
+
+    python simulador.py --rom programa.bin
+    python depurador.py /dev/pts/N 115200 0
+
+Detrás del protocolo corre un modelo de la CPU a nivel de señales: en cada ciclo se leen las banderas de las dos ROM de
+microcódigo y son esas señales las que deciden qué maneja el bus de datos y qué registros se cargan.
+"""
+import argparse
+import os
+import pty
+import select
+import sys
+import time
+import tty
+
+from receptor import LARGO_PAQUETE, SINCRONIA, VERSION_PROTOCOLO, codificar_bloque, crc8
+
+# Bits de la ROM de microcódigo 0 (ver NibblerArduino.h), los que comienzan con `n` son activos en bajo
+nLOADOUT, nOEOPERAND, nOEIN, nOEALU, nWERAM, nCSRAM, S0, S1 = (1 << i for i in range(8))
+# Bits de la ROM de microcódigo 1
+S2, S3, M, nCARRYIN, nLOADFLAGS, nLOADA, nLOADPC, INCPC = (1 << i for i in range(8))
+
+# Valor de cada ROM de microcódigo cuando ninguna señal está activa
+INACTIVO0 = nLOADOUT | nOEOPERAND | nOEIN | nOEALU | nWERAM | nCSRAM
+INACTIVO1 = nCARRYIN | nLOADFLAGS | nLOADA | nLOADPC
+
+# Funciones de la ALU 74181 que usa la CPU: (S3 S2 S1 S0, M, nCARRYIN)
+ALU_SUMA = (0b1001, 0, 1)
+ALU_RESTA = (0b0110, 0, 0)
+ALU_NOR = (0b0001, 1, 1)
+ALU_B = (0b1010, 1, 1)
+ALU_A = (0b1111, 1, 1)
+
+
+def _microinstruccion(alu=None, activas0=0, activas1=0, incpc=False):  # type: (tuple, int, int, bool) -> (int, int)
+    """
+    Construye el valor de las dos ROM de microcódigo para una microinstrucción.
+    :param alu: la función de la ALU, una de las constantes `ALU_*`
+    :param activas0: las señales activas en bajo de la ROM 0 que se activan
+    :param activas1: las señales activas en bajo de la ROM 1 que se activan
+    :param incpc: si se incrementa el PC
+    :return: los bytes de la ROM 0 y la ROM 1
+    """
+    u0 = INACTIVO0 & ~activas0
+    u1 = INACTIVO1 & ~activas1
+    if alu is not None:
+        s, m, carry_in = alu
+        u0 |= (s & 1) * S0 | (s >> 1 & 1) * S1
+        u1 |= (s >> 2 & 1) * S2 | (s >> 3 & 1) * S3 | m * M
+        if not carry_in:
+            u1 &= ~nCARRYIN
+    if incpc:
+        u1 |= INCPC
+    return u0, u1
+
+
+def generar_microcodigo():  # type: () -> (bytearray, bytearray)
+    """
+    Genera el contenido de las dos ROM de microcódigo. La dirección es `instr << 3 | fase << 2 | acarreo << 1 | cero`.
+    :return: las ROM 0 y 1, de 128 bytes cada una
+    """
+    micro0 = bytearray(128)
+    micro1 = bytearray(128)
+    for direccion in range(128):
+        instr, fase, acarreo, cero = direccion >> 3, direccion >> 2 & 1, direccion >> 1 & 1, direccion & 1
+        if not fase:
+            # Fase de obtención: el fetch carga la instrucción y el PC avanza
+            u = _microinstruccion(incpc=True)
+        elif instr in (0, 1, 8, 9):
+            # JC, JNC, JZ, JNZ: si no se cumple la condición, se salta el byte de la dirección
+            condicion = (acarreo, not acarreo, cero, not cero)[(0, 1, 8, 9).index(instr)]
+            u = _microinstruccion(activas1=nLOADPC) if condicion else _microinstruccion(incpc=True)
+        else:
+            u = {
+                2: _microinstruccion(ALU_RESTA, nOEOPERAND, nLOADFLAGS),
+                3: _microinstruccion(ALU_RESTA, nCSRAM, nLOADFLAGS, True),
+                4: _microinstruccion(ALU_B, nOEOPERAND, nLOADA),
+                5: _microinstruccion(ALU_B, nOEIN, nLOADA),
+                6: _microinstruccion(ALU_B, nCSRAM, nLOADA, True),
+                7: _microinstruccion(ALU_A, nOEALU | nCSRAM | nWERAM, 0, True),
+                10: _microinstruccion(ALU_SUMA, nOEOPERAND, nLOADA | nLOADFLAGS),
+                11: _microinstruccion(ALU_SUMA, nCSRAM, nLOADA | nLOADFLAGS, True),
+                12: _microinstruccion(activas1=nLOADPC),
+                13: _microinstruccion(ALU_A, nOEALU | nLOADOUT),
+                14: _microinstruccion(ALU_NOR, nOEOPERAND, nLOADA | nLOADFLAGS),
+                15: _microinstruccion(ALU_NOR, nCSRAM, nLOADA | nLOADFLAGS, True),
+            }[instr]
+        micro0[direccion], micro1[direccion] = u
+    return micro0, micro1
+
+
+MICRO0, MICRO1 = generar_microcodigo()
+
+
+def alu74181(s, m, carry_in, a, b):  # type: (int, int, bool, int, int) -> (int, bool)
+    """
+    Las funciones del 74181 (datos activos en alto) que usa el microcódigo.
+    :return: el resultado de 4 bits y el acarreo de salida
+    """
+    if m:
+        resultado = {0b0001: ~(a | b), 0b1010: b, 0b1111: a}.get(s, 0)
+        return resultado & 0xF, False
+    if s == 0b1001:
+        total = a + b + carry_in
+    elif s == 0b0110:
+        total = a + (~b & 0xF) + carry_in
+    else:
+        total = a + carry_in
+    return total & 0xF, total > 0xF
+
+
+class NucleoNibbler(object):
+    """
+    Modelo de la CPU Nibbler ciclo a ciclo. Los registros son los mismos que lee Arduino, y el flanco de subida del
+    reloj se simula con `reloj`.
+    """
+
+    def __init__(self, rom=None, micro0=MICRO0, micro1=MICRO1):
+        # type: (bytearray, bytearray, bytearray) -> None
+        self.rom = bytearray(4096)  # type: bytearray
+        if rom:
+            self.rom[:len(rom)] = bytearray(rom)[:4096]
+        self.micro0 = bytearray(micro0)
+        self.micro1 = bytearray(micro1)
+        self.ram = bytearray(4096)  # type: bytearray
+        self.pc = 0
+        self.fase = 0
+        self.fetch = 0
+        self.acc = 0
+        self.out = 0
+        self.cero = False
+        self.acarreo = False
+        self.boton = 0
+        self.reset = True
+        # En el modo instrucción, Arduino maneja los pines de la ROM del programa
+        self.prog_forzado = None  # type: int
+        self.ciclos = 0
+
+    @property
+    def progb(self):  # type: () -> int
+        return self.rom[self.pc] if self.prog_forzado is None else self.prog_forzado
+
+    def senales(self):  # type: () -> (int, int)
+        """
+        :return: las banderas de las ROM de microcódigo 0 y 1 para el estado actual
+        """
+        direccion = (self.fetch >> 4) << 3 | self.fase << 2 | self.acarreo << 1 | self.cero
+        return self.micro0[direccion], self.micro1[direccion]
+
+    def _datapath(self, u0, u1):  # type: (int, int) -> (int, int, bool)
+        """
+        Resuelve la parte combinacional: el valor del bus de datos y la salida de la ALU.
+        :return: bus, resultado de la ALU, acarreo de la ALU
+        """
+        direccion = (self.fetch & 0xF) << 8 | self.progb
+        if not u0 & nOEOPERAND:
+            bus = self.fetch & 0xF
+        elif not u0 & nOEIN:
+            bus = self.boton
+        elif not u0 & nCSRAM and u0 & nWERAM:
+            bus = self.ram[direccion]
+        else:
+            bus = 0
+        s = (u0 & S0 and 1) | (u0 & S1 and 2) | (u1 & S2 and 4) | (u1 & S3 and 8)
+        resultado, acarreo = alu74181(s, u1 & M, not u1 & nCARRYIN, self.acc, bus)
+        if not u0 & nOEALU:
+            bus = resultado
+        return bus, resultado, acarreo
+
+    @property
+    def datos(self):  # type: () -> int
+        return self._datapath(*self.senales())[0]
+
+    def reloj(self):
+        """
+        Un flanco de subida del reloj.
+        """
+        u0, u1 = self.senales()
+        bus, resultado, acarreo = self._datapath(u0, u1)
+        direccion = (self.fetch & 0xF) << 8 | self.progb
+        if not u1 & nLOADFLAGS:
+            self.cero = resultado == 0
+            self.acarreo = acarreo
+        if not u1 & nLOADA:
+            self.acc = resultado
+        if not u0 & nLOADOUT:
+            self.out = bus
+        if not u0 & nWERAM and not u0 & nCSRAM:
+            self.ram[direccion] = bus
+        if not self.fase:
+            self.fetch = self.progb
+        if self.reset:
+            self.pc = 0
+            self.fase = 0
+        else:
+            if not u1 & nLOADPC:
+                self.pc = direccion
+            elif u1 & INCPC:
+                self.pc = (self.pc + 1) & 0xFFF
+            self.fase ^= 1
+        self.ciclos += 1
+
+    def bloque(self, comando):  # type: (int) -> bytearray
+        """
+        Construye el bloque de 14 bytes tal como lo envía `enviarEstado`, con la cabecera al inicio.
+        """
+        u0, u1 = self.senales()
+        return bytearray((10, 13, comando, self._datapath(u0, u1)[0], self.pc & 0xFF, self.pc >> 8, self.fetch, u0, u1,
+                          self.cero | self.acarreo << 1 | self.fase << 2 | self.reset << 3, self.boton, self.progb,
+                          self.acc, self.out))
+
+
+class FirmwareNibbler(object):
+    """
+    Las rutinas de `NibblerArduino.ino` sobre un `NucleoNibbler`. Los bloques que Arduino enviaría se acumulan en
+    `salida`.
+    """
+
+    def __init__(self, nucleo):  # type: (NucleoNibbler) -> None
+        self.nucleo = nucleo
+        self.salida = bytearray()  # type: bytearray
+        self.modo = None  # type: str
+        self.protocolo = 1
+        self.secuencia = 0
+
+    def enviar_estado(self, t):
+        if self.protocolo == 2:
+            self.salida += codificar_bloque(self.nucleo.bloque(ord(t))[2:], self.secuencia)
+            self.secuencia = (self.secuencia + 1) & 0xFF
+        else:
+            self.salida += self.nucleo.bloque(ord(t))
+
+    def pulso(self):
+        self.enviar_estado('C')
+        self.nucleo.reloj()
+        self.enviar_estado('c')
+
+    def propagar(self):
+        self.enviar_estado('P')
+        if not self.nucleo.fase:
+            self.nucleo.reloj()
+            self.enviar_estado('a')
+        while self.nucleo.fase:
+            self.nucleo.reloj()
+            self.enviar_estado('n')
+        self.enviar_estado('p')
+
+    def escribir_boton(self, boton):
+        self.enviar_estado('B')
+        self.nucleo.boton = boton & 0xF
+        self.enviar_estado('b')
+
+    def reset_cpu(self):
+        self.nucleo.reset = True
+        self.enviar_estado('R')
+        self.propagar()
+        self.escribir_boton(0)
+        self.nucleo.reset = False
+        self.enviar_estado('r')
+
+    def escribir_progbyte(self, larga, progb):
+        self.enviar_estado('I')
+        self.propagar()
+        self.nucleo.prog_forzado = progb & 0xFF
+        if larga > 0:
+            self.pulso()
+            self.nucleo.prog_forzado = progb >> 8 & 0xFF
+        self.propagar()
+        self.enviar_estado('i')
+
+    def iniciar(self):
+        """
+        Lo que hace `setup` antes de esperar el modo: un pulso con la CPU en reset y el byte de listo.
+        """
+        self.nucleo.reset = True
+        self.nucleo.reloj()
+        self.salida.append(64)
+
+    def seleccionar_modo(self, modo):  # type: (str) -> bool
+        """
+        Responde a la selección de modo de `setup`.
+        :return: verdadero si el modo es válido
+        """
+        if modo not in ('0', '1'):
+            return False
+        self.modo = modo
+        self.salida += b"0p" + modo.encode() + b"\r\n"
+        if modo == '0':
+            self.nucleo.prog_forzado = None
+        self.reset_cpu()
+        return True
+
+    def atender(self, lector):  # type: (LectorBytes) -> None
+        """
+        Atiende un comando de `depurarPrograma` o `depurarInstruccion`.
+        :param lector: de donde se leen el comando y sus argumentos
+        """
+        comando = lector.leer()
+        if comando is None:
+            return
+        if comando == SINCRONIA:
+            self.atender_paquete(lector)
+            return
+        comando = chr(comando)
+        if comando == 'O':
+            self.enviar_estado('o')
+        elif comando == 'R':
+            self.reset_cpu()
+            if self.modo == '1':
+                self.escribir_progbyte(0, 0)
+        elif comando == 'B':
+            self.escribir_boton(parse_int(lector))
+        elif comando == 'C':
+            self.pulso()
+        elif comando == 'P':
+            self.propagar()
+        elif comando == 'I' and self.modo == '1':
+            # El firmware evalúa los argumentos de derecha a izquierda: el primer número es la instrucción
+            progb = parse_int(lector)
+            larga = parse_int(lector)
+            self.escribir_progbyte(larga, progb)
+        elif comando == self.modo:
+            self.salida += b"0p" + comando.encode() + b"\r\n"
+        elif comando == 'V':
+            self.salida += b"0v" + str(VERSION_PROTOCOLO).encode() + b"\r\n"
+            self.protocolo = VERSION_PROTOCOLO
+            self.secuencia = 0
+
+    def atender_paquete(self, lector):  # type: (LectorBytes) -> None
+        """
+        Atiende un paquete del protocolo 2 (ver `atenderPaquete`), después de su byte de sincronía.
+        """
+        paquete = bytearray()
+        while len(paquete) < LARGO_PAQUETE - 1:
+            byte = lector.leer(1.0)
+            if byte is None:
+                return
+            paquete.append(byte)
+        if crc8(paquete[:-1]) != paquete[-1]:
+            return
+        comando = chr(paquete[0])
+        argumento0 = paquete[2] | paquete[3] << 8
+        argumento1 = paquete[4]
+        for i in range(paquete[1]):
+            if comando == 'O':
+                self.enviar_estado('o')
+            elif comando == 'R':
+                self.reset_cpu()
+                if self.modo == '1':
+                    self.escribir_progbyte(0, 0)
+            elif comando == 'B':
+                self.escribir_boton(argumento0)
+            elif comando == 'C':
+                self.pulso()
+            elif comando == 'P':
+                self.propagar()
+            elif comando == 'I' and self.modo == '1':
+                self.escribir_progbyte(argumento1, argumento0)
+
+
+class LectorBytes(object):
+    """
+    Los bytes recibidos por el firmware simulado. Si se da una función `recibir(espera)`, se usa para esperar más
+    bytes cuando el buffer está vacío.
+    """
+
+    def __init__(self, recibir=None):  # type: (callable) -> None
+        self.buffer = bytearray()  # type: bytearray
+        self.recibir = recibir
+
+    def agregar(self, datos):
+        self.buffer += datos
+
+    def _esperar(self, espera):
+        if not self.buffer and espera and self.recibir is not None:
+            self.buffer += self.recibir(espera)
+
+    def observar(self, espera=0):  # type: (float) -> int
+        """
+        :return: el siguiente byte sin consumirlo, o None si no llega en `espera` segundos
+        """
+        self._esperar(espera)
+        return self.buffer[0] if self.buffer else None
+
+    def leer(self, espera=0):  # type: (float) -> int
+        """
+        :return: el siguiente byte, o None si no llega en `espera` segundos
+        """
+        self._esperar(espera)
+        return self.buffer.pop(0) if self.buffer else None
+
+
+def parse_int(lector, espera=1.0):  # type: (LectorBytes, float) -> int
+    """
+    Imita `Serial.parseInt`: descarta todo hasta un dígito o '-', lee los dígitos y se detiene en el primer carácter
+    que no lo sea, sin consumirlo. Si no llega nada en `espera` segundos, devuelve lo leído hasta entonces.
+    """
+    negativo = False
+    valor = 0
+    leido = False
+    while True:
+        c = lector.observar(espera)
+        if c is None:
+            break
+        if ord('0') <= c <= ord('9'):
+            valor = valor * 10 + c - ord('0')
+            leido = True
+        elif c == ord('-') and not leido:
+            negativo = True
+        elif leido:
+            break
+        lector.leer()
+    return -valor if negativo else valor
+
+
+class SimuladorPty(object):
+    """
+    Conecta un `FirmwareNibbler` a una pseudo-terminal. Cuando un programa abre la terminal, el simulador se comporta
+    como un Arduino recién reiniciado; cuando la cierra, vuelve a esperar. Una pseudo-terminal no tiene DTR, así que el
+    cierre solo se detecta si la terminal permanece cerrada al menos unas décimas de segundo.
+    """
+
+    def __init__(self, rom=None, latencia=0.0, baudios=115200, arranque=0.1, micro0=MICRO0, micro1=MICRO1):
+        # type: (bytearray, float, int, float, bytearray, bytearray) -> None
+        self.rom = rom
+        self.micro = (micro0, micro1)
+        self.latencia = latencia
+        self.baudios = baudios
+        self.arranque = arranque
+        self.maestro, esclavo = pty.openpty()
+        self.nombre = os.ttyname(esclavo)
+        tty.setraw(esclavo)
+        os.close(esclavo)
+        self.sondeo = select.poll()
+        self.sondeo.register(self.maestro, select.POLLIN | select.POLLHUP)
+        self.firmware = None  # type: FirmwareNibbler
+        self.lector = LectorBytes(self._recibir)
+        self._libre = 0.0
+
+    def _conectado(self, espera):  # type: (float) -> (bool, bool)
+        """
+        :return: si hay un programa con la terminal abierta y si hay datos para leer
+        """
+        eventos = self.sondeo.poll(espera * 1000)
+        if not eventos:
+            return True, False
+        evento = eventos[0][1]
+        return not evento & select.POLLHUP, bool(evento & select.POLLIN)
+
+    def _recibir(self, espera):  # type: (float) -> bytes
+        conectado, datos = self._conectado(espera)
+        if not conectado:
+            raise EOFError()
+        return os.read(self.maestro, 4096) if datos else b""
+
+    def _enviar(self):
+        """
+        Envía la salida del firmware respetando la latencia y la tasa de baudios configuradas.
+        """
+        datos = bytes(self.firmware.salida)
+        del self.firmware.salida[:]
+        if not datos:
+            return
+        if self.latencia:
+            time.sleep(self.latencia)
+        if self.baudios:
+            # Cada byte ocupa 10 bits en la línea (inicio, 8 de datos y parada)
+            ahora = time.time()
+            self._libre = max(self._libre, ahora) + len(datos) * 10.0 / self.baudios
+        while datos:
+            try:
+                datos = datos[os.write(self.maestro, datos):]
+            except OSError:
+                return
+        if self.baudios and self._libre > time.time():
+            time.sleep(self._libre - time.time())
+
+    def sesion(self):
+        """
+        Atiende a un programa desde que abre la terminal hasta que la cierra.
+        """
+        self.firmware = FirmwareNibbler(NucleoNibbler(self.rom, *self.micro))
+        self.lector.buffer = bytearray()
+        time.sleep(self.arranque)
+        self.firmware.iniciar()
+        self._enviar()
+        try:
+            while self.firmware.modo is None:
+                c = self.lector.leer(1.0)
+                if c is not None and self.firmware.seleccionar_modo(chr(c)):
+                    self._enviar()
+            while True:
+                if self.lector.observar(1.0) is not None:
+                    self.firmware.atender(self.lector)
+                    self._enviar()
+        except EOFError:
+            pass
+
+    def ejecutar(self):
+        while True:
+            conectado, datos = self._conectado(0.05)
+            if conectado:
+                self.sesion()
+                continue
+            if datos:
+                # Mientras la terminal se cierra, el programa espera a que se lea lo que escribió
+                try:
+                    os.read(self.maestro, 4096)
+                except OSError:
+                    pass
+            time.sleep(0.05)
+
+
+def _leer_archivo(nombre):  # type: (str) -> bytearray
+    with open(nombre, "rb") as f:
+        return bytearray(f.read())
+
+
+if __name__ == "__main__":
+    argumentos = argparse.ArgumentParser(description="Simulador de la CPU Nibbler y del depurador de Arduino.")
+    argumentos.add_argument("--rom", help="imagen de la ROM del programa (ver ensamblador.py)")
+    argumentos.add_argument("--micro0", help="imagen de la ROM de microcódigo 0 (128 bytes)")
+    argumentos.add_argument("--micro1", help="imagen de la ROM de microcódigo 1 (128 bytes)")
+    argumentos.add_argument("--latencia", type=float, default=0.0, help="segundos antes de cada respuesta")
+    argumentos.add_argument("--baudios", type=int, default=115200, help="tasa simulada, 0 para no limitarla")
+    opciones = argumentos.parse_args()
+    simulador = SimuladorPty(_leer_archivo(opciones.rom) if opciones.rom else None, opciones.latencia,
+                             opciones.baudios,
+                             micro0=_leer_archivo(opciones.micro0) if opciones.micro0 else MICRO0,
+                             micro1=_leer_archivo(opciones.micro1) if opciones.micro1 else MICRO1)
+    print(simulador.nombre)
+    sys.stdout.flush()
+    try:
+        simulador.ejecutar()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,280 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+"""
+Simulador por lotes de la CPU Nibbler con NumPy, para validar un programa con miles de secuencias de botones a la vez.
+El estado de todas las instancias (PC, fetch, acumulador, salida, banderas y la RAM de 4 bits) se guarda en arreglos
+con una dimensión de lote, y cada paso ejecuta una instrucción completa en todas las instancias: las instrucciones se
+decodifican con `TABLA_INSTRUCCIONES` de `ensamblador_reverso` y cada operación se aplica con máscaras, sin ciclos de
+Python por instancia.
+
+Cada paso equivale al comando `P` de Arduino y produce, por instancia, el bloque `p` con el mismo formato que entrega
+`receptor`, así que los resultados se pueden leer con `decodificar_datos` o `decodificar_lote`:
+
+    python simulador_lote.py programa.bin --pasos 200 --longitud 3 --salida trazas.npy
+
+Con `--verificar N`, las primeras N instancias se ejecutan también en el modelo ciclo a ciclo de `simulador.py` y se
+comparan bloque por bloque (ver `verificar`).
+
+NumPy es opcional para el resto del depurador; solo este módulo lo necesita.
+"""
+import argparse
+import sys
+
+from ensamblador_reverso import BYTES_BLOQUE, COLUMNAS_LOTE, TABLA_INSTRUCCIONES, decodificar_lote
+from grabacion import reloj_monotonico
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Las operaciones de la ALU que usa cada instrucción; las instrucciones que no aparecen no cargan el acumulador ni las
+# banderas
+OPERACIONES = {
+    "COMPI": "resta", "COMPM": "resta",
+    "LIT": "b", "IN": "b", "LD": "b",
+    "ADDI": "suma", "ADDM": "suma",
+    "NORI": "nor", "NORM": "nor",
+}
+# Las instrucciones que actualizan las banderas
+CARGAN_BANDERAS = frozenset(("COMPI", "COMPM", "ADDI", "ADDM", "NORI", "NORM"))
+
+# Los valores de las ROM de microcódigo al terminar una instrucción (fase de obtención), igual para todas
+U0_OBTENCION = 0x3F
+U1_OBTENCION = 0xF8
+
+
+def _tabla(condicion):  # type: (callable) -> numpy.ndarray
+    # Un arreglo de 16 booleanos, indexado por el código de operación
+    return numpy.array([bool(condicion(nombre, larga, usa_carry, usa_cero))
+                        for nombre, larga, usa_carry, usa_cero in TABLA_INSTRUCCIONES])
+
+
+class SimuladorLote(object):
+    """
+    `lote` instancias de la CPU Nibbler que ejecutan el mismo programa en paralelo, recién reiniciadas con el comando
+    `R` de Arduino.
+    :param rom: la imagen de la ROM del programa, hasta 4K bytes
+    :param lote: la cantidad de instancias
+    """
+
+    def __init__(self, rom, lote):  # type: (bytearray, int) -> None
+        if numpy is None:
+            raise ImportError("El simulador por lotes requiere NumPy.")
+        self.rom = numpy.zeros(4096, dtype=numpy.uint8)
+        rom = numpy.frombuffer(bytes(bytearray(rom)[:4096]), dtype=numpy.uint8)
+        self.rom[:len(rom)] = rom
+        self.lote = lote
+        self.indices = numpy.arange(lote)
+        # Después del reset, el fetch tiene el primer byte del programa
+        self.pc = numpy.zeros(lote, dtype=numpy.int32)
+        self.fetch = numpy.full(lote, self.rom[0], dtype=numpy.int32)
+        self.acc = numpy.zeros(lote, dtype=numpy.int32)
+        self.out = numpy.zeros(lote, dtype=numpy.int32)
+        self.cero = numpy.zeros(lote, dtype=bool)
+        self.acarreo = numpy.zeros(lote, dtype=bool)
+        self.boton = numpy.zeros(lote, dtype=numpy.int32)
+        self.ram = numpy.zeros((lote, 4096), dtype=numpy.uint8)
+        self.pasos = 0
+
+        # Tablas por código de operación, derivadas de la tabla del desensamblador
+        self.larga = _tabla(lambda nombre, larga, c, z: larga).astype(numpy.int32)
+        self.salto = _tabla(lambda nombre, larga, c, z: c or z or nombre == "JMP")
+        self.salto_acarreo = _tabla(lambda nombre, larga, c, z: c)
+        self.negado = _tabla(lambda nombre, larga, c, z: nombre.startswith("JN"))
+        self.incondicional = _tabla(lambda nombre, larga, c, z: nombre == "JMP")
+        self.lee_ram = _tabla(lambda nombre, larga, c, z: larga and nombre in OPERACIONES)
+        self.lee_boton = _tabla(lambda nombre, larga, c, z: nombre == "IN")
+        self.escribe_ram = _tabla(lambda nombre, larga, c, z: nombre == "ST")
+        self.escribe_salida = _tabla(lambda nombre, larga, c, z: nombre == "OUT")
+        self.carga_banderas = _tabla(lambda nombre, larga, c, z: nombre in CARGAN_BANDERAS)
+        self.operacion = {operacion: _tabla(lambda nombre, larga, c, z: OPERACIONES.get(nombre) == operacion)
+                          for operacion in ("resta", "b", "suma", "nor")}
+        self.carga_acc = _tabla(lambda nombre, larga, c, z: nombre in OPERACIONES and not nombre.startswith("COMP"))
+
+    def paso(self, boton=None):  # type: (numpy.ndarray) -> None
+        """
+        Ejecuta una instrucción en todas las instancias.
+        :param boton: el valor de los botones de cada instancia (o uno para todas) antes de la instrucción; si se
+        omite, se conserva el anterior
+        """
+        if boton is not None:
+            self.boton[:] = numpy.asarray(boton) & 0xF
+        # Fase de obtención
+        self.fetch = self.rom[self.pc].astype(numpy.int32)
+        pc = (self.pc + 1) & 0xFFF
+        # Fase de ejecución
+        instr = self.fetch >> 4
+        operando = self.fetch & 0xF
+        direccion = operando << 8 | self.rom[pc]
+        b = numpy.where(self.lee_ram[instr], self.ram[self.indices, direccion],
+                        numpy.where(self.lee_boton[instr], self.boton, operando))
+        a = self.acc
+        suma = a + b
+        resta = a + (~b & 0xF) + 1
+        resultado = numpy.select([self.operacion["suma"][instr], self.operacion["resta"][instr],
+                                  self.operacion["nor"][instr]], [suma & 0xF, resta & 0xF, ~(a | b) & 0xF], b)
+        acarreo = numpy.select([self.operacion["suma"][instr], self.operacion["resta"][instr]],
+                               [suma > 0xF, resta > 0xF], False)
+
+        escribe = self.escribe_ram[instr]
+        if escribe.any():
+            self.ram[self.indices[escribe], direccion[escribe]] = a[escribe]
+        self.out = numpy.where(self.escribe_salida[instr], a, self.out)
+
+        # Los saltos condicionales usan las banderas anteriores a la instrucción
+        condicion = numpy.where(self.salto_acarreo[instr], self.acarreo, self.cero) != self.negado[instr]
+        salta = self.salto[instr] & (self.incondicional[instr] | condicion)
+        self.pc = numpy.where(salta, direccion, (pc + self.larga[instr]) & 0xFFF)
+
+        carga = self.carga_banderas[instr]
+        self.cero = numpy.where(carga, resultado == 0, self.cero)
+        self.acarreo = numpy.where(carga, acarreo, self.acarreo)
+        self.acc = numpy.where(self.carga_acc[instr], resultado, a)
+        self.pasos += 1
+
+    def bloques(self, salida=None):  # type: (numpy.ndarray) -> numpy.ndarray
+        """
+        Construye el bloque `p` de cada instancia, con el formato que entrega `receptor`: los 12 bytes de información
+        seguidos de la cabecera.
+        :param salida: un arreglo de (lote, 14) bytes donde escribir los bloques, por ejemplo una fila de la traza
+        :return: el arreglo de los bloques
+        """
+        if salida is None:
+            salida = numpy.empty((self.lote, BYTES_BLOQUE), dtype=numpy.uint8)
+        salida[:, 0] = ord('p')
+        # En la fase de obtención nada maneja el bus de datos
+        salida[:, 1] = 0
+        salida[:, 2] = self.pc & 0xFF
+        salida[:, 3] = self.pc >> 8
+        salida[:, 4] = self.fetch
+        salida[:, 5] = U0_OBTENCION
+        salida[:, 6] = U1_OBTENCION
+        salida[:, 7] = self.cero.astype(numpy.uint8) | self.acarreo.astype(numpy.uint8) << 1
+        salida[:, 8] = self.boton
+        salida[:, 9] = self.rom[self.pc]
+        salida[:, 10] = self.acc
+        salida[:, 11] = self.out
+        salida[:, 12] = 10
+        salida[:, 13] = 13
+        return salida
+
+    def ejecutar(self, botones, registrar=True):  # type: (numpy.ndarray, bool) -> numpy.ndarray
+        """
+        Ejecuta una instrucción por cada fila de `botones`.
+        :param botones: un arreglo de (pasos, lote) con el valor de los botones de cada instancia en cada paso
+        :param registrar: si es verdadero, devuelve los bloques de todos los pasos; si no, solo los del último
+        :return: un arreglo de (pasos, lote, 14) bytes, o de (lote, 14) si no se registra la traza
+        """
+        botones = numpy.asarray(botones)
+        traza = numpy.empty((len(botones), self.lote, BYTES_BLOQUE), dtype=numpy.uint8) if registrar else None
+        for i, fila in enumerate(botones):
+            self.paso(fila)
+            if registrar:
+                self.bloques(traza[i])
+        return traza if registrar else self.bloques()
+
+
+def secuencias_exhaustivas(longitud, pasos):  # type: (int, int) -> numpy.ndarray
+    """
+    Todas las secuencias de `longitud` valores de los botones, 16 ** longitud instancias. Cada valor se mantiene durante
+    la misma cantidad de pasos.
+    :return: un arreglo de (pasos, 16 ** longitud) con el valor de los botones de cada instancia en cada paso
+    """
+    if numpy is None:
+        raise ImportError("El simulador por lotes requiere NumPy.")
+    instancias = numpy.arange(16 ** longitud)
+    # El valor j de cada secuencia es el dígito hexadecimal j de su número de instancia, el más significativo primero
+    valores = numpy.array([instancias >> 4 * (longitud - 1 - j) & 0xF for j in range(longitud)])
+    tramo = max(1, -(-pasos // longitud))
+    return numpy.repeat(valores, tramo, axis=0)[:pasos]
+
+
+def verificar(rom, botones, instancias=None):  # type: (bytearray, numpy.ndarray, int) -> list
+    """
+    Compara `SimuladorLote` con el modelo ciclo a ciclo de `simulador.NucleoNibbler`, bloque por bloque: cada instancia
+    del modelo recibe los mismos botones con el comando `B` antes de cada `P`, como lo haría Arduino.
+    :param botones: un arreglo de (pasos, lote) con el valor de los botones de cada instancia en cada paso
+    :param instancias: cuántas instancias comparar, las primeras; por omisión, todas
+    :return: las diferencias, como tuplas (paso, instancia, bloque del lote, bloque del modelo); el paso cuenta desde 1
+    """
+    # simulador.py importa `pty`, que solo existe en Unix, así que el modelo de referencia solo se importa aquí
+    from simulador import FirmwareNibbler, NucleoNibbler
+    botones = numpy.asarray(botones)[:, :instancias]
+    traza = SimuladorLote(rom, botones.shape[1]).ejecutar(botones)
+    diferencias = []
+    for instancia in range(botones.shape[1]):
+        firmware = FirmwareNibbler(NucleoNibbler(rom))
+        firmware.seleccionar_modo('0')
+        for paso, boton in enumerate(botones[:, instancia]):
+            firmware.escribir_boton(int(boton))
+            firmware.propagar()
+            # El bloque del modelo lleva la cabecera al inicio y el del lote al final
+            bloque = firmware.nucleo.bloque(ord('p'))
+            bloque = bloque[2:] + bloque[:2]
+            obtenido = bytearray(traza[paso, instancia].tobytes())
+            if obtenido != bloque:
+                diferencias.append((paso + 1, instancia, obtenido, bloque))
+    return diferencias
+
+
+def trazas(bloques, columna):  # type: (numpy.ndarray, str) -> numpy.ndarray
+    """
+    Extrae una columna de una traza de `SimuladorLote.ejecutar`, con `decodificar_lote`.
+    :return: un arreglo de (lote, pasos) con el valor de la columna de cada instancia en cada paso
+    """
+    pasos, lote = bloques.shape[:2]
+    decodificados = decodificar_lote(numpy.ascontiguousarray(bloques.swapaxes(0, 1)).tobytes(), como_numpy=True)
+    return decodificados[columna].reshape(lote, pasos)
+
+
+if __name__ == "__main__":
+    argumentos = argparse.ArgumentParser(description="Ejecuta un programa con muchas secuencias de botones a la vez.")
+    argumentos.add_argument("rom", help="imagen de la ROM del programa (ver ensamblador.py)")
+    argumentos.add_argument("--pasos", type=int, default=100, help="instrucciones a ejecutar (por omisión "
+                                                                     "%(default)s)")
+    argumentos.add_argument("--longitud", type=int, default=2,
+                            help="cada instancia recibe una de las 16 ** LONGITUD secuencias de botones "
+                                 "(por omisión %(default)s)")
+    argumentos.add_argument("--aleatorias", metavar="N", type=int,
+                            help="en lugar de todas las secuencias, N secuencias aleatorias que cambian en cada paso")
+    argumentos.add_argument("--semilla", type=int, default=0, help="semilla de las secuencias aleatorias")
+    argumentos.add_argument("--columna", choices=[nombre for nombre, posicion, tipo in COLUMNAS_LOTE], default="out",
+                            help="la columna cuyas trazas se comparan (por omisión %(default)s)")
+    argumentos.add_argument("--salida", metavar="ARCHIVO", help="guarda los bloques de todos los pasos en un .npy")
+    argumentos.add_argument("--verificar", metavar="N", type=int,
+                            help="compara además las primeras N instancias con el modelo ciclo a ciclo de "
+                                 "simulador.py, bloque por bloque, y termina con error si alguno difiere")
+    opciones = argumentos.parse_args()
+    if numpy is None:
+        argumentos.error("El simulador por lotes requiere NumPy.")
+
+    with open(opciones.rom, "rb") as archivo:
+        imagen = bytearray(archivo.read())
+    if opciones.aleatorias:
+        secuencias = numpy.random.RandomState(opciones.semilla).randint(0, 16, (opciones.pasos, opciones.aleatorias))
+    else:
+        secuencias = secuencias_exhaustivas(opciones.longitud, opciones.pasos)
+    simulador = SimuladorLote(imagen, secuencias.shape[1])
+    inicio = reloj_monotonico()
+    resultado = simulador.ejecutar(secuencias)
+    duracion = reloj_monotonico() - inicio
+    columna = trazas(resultado, opciones.columna)
+    distintas = len(numpy.unique(columna, axis=0))
+    sys.stderr.write("{0:d} instancias x {1:d} pasos en {2:.3f} s, {3:.0f} instrucciones/s. {4:d} trazas distintas "
+                     "de {5:s}.\n".format(simulador.lote, opciones.pasos, duracion,
+                                         simulador.lote * opciones.pasos / duracion if duracion > 0 else 0.0,
+                                         distintas, opciones.columna))
+    if opciones.salida:
+        numpy.save(opciones.salida, resultado)
+    if opciones.verificar:
+        diferencias = verificar(imagen, secuencias, opciones.verificar)
+        for paso, instancia, obtenido, esperado in diferencias[:10]:
+            sys.stderr.write("Paso {0:d}, instancia {1:d}: {2:s} en lugar de {3:s}\n".format(
+                paso, instancia, " ".join("{0:02X}".format(b) for b in obtenido),
+                " ".join("{0:02X}".format(b) for b in esperado)))
+        sys.stderr.write("{0:d} bloques comparados con el modelo ciclo a ciclo, {1:d} diferentes.\n".format(
+            min(opciones.verificar, simulador.lote) * opciones.pasos, len(diferencias)))
+        if diferencias:
+            sys.exit(1)